@@ -0,0 +1,103 @@
+"""Echo benchmark for ezstruct over asyncio streams.
+
+Sends messages through a socketpair to an echo server and reads them
+back, comparing two ways of using ezstruct with asyncio:
+
+  ``framed``: each message is packed with ``pack_bytes`` and sent behind
+  a 4-byte length, then read back with ``readexactly`` and unpacked
+  with ``unpack_bytes``; one ``write`` and ``drain`` per message.
+
+  ``streamed``: messages are sent with ``Struct.pack_to_transport``, one
+  ``writelines`` and ``drain`` per batch, and read back with
+  ``Struct.unpack_async``.
+
+Run with ``python benchmarks/bench_asyncio.py``.
+"""
+import asyncio
+import socket
+import struct
+import time
+
+import ezstruct
+
+MESSAGE = ezstruct.Struct(
+    "NET_ENDIAN",
+    ezstruct.Field("UINT32", name="id"),
+    ezstruct.Field("UINT16", name="kind"),
+    ezstruct.Field("STRING", name="topic", string_encoding="utf-8",
+                   length=ezstruct.Delimiter(b"\0")),
+    ezstruct.Field("BYTES", name="payload", length=ezstruct.Field("UINT16")))
+
+FRAME = struct.Struct("!L")
+COUNT = 20000
+BATCH = 100
+
+
+def _records():
+    return [{"id": i, "kind": i % 7, "topic": u"sensors/%d" % (i % 13),
+             "payload": b"\xab" * (i % 64)} for i in range(COUNT)]
+
+
+async def _echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def _connect():
+    client_sock, server_sock = socket.socketpair()
+    server_reader, server_writer = await asyncio.open_connection(sock=server_sock)
+    echo = asyncio.ensure_future(_echo(server_reader, server_writer))
+    reader, writer = await asyncio.open_connection(sock=client_sock)
+    return reader, writer, echo
+
+
+async def framed(records):
+    reader, writer, echo = await _connect()
+
+    async def send():
+        for record in records:
+            data = MESSAGE.pack_bytes(record)
+            writer.write(FRAME.pack(len(data)) + data)
+            await writer.drain()
+
+    sender = asyncio.ensure_future(send())
+    for _ in records:
+        size, = FRAME.unpack(await reader.readexactly(FRAME.size))
+        MESSAGE.unpack_bytes(await reader.readexactly(size))
+    await sender
+    writer.close()
+    await echo
+
+
+async def streamed(records):
+    reader, writer, echo = await _connect()
+
+    async def send():
+        for start in range(0, len(records), BATCH):
+            await MESSAGE.pack_to_transport(writer,
+                                            records[start:start + BATCH])
+
+    sender = asyncio.ensure_future(send())
+    for _ in records:
+        await MESSAGE.unpack_async(reader)
+    await sender
+    writer.close()
+    await echo
+
+
+def main():
+    records = _records()
+    for name, bench in (("framed", framed), ("streamed", streamed)):
+        start = time.perf_counter()
+        asyncio.run(bench(records))
+        elapsed = time.perf_counter() - start
+        print("%-10s %10.0f messages/s" % (name, len(records) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
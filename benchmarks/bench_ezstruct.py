@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""Pack and unpack throughput benchmarks for ezstruct.
+
+Each scenario is a structure exercising one feature: every field type,
+every kind of ``length``, fixed and variable ``repeat``, string
+encodings and value transforms.  Each is timed packing with
+``pack_bytes`` and unpacking with ``unpack_bytes``, both as it is and
+compiled with ``codegen=True``, and compared against hand-written code
+using the :py:mod:`struct` module that produces the same bytes.
+
+Results can be saved as JSON with ``--output``, and compared with a
+saved run with ``--baseline``.  Since runs may come from different
+machines, the comparison uses each result's time relative to its
+:py:mod:`struct` baseline, and flags those which got more than
+``--threshold`` slower; the exit status is 1 if any did.
+
+Run with ``make bench``, or e.g.::
+
+  PYTHONPATH=. python benchmarks/bench_ezstruct.py --filter length_ \\
+    --baseline bench.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import struct
+import sys
+import timeit
+
+import ezstruct
+
+
+class Scenario(object):
+    """A structure, a record of it, and the equivalent ``struct`` code.
+
+    Args:
+      ``name``: The scenario's name.
+      ``ezs``: The :py:class:`ezstruct.Struct`.
+      ``record``: The data to pack.
+      ``baseline_pack``: Packs ``record`` by hand.
+      ``baseline_unpack``: Unpacks ``baseline_pack``'s result by hand.
+    """
+
+    def __init__(self, name, ezs, record, baseline_pack, baseline_unpack):
+        self.name = name
+        self.struct = ezs
+        self.record = record
+        self.baseline_pack = baseline_pack
+        self.baseline_unpack = baseline_unpack
+        self.packed = baseline_pack(record)
+
+    def check(self):
+        """Makes sure ezstruct and the baseline agree."""
+        packed = self.struct.pack_bytes(self.record)
+        assert packed == self.packed, (self.name, packed, self.packed)
+        unpacked = self.struct.unpack_bytes(packed)
+        assert unpacked == self.baseline_unpack(packed), self.name
+        assert unpacked == self.record, self.name
+
+
+def _numeric(type_name, fmt, value):
+    compiled = struct.Struct(">" + fmt)
+    return Scenario(
+        "type_%s" % type_name,
+        ezstruct.Struct("NET_ENDIAN", ezstruct.Field(type_name, name="v")),
+        {"v": value},
+        lambda data: compiled.pack(data["v"]),
+        lambda packed: {"v": compiled.unpack(packed)[0]})
+
+
+def _bytes_scenarios():
+    prefix = struct.Struct(">H")
+    n_prefix = struct.Struct(">B")
+    payload = b"\xab" * 40
+
+    def pack_delimited(data):
+        return data["v"] + b"\0"
+
+    def unpack_delimited(packed):
+        return {"v": packed[:packed.index(b"\0")]}
+
+    def pack_prefixed(data):
+        return prefix.pack(len(data["v"])) + data["v"]
+
+    def unpack_prefixed(packed):
+        length = prefix.unpack_from(packed)[0]
+        return {"v": packed[2:2 + length]}
+
+    def pack_computed(data):
+        return n_prefix.pack(data["n"]) + data["v"]
+
+    def unpack_computed(packed):
+        length = n_prefix.unpack_from(packed)[0]
+        return {"n": length, "v": packed[1:1 + length]}
+
+    yield Scenario(
+        "type_BYTES",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("BYTES", name="v", length=40)),
+        {"v": payload},
+        lambda data: data["v"],
+        lambda packed: {"v": packed})
+    yield Scenario(
+        "length_fixed",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("BYTES", name="v", length=40,
+                                       repeat=4)),
+        {"v": [payload] * 4},
+        lambda data: b"".join(data["v"]),
+        lambda packed: {"v": [packed[i:i + 40] for i in range(0, 160, 40)]})
+    yield Scenario(
+        "length_field",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("BYTES", name="v",
+                                       length=ezstruct.Field("UINT16"))),
+        {"v": payload},
+        pack_prefixed,
+        unpack_prefixed)
+    yield Scenario(
+        "length_delimiter",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("BYTES", name="v",
+                                       length=ezstruct.Delimiter(b"\0"))),
+        {"v": payload},
+        pack_delimited,
+        unpack_delimited)
+    yield Scenario(
+        "length_callable",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("UINT8", name="n"),
+                        ezstruct.Field("BYTES", name="v",
+                                       length=lambda data: data["n"])),
+        {"n": 40, "v": payload},
+        pack_computed,
+        unpack_computed)
+
+
+def _repeat_scenarios():
+    fixed = struct.Struct(">16L")
+    count = struct.Struct(">B")
+
+    def pack_variable(data):
+        vals = data["v"]
+        return count.pack(len(vals)) + struct.pack(">%dL" % len(vals), *vals)
+
+    def unpack_variable(packed):
+        num = count.unpack_from(packed)[0]
+        return {"v": list(struct.unpack_from(">%dL" % num, packed, 1))}
+
+    yield Scenario(
+        "repeat_fixed",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("UINT32", name="v", repeat=16)),
+        {"v": list(range(16))},
+        lambda data: fixed.pack(*data["v"]),
+        lambda packed: {"v": list(fixed.unpack(packed))})
+    yield Scenario(
+        "repeat_field",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("UINT32", name="v",
+                                       repeat=ezstruct.Field("UINT8"))),
+        {"v": list(range(64))},
+        pack_variable,
+        unpack_variable)
+
+
+def _string_scenarios():
+    prefix = struct.Struct(">B")
+    text = {"ascii": u"hello, world",
+            "latin-1": u"déjà vu",
+            "utf-8": u"über straße ☃",
+            "utf-16-be": u"中文 text"}
+    for encoding, value in sorted(text.items()):
+        def pack(data, encoding=encoding):
+            encoded = data["v"].encode(encoding)
+            return prefix.pack(len(encoded)) + encoded
+
+        def unpack(packed, encoding=encoding):
+            length = prefix.unpack_from(packed)[0]
+            return {"v": packed[1:1 + length].decode(encoding)}
+
+        yield Scenario(
+            "string_%s" % encoding,
+            ezstruct.Struct("NET_ENDIAN",
+                            ezstruct.Field("STRING", name="v",
+                                           string_encoding=encoding,
+                                           length=ezstruct.Field("UINT8"))),
+            {"v": value},
+            pack,
+            unpack)
+
+
+def _transform_scenarios():
+    compiled = struct.Struct(">H")
+    yield Scenario(
+        "transform",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("UINT16", name="v",
+                                       value_transform=ezstruct.FieldTransform(
+                                           lambda val: val * 10,
+                                           lambda val: val // 10))),
+        {"v": 1234},
+        lambda data: compiled.pack(data["v"] * 10),
+        lambda packed: {"v": compiled.unpack(packed)[0] // 10})
+
+    names = ["off", "idle", "busy", "fault"]
+    numbers = dict((name, index) for index, name in enumerate(names))
+    repeated = struct.Struct(">8B")
+    yield Scenario(
+        "transform_enum",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("UINT8", name="v", repeat=8,
+                                       value_transform=ezstruct.EnumTransform(
+                                           names))),
+        {"v": names * 2},
+        lambda data: repeated.pack(*[numbers[val] for val in data["v"]]),
+        lambda packed: {"v": [names[val]
+                              for val in repeated.unpack(packed)]})
+
+
+def _message_scenario():
+    header = struct.Struct(">BHLq")
+    prefix = struct.Struct(">H")
+
+    def pack(data):
+        payload = data["payload"]
+        topic = data["topic"].encode("utf-8")
+        return b"".join([header.pack(data["version"], data["kind"],
+                                     data["id"], data["time"]),
+                         topic, b"\0", prefix.pack(len(payload)), payload])
+
+    def unpack(packed):
+        version, kind, ident, the_time = header.unpack_from(packed)
+        end = packed.index(b"\0", header.size)
+        topic = packed[header.size:end].decode("utf-8")
+        length = prefix.unpack_from(packed, end + 1)[0]
+        start = end + 1 + prefix.size
+        return {"version": version, "kind": kind, "id": ident,
+                "time": the_time, "topic": topic,
+                "payload": packed[start:start + length]}
+
+    return Scenario(
+        "message",
+        ezstruct.Struct("NET_ENDIAN",
+                        ezstruct.Field("UINT8", name="version"),
+                        ezstruct.Field("UINT16", name="kind"),
+                        ezstruct.Field("UINT32", name="id"),
+                        ezstruct.Field("SINT64", name="time"),
+                        ezstruct.Field("STRING", name="topic",
+                                       string_encoding="utf-8",
+                                       length=ezstruct.Delimiter(b"\0")),
+                        ezstruct.Field("BYTES", name="payload",
+                                       length=ezstruct.Field("UINT16"))),
+        {"version": 1, "kind": 7, "id": 123456, "time": -42,
+         "topic": u"sensors/temperature", "payload": b"\x01" * 100},
+        pack,
+        unpack)
+
+
+def scenarios():
+    """Returns every :py:class:`Scenario`."""
+    ret = [_numeric("BOOL", "?", True),
+           _numeric("DOUBLE", "d", 2.5),
+           _numeric("FLOAT", "f", 0.75),
+           _numeric("SINT8", "b", -5),
+           _numeric("SINT16", "h", -500),
+           _numeric("SINT32", "l", -50000),
+           _numeric("SINT64", "q", -5000000000),
+           _numeric("UINT8", "B", 5),
+           _numeric("UINT16", "H", 500),
+           _numeric("UINT32", "L", 50000),
+           _numeric("UINT64", "Q", 5000000000)]
+    ret.extend(_bytes_scenarios())
+    ret.extend(_repeat_scenarios())
+    ret.extend(_string_scenarios())
+    ret.extend(_transform_scenarios())
+    ret.append(_message_scenario())
+    return ret
+
+
+def _time(func, arg, repeat, min_time):
+    """Returns the fastest time per call of ``func(arg)``, in nanoseconds."""
+    timer = timeit.default_timer
+    number = 1
+    while True:
+        start = timer()
+        for _ in range(number):
+            func(arg)
+        elapsed = timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = timer()
+        for _ in range(number):
+            func(arg)
+        best = min(best, timer() - start)
+    return best * 1e9 / number
+
+
+def run(scenario, repeat, min_time):
+    """Times one scenario.
+
+    Returns:
+      A dict mapping each operation to a dict of its timings.
+    """
+    compiled = ezstruct.Struct(str(scenario.struct.byte_order),
+                               *scenario.struct.fields, codegen=True)
+    baseline_pack = _time(scenario.baseline_pack, scenario.record,
+                          repeat, min_time)
+    baseline_unpack = _time(scenario.baseline_unpack, scenario.packed,
+                            repeat, min_time)
+    ops = (("pack", scenario.struct.pack_bytes, scenario.record,
+            baseline_pack),
+           ("unpack", scenario.struct.unpack_bytes, scenario.packed,
+            baseline_unpack),
+           ("pack_codegen", compiled.pack_bytes, scenario.record,
+            baseline_pack),
+           ("unpack_codegen", compiled.unpack_bytes, scenario.packed,
+            baseline_unpack))
+    results = {}
+    for op_name, func, arg, baseline in ops:
+        ns_per_record = _time(func, arg, repeat, min_time)
+        results[op_name] = {
+            "ns_per_record": ns_per_record,
+            "records_per_sec": 1e9 / ns_per_record,
+            "mb_per_sec": len(scenario.packed) * 1e3 / ns_per_record,
+            "baseline_ns_per_record": baseline,
+            "vs_baseline": ns_per_record / baseline}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns ``(scenario, op, old ratio, new ratio)`` for each regression."""
+    regressions = []
+    for name, ops in sorted(results.items()):
+        for op_name, result in sorted(ops.items()):
+            try:
+                old = baseline[name][op_name]["vs_baseline"]
+            except KeyError:
+                continue
+            new = result["vs_baseline"]
+            if new > old * (1 + threshold):
+                regressions.append((name, op_name, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="compare with results saved by --output")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown relative to the baseline, as a "
+                        "fraction, counted as a regression (default 0.10)")
+    parser.add_argument("--filter", default="",
+                        help="only run scenarios whose names contain this")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing runs per measurement (default 5)")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="seconds per timing run (default 0.05)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print("%-18s %-15s %12s %12s %8s" % ("scenario", "op", "ns/record",
+                                         "records/s", "vs struct"))
+    for scenario in scenarios():
+        if args.filter not in scenario.name:
+            continue
+        scenario.check()
+        results[scenario.name] = run(scenario, args.repeat, args.min_time)
+        for op_name, result in sorted(results[scenario.name].items()):
+            print("%-18s %-15s %12.0f %12.0f %7.2fx" % (
+                scenario.name, op_name, result["ns_per_record"],
+                result["records_per_sec"], result["vs_baseline"]))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"python": platform.python_version(),
+                       "implementation": platform.python_implementation(),
+                       "ezstruct": ezstruct.__version__,
+                       "results": results},
+                      output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)["results"],
+                                  args.threshold)
+        for name, op_name, old, new in regressions:
+            print("REGRESSION %s %s: %.2fx -> %.2fx struct time" % (
+                name, op_name, old, new))
+        if regressions:
+            return 1
+        print("No regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
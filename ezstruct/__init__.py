@@ -6,12 +6,20 @@ __license__ = "Apache License v2.0"
 __vcs_id__ = "$Revision$"
 __version__ = "0.1.0"
 
+from . import decoder
 from . import delimiter
 from . import field
 from . import field_transform
+from . import record
+from . import record_file
+from . import schema
 from . import struct
 
+Decoder = decoder.Decoder
 Delimiter = delimiter.Delimiter
+EnumTransform = field_transform.EnumTransform
 Field = field.Field
 FieldTransform = field_transform.FieldTransform
+RecordFile = record_file.RecordFile
+load_schema = schema.load_schema
 Struct = struct.Struct
@@ -0,0 +1,48 @@
+"""Packing to and unpacking from :py:mod:`asyncio` streams."""
+from __future__ import absolute_import
+
+
+async def unpack(ezs, reader):
+    """Unpacks one structure from an ``asyncio.StreamReader``.
+
+    See :py:meth:`ezstruct.Struct.unpack_async`.
+    """
+    ret = {}
+    readexactly = reader.readexactly
+    for step in ezs._get_plan():  # pylint: disable=protected-access
+        size = step.size
+        if size is not None:
+            # Fixed-size steps, such as runs of fields, are read with a
+            # single call, and unpacked in place.
+            step.unpack_from(await readexactly(size), 0, ret)
+            continue
+        unpack_async = getattr(step, "unpack_async", None)
+        if unpack_async is not None:
+            await unpack_async(reader, ret)
+            continue
+        requests = step.unpack_requests(ret)
+        send = requests.send
+        try:
+            size, delim = next(requests)
+            while True:
+                if delim is None:
+                    data = await readexactly(size)
+                else:
+                    data = await reader.readuntil(delim)
+                size, delim = send(data)
+        except StopIteration:
+            pass
+    return ret
+
+
+async def pack(ezs, writer, records):
+    """Writes packed structures to an ``asyncio.StreamWriter``.
+
+    See :py:meth:`ezstruct.Struct.pack_to_transport`.
+    """
+    out = []
+    for data in records:
+        out.extend(ezs._pack_chunks(data))  # pylint: disable=protected-access
+    writer.writelines(out)
+    await writer.drain()
+    return sum(len(chunk) for chunk in out)
@@ -0,0 +1,431 @@
+"""Generated, straight-line pack and unpack functions for structures.
+
+:py:func:`compile_struct` turns a structure's plan into Python source
+with one block per field, no loop over the fields and no dispatch on
+their ``repeat`` or ``length``, and runs it through ``exec``.
+
+Compiling the source is most of the cost of generating code, so the
+compiled code can also be kept in a directory, as ``.pyc`` files are,
+and loaded from there by later processes.
+"""
+from __future__ import absolute_import
+
+from . import delimiter
+from . import errors
+from . import field
+from . import plan
+
+import hashlib
+import linecache
+import marshal
+import os
+import tempfile
+import types
+import weakref
+from importlib.util import MAGIC_NUMBER as _MAGIC
+
+
+class CompiledStruct(object):
+    """Specialized pack and unpack functions for one structure layout.
+
+    Attributes:
+      ``source``: The generated Python source, for debugging.
+
+      ``pack``:
+        ``pack(data)`` returns the packed ``bytes`` for ``data``.
+
+      ``unpack``:
+        ``unpack(buf)`` unpacks one structure from the :py:mod:`io`
+        buffer ``buf`` and returns a dict.
+
+      ``unpack_from``:
+        ``unpack_from(buffer, offset)`` unpacks one structure from
+        ``buffer`` at ``offset``, and returns a tuple of the dict and
+        the offset just past the structure.
+
+    Args:
+      ``order``: The ``ByteOrder`` of the structure.
+      ``fields``: The structure's fields.
+      ``cache_dir``: Where to keep compiled code, if anywhere.
+    """
+
+    def __init__(self, order, fields, cache_dir=None):
+        gen = _Generator(order, plan.compile_plan(order, fields))
+        self.source = gen.source
+        digest = hashlib.sha256(_MAGIC + self.source.encode("utf-8")).hexdigest()
+        filename = "<ezstruct-codegen-%s>" % digest[:16]
+        namespace = dict(gen.constants)
+        if cache_dir is None:
+            code = compile(self.source, filename, "exec")
+        else:
+            code = _cached_code(self.source, filename, cache_dir, digest)
+        exec(code, namespace)
+        # Lets tracebacks and debuggers show the generated source.
+        linecache.cache[filename] = (len(self.source),
+                                     None,
+                                     self.source.splitlines(True),
+                                     filename)
+        self.pack = namespace["pack"]
+        self.unpack = namespace["unpack"]
+        self.unpack_from = namespace["unpack_from"]
+
+
+def _cached_code(source, filename, cache_dir, digest):
+    """Compiles ``source``, or loads it from ``cache_dir`` if it's there.
+
+    The file is named for ``digest``, a hash of the source and of the
+    interpreter's bytecode version.  Files which can't be read or
+    written are ignored, and the source is compiled as usual.
+    """
+    path = os.path.join(cache_dir, digest + ".ezc")
+    try:
+        with open(path, "rb") as cached:
+            code = marshal.loads(cached.read())
+        if isinstance(code, types.CodeType):
+            return code
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+
+    code = compile(source, filename, "exec")
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Written under another name, then renamed, so that other
+        # processes never see a partial file.
+        handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        try:
+            with os.fdopen(handle, "wb") as temp:
+                temp.write(marshal.dumps(code))
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            os.remove(temp_path)
+            raise
+    except (IOError, OSError):
+        pass
+    return code
+
+
+# Maps schema keys to the CompiledStruct of each structure layout in use.
+# Entries go away with the last structure using them, along with
+# anything their keys refer to, such as length functions.
+_COMPILED = weakref.WeakValueDictionary()
+
+
+def compile_struct(ezs, cache_dir=None):
+    """Returns the :py:class:`CompiledStruct` for an ``ezstruct.Struct``.
+
+    Structures with the same :py:meth:`ezstruct.Struct.schema_key`
+    share a single ``CompiledStruct``, for as long as any of them
+    refers to it.  Structures whose keys can't be hashed, because of a
+    length function or transform, each get their own.  If one has to be made, its code
+    is kept in, or loaded from, ``cache_dir``.
+    """
+    key = ezs.schema_key()
+    try:
+        compiled = _COMPILED.get(key)
+    except TypeError:
+        return CompiledStruct(ezs.byte_order, ezs.fields, cache_dir)
+    if compiled is None:
+        compiled = _COMPILED[key] = CompiledStruct(ezs.byte_order, ezs.fields,
+                                                   cache_dir)
+    return compiled
+
+
+def _specialized_run(step):
+    """Is ``step`` a :py:class:`plan._FixedRun` that gets generated code?
+
+    Runs with nested structures or bitfields folded in are called like
+    other steps.  Element-wise value transforms are applied inline.
+    """
+    return (isinstance(step, plan._FixedRun) and  # pylint: disable=protected-access
+            not step.nested)
+
+
+class _Generator(object):
+    """Produces the source for a plan's ``pack`` and ``unpack`` functions."""
+
+    def __init__(self, order, steps):
+        self._order = order
+        self._var_count = 0
+        self.constants = {"InconsistentLength": errors.InconsistentLength,
+                          "read_delimited": plan.read_delimited,
+                          "short_read": field.short_read,
+                          "take": plan.take,
+                          "take_delimited": plan.take_delimited}
+        self._from_buffer = False
+        self._lines = []
+        self._gen_pack(steps)
+        self._lines.append("")
+        self._gen_unpack(steps, False)
+        self._lines.append("")
+        self._gen_unpack(steps, True)
+        self.source = "\n".join(self._lines) + "\n"
+
+    def _const(self, prefix, val):
+        name = "%s%d" % (prefix, len(self.constants))
+        self.constants[name] = val
+        return name
+
+    def _emit(self, indent, line):
+        self._lines.append("    " * indent + line)
+
+    def _getter(self, the_field):
+        default = self._const("default", the_field.get_values_for_pack({}))
+        if the_field.name:
+            return "get(%r, %s)" % (the_field.name, default)
+        return default
+
+    def _gen_pack(self, steps):
+        self._emit(0, "def pack(data):")
+        self._emit(1, "get = data.get")
+        if _specialized_run(plan.single_run(steps)):
+            self._emit(1, "return %s" % self._pack_run(steps[0]))
+            return
+
+        self._emit(1, "out = []")
+        for step in steps:
+            if _specialized_run(step):
+                self._emit(1, "out.append(%s)" % self._pack_run(step))
+            elif isinstance(step, plan._FieldStep):  # pylint: disable=protected-access
+                self._pack_field(step.field)
+            else:
+                # Steps without specialized code are called directly.
+                self._emit(1, "%s.pack(data, out)" % self._const("step", step))
+        self._emit(1, "return b''.join(out)")
+
+    def _pack_run(self, run):
+        """Emits value checks, and returns the expression packing ``run``."""
+        segments = []
+        for the_field in run.fields:
+            var = "v%d" % self._var_count
+            self._var_count += 1
+            self._emit(1, "%s = %s" % (var, self._getter(the_field)))
+            if the_field.value_transform is not None:
+                self._emit(1, self._apply_transform(the_field, var, "pack"))
+            length = None
+            if the_field.type.variable_length:
+                length = the_field.length
+            if the_field.repeat == 1:
+                if length is not None:
+                    self._emit(1, "assert len(%s) == %d" % (var, length))
+                if segments and isinstance(segments[-1], list):
+                    segments[-1].append(var)
+                else:
+                    segments.append([var])
+            else:
+                self._emit(1, "assert len(%s) == %d" % (var, the_field.repeat))
+                if length is not None:
+                    self._emit(1, "assert all(len(elt) == %d for elt in %s)" %
+                               (length, var))
+                segments.append(var)
+
+        compiled = self._const("run", run.struct)
+        if len(segments) == 1 and isinstance(segments[0], list):
+            return "%s.pack(%s)" % (compiled, ", ".join(segments[0]))
+        args = []
+        for segment in segments:
+            if isinstance(segment, list):
+                args.append("(%s,)" % ", ".join(segment))
+            else:
+                args.append("tuple(%s)" % segment)
+        return "%s.pack(*(%s))" % (compiled, " + ".join(args))
+
+    def _pack_field(self, the_field):
+        var = "val" if the_field.repeat == 1 else "vals"
+        self._emit(1, "%s = %s" % (var, self._getter(the_field)))
+        value_transform = plan.value_transform(the_field)
+        if value_transform is not None:
+            transform = self._const("transform", value_transform)
+            self._emit(1, "%s = %s.pack(%s)" % (var, transform, var))
+
+        if the_field.repeat == 1:
+            self._pack_value(1, the_field)
+            return
+
+        if isinstance(the_field.repeat, field.Field):
+            count = self._const("count", the_field.repeat.get_struct(self._order))
+            self._emit(1, "out.append(%s.pack(len(vals)))" % count)
+        else:
+            self._emit(1, "assert len(vals) == %d" % the_field.repeat)
+        self._emit(1, "for val in vals:")
+        self._pack_value(2, the_field)
+
+    def _pack_value(self, indent, the_field):
+        """Emits code packing the single value ``val``."""
+        if not the_field.type.variable_length:
+            compiled = self._const("value", the_field.get_struct(self._order))
+            self._emit(indent, "out.append(%s.pack(val))" % compiled)
+            return
+
+        length = the_field.length
+        computed = not isinstance(
+            length, (type(None), int, delimiter.Delimiter, field.Field))
+        if isinstance(length, int):
+            self._emit(indent, "assert len(val) == %d" % length)
+        elif computed:
+            self._emit(indent, "fn_len = %s(data)" %
+                       self._const("length_fn", length))
+            self._emit(indent, "if fn_len != len(val):")
+            self._emit(indent + 1, "raise InconsistentLength(%s, fn_len, len(val))" %
+                       self._const("field", the_field))
+
+        if the_field.string_encoding:
+            self._emit(indent, "val = %s(val)" %
+                       self._const("encode", the_field.encoder))
+        if isinstance(length, field.Field):
+            prefix = self._const("length", length.get_struct(self._order))
+            self._emit(indent, "out.append(%s.pack(len(val)))" % prefix)
+        self._emit(indent, "out.append(val)")
+        if isinstance(length, delimiter.Delimiter):
+            self._emit(indent, "out.append(%s)" %
+                       self._const("delimiter", length.delimiter))
+
+    def _gen_unpack(self, steps, from_buffer):
+        """Emits ``unpack(buf)``, or ``unpack_from(buffer, offset)``."""
+        self._from_buffer = from_buffer
+        if from_buffer:
+            self._emit(0, "def unpack_from(buffer, offset):")
+            self._emit(1, "limit = len(buffer)")
+        else:
+            self._emit(0, "def unpack(buf):")
+            self._emit(1, "read = buf.read")
+
+        if _specialized_run(plan.single_run(steps)):
+            self._unpack_run(steps[0])
+            ret = "{%s}" % ", ".join("%r: %s" % member
+                                     for member in self._run_members(steps[0]))
+        else:
+            self._emit(1, "ret = {}")
+            for step in steps:
+                if _specialized_run(step):
+                    self._unpack_run(step)
+                    for name, expr in self._run_members(step):
+                        self._emit(1, "ret[%r] = %s" % (name, expr))
+                elif isinstance(step, plan._FieldStep):  # pylint: disable=protected-access
+                    self._unpack_field(step.field)
+                elif from_buffer:
+                    self._emit(1, "offset = %s.unpack_from(buffer, offset, ret)" %
+                               self._const("step", step))
+                else:
+                    self._emit(1, "%s.unpack(buf, ret)" % self._const("step", step))
+            ret = "ret"
+
+        if from_buffer:
+            self._emit(1, "return %s, offset" % ret)
+        else:
+            self._emit(1, "return %s" % ret)
+
+    def _read_fixed(self, indent, target, compiled):
+        """Emits code unpacking the ``struct.Struct`` ``compiled``.
+
+        If ``target`` is ``None``, the unpacked tuple is assigned to
+        ``vals``; otherwise, its only value is assigned to ``target``.
+        """
+        name = self._const("struct", compiled)
+        if target is None:
+            target, index = "vals", ""
+        else:
+            index = "[0]"
+        if self._from_buffer:
+            self._emit(indent, "if offset + %d > limit:" % compiled.size)
+            self._emit(indent + 1, "short_read(%d)" % compiled.size)
+            self._emit(indent, "%s = %s.unpack_from(buffer, offset)%s" %
+                       (target, name, index))
+            self._emit(indent, "offset += %d" % compiled.size)
+        else:
+            self._emit(indent, "%s = %s.unpack(read(%d))%s" %
+                       (target, name, compiled.size, index))
+
+    def _read_bytes(self, indent):
+        """Emits code reading ``size`` bytes into ``val``."""
+        if self._from_buffer:
+            self._emit(indent, "val = take(buffer, offset, size)")
+            self._emit(indent, "offset += size")
+        else:
+            self._emit(indent, "val = read(size)")
+            self._emit(indent, "if len(val) != size:")
+            self._emit(indent + 1, "short_read(size)")
+
+    def _unpack_run(self, run):
+        self._read_fixed(1, None, run.struct)
+
+    def _apply_transform(self, the_field, var, direction):
+        """Returns a statement applying an element-wise transform to ``var``."""
+        transform = self._const(
+            direction, getattr(the_field.value_transform, direction))
+        if the_field.repeat == 1:
+            return "%s = %s(%s)" % (var, transform, var)
+        return "%s = list(map(%s, %s))" % (var, transform, var)
+
+    def _run_members(self, run):
+        """Yields ``(name, expression)`` for each named field of ``run``."""
+        index = 0
+        for the_field in run.fields:
+            if the_field.name:
+                transform = None
+                if the_field.value_transform is not None:
+                    transform = self._const(
+                        "unpack", the_field.value_transform.unpack)
+                if the_field.repeat == 1:
+                    expr = "vals[%d]" % index
+                    if transform is not None:
+                        expr = "%s(%s)" % (transform, expr)
+                elif transform is not None:
+                    expr = "list(map(%s, vals[%d:%d]))" % (
+                        transform, index, index + the_field.repeat)
+                else:
+                    expr = "list(vals[%d:%d])" % (index,
+                                                  index + the_field.repeat)
+                yield the_field.name, expr
+            index += the_field.repeat
+
+    def _unpack_field(self, the_field):
+        var = "vals"
+        if the_field.repeat == 1:
+            self._unpack_value(1, the_field)
+            var = "val"
+        else:
+            if isinstance(the_field.repeat, field.Field):
+                self._read_fixed(1, "count",
+                                 the_field.repeat.get_struct(self._order))
+            else:
+                self._emit(1, "count = %d" % the_field.repeat)
+            self._emit(1, "vals = []")
+            self._emit(1, "for _ in range(count):")
+            self._unpack_value(2, the_field)
+            self._emit(2, "vals.append(val)")
+
+        value_transform = plan.value_transform(the_field)
+        if value_transform is not None:
+            transform = self._const("transform", value_transform)
+            self._emit(1, "%s = %s.unpack(%s)" % (var, transform, var))
+        if the_field.name:
+            self._emit(1, "ret[%r] = %s" % (the_field.name, var))
+
+    def _unpack_value(self, indent, the_field):
+        """Emits code unpacking a single value into ``val``."""
+        if not the_field.type.variable_length:
+            self._read_fixed(indent, "val", the_field.get_struct(self._order))
+            return
+
+        length = the_field.length
+        if isinstance(length, delimiter.Delimiter):
+            delim = self._const("delimiter", length.delimiter)
+            if self._from_buffer:
+                self._emit(indent, "val, offset = take_delimited(buffer, offset, %s)" %
+                           delim)
+            else:
+                self._emit(indent, "val = read_delimited(buf, %s)" % delim)
+        else:
+            if isinstance(length, field.Field):
+                self._read_fixed(indent, "size", length.get_struct(self._order))
+            elif isinstance(length, int) or length is None:
+                self._emit(indent, "size = %d" % (length or 1))
+            else:
+                self._emit(indent, "size = %s(ret)" %
+                           self._const("length_fn", length))
+            self._read_bytes(indent)
+
+        if the_field.string_encoding:
+            self._emit(indent, "val = %s(val)" %
+                       self._const("decode", the_field.decoder))
@@ -0,0 +1,101 @@
+"""A cache of whole unpacked structures, keyed by their packed bytes.
+
+See :py:meth:`ezstruct.Struct.enable_decode_cache`.
+"""
+from __future__ import absolute_import
+
+import collections
+import sys
+import threading
+
+
+def _approximate_size(key, ret):
+    """Roughly how many bytes an entry keeps alive.
+
+    This counts the key, the record and its values, but not anything
+    the values refer to, such as the elements of a repeated field.
+    """
+    return (sys.getsizeof(key) + sys.getsizeof(ret) +
+            sum(sys.getsizeof(ret[name]) for name in ret.keys()))
+
+
+class DecodeCache(object):
+    """Unpacks structures, keeping the most recently used results.
+
+    Results are frozen records, so they can be shared between callers.
+    Entries are evicted, least recently used first, when there are more
+    than ``max_entries`` of them, or when their approximate size adds up
+    to more than ``max_bytes``.  It's safe to use from several threads.
+
+    Args:
+      ``ezs``: The :py:class:`ezstruct.Struct`.
+      ``max_entries``: The most results to keep.
+      ``max_bytes``: The most memory, approximately, for them to take up.
+    """
+
+    def __init__(self, ezs, max_entries, max_bytes):
+        assert isinstance(max_entries, int) and max_entries > 0
+        assert isinstance(max_bytes, int) and max_bytes > 0
+        self._struct = ezs
+        self._record_class = ezs.frozen_record_class()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Maps the packed bytes to (record, approximate size).
+        self._entries = collections.OrderedDict()
+        self.clear()
+
+    def clear(self):
+        """Drops every result, and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = self.uncached = 0
+
+    def info(self):
+        """The cache's counters, as a dict.
+
+        ``uncached`` counts results too large to keep within
+        ``max_bytes``.  ``hit_rate`` is the fraction of lookups which
+        were hits, or ``None`` before the first one.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "uncached": self.uncached,
+                    "entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "hit_rate": (float(self.hits) / lookups if lookups
+                                 else None)}
+
+    def unpack_bytes(self, the_bytes):
+        """Like :py:meth:`ezstruct.Struct.unpack_bytes`, returning a frozen record."""
+        if not isinstance(the_bytes, bytes):
+            the_bytes = bytes(the_bytes)
+        with self._lock:
+            entries = self._entries
+            entry = entries.pop(the_bytes, None)
+            if entry is not None:
+                # Reinserting marks the entry as most recently used.
+                entries[the_bytes] = entry
+                self.hits += 1
+                return entry[0]
+
+        ret = self._record_class(**self._struct.unpack_from(the_bytes)[0])
+        size = _approximate_size(the_bytes, ret)
+        with self._lock:
+            entries = self._entries
+            self.misses += 1
+            if size > self._max_bytes:
+                self.uncached += 1
+            elif the_bytes not in entries:
+                entries[the_bytes] = (ret, size)
+                self._bytes += size
+                while (len(entries) > self._max_entries or
+                       self._bytes > self._max_bytes):
+                    _, (_, evicted_size) = entries.popitem(last=False)
+                    self._bytes -= evicted_size
+                    self.evictions += 1
+        return ret
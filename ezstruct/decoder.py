@@ -0,0 +1,213 @@
+"""Incremental decoding of structures from data that arrives piecemeal."""
+from __future__ import absolute_import
+
+from . import errors
+
+import collections
+import struct
+
+
+# Consumed bytes are only discarded from the front of the buffer once
+# they make up at least this much of it, and this many bytes.
+_COMPACT_FRACTION = 2
+_COMPACT_MINIMUM = 4096
+
+
+class Decoder(object):
+    """Unpacks consecutive structures from data fed to it in fragments.
+
+    This doesn't do any I/O itself, so it suits sockets, where a
+    structure can be split across several reads.  Fields are decoded as
+    soon as enough data for them has arrived.  When a field is split
+    across feeds, its decoding is suspended where the data ran out, and
+    resumed once enough more has arrived, so nothing is decoded twice.
+
+    Iterating over a ``Decoder`` yields, and removes, each structure
+    that has been completely received::
+
+      decoder = ezstruct.Decoder(message)
+      while True:
+          data = sock.recv(65536)
+          if not data:
+              break
+          decoder.feed(data)
+          for record in decoder:
+              handle(record)
+      decoder.close()
+
+    Args:
+      ``ezs``: The :py:class:`ezstruct.Struct` to unpack.
+    """
+
+    def __init__(self, ezs):
+        self._struct = ezs
+        self._steps = ezs._get_plan()  # pylint: disable=protected-access
+        self._buffer = bytearray()
+        # Offset in the buffer of the structure being decoded.
+        self._start = 0
+        # Offset in the buffer of the next step to run, and its index.
+        self._offset = 0
+        self._step = 0
+        # Data unpacked so far for the structure being decoded.
+        self._partial = {}
+        # The suspended unpack_requests generator of a variable-size
+        # step, and the (size, delimiter) it's waiting for.
+        self._requests = None
+        self._request = None
+        # Where to resume searching for a requested delimiter.
+        self._scan = 0
+        # The buffer size needed before decoding can continue.
+        self._needed = 0
+        self._records = collections.deque()
+        self._count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._records:
+            raise StopIteration
+        return self._records.popleft()
+
+    next = __next__
+
+    @property
+    def pending(self):
+        """The number of bytes received but not yet part of a structure."""
+        return len(self._buffer) - self._start
+
+    def feed(self, data):
+        """Adds received bytes, and decodes any structures they complete.
+
+        Args:
+          ``data``: A ``bytes``-like object.
+        """
+        self._buffer += data
+        if len(self._buffer) >= self._needed:
+            self._decode()
+
+    def close(self):
+        """Signals the end of the input.
+
+        Raises:
+          :py:class:`ezstruct.errors.TruncatedRecord` if the input ended
+          partway through a structure.
+        """
+        if self.pending:
+            raise errors.TruncatedRecord(self._count)
+
+    def _decode(self):
+        steps = self._steps
+        buffer = self._buffer
+        limit = len(buffer)
+        index = self._step
+        offset = self._offset
+        partial = self._partial
+        while self._requests is not None or self._start < limit:
+            while index < len(steps):
+                step = steps[index]
+                size = step.size
+                if self._requests is None and size is not None:
+                    # Fixed-size steps are unpacked in place once all of
+                    # their data has arrived.
+                    if offset + size > limit:
+                        self._needed = offset + size
+                        break
+                    offset = step.unpack_from(buffer, offset, partial)
+                else:
+                    self._offset = offset
+                    finished = self._run_step(step)
+                    offset = self._offset
+                    if not finished:
+                        break
+                index += 1
+            else:
+                self._records.append(partial)
+                self._count += 1
+                partial = self._partial = {}
+                index = 0
+                self._start = offset
+                continue
+            break
+        self._step = index
+        self._offset = offset
+        self._compact()
+
+    def _run_step(self, step):
+        """Runs, or resumes, a variable-size step, as far as the data allows.
+
+        The step is unpacked in place if all of its data has arrived,
+        which is checked with ``skip_from``, since that only reads length
+        and count prefixes.  Otherwise, it's driven through its
+        ``unpack_requests`` generator, which is kept, suspended, while it
+        waits for more data.
+
+        Returns:
+          Whether the step finished.
+        """
+        buffer = self._buffer
+        offset = self._offset
+        requests = self._requests
+        if requests is None:
+            try:
+                end = step.skip_from(buffer, offset, self._partial)
+            except (struct.error, errors.DelimiterNotFound):
+                end = None
+            if end is not None and end <= len(buffer):
+                self._offset = step.unpack_from(buffer, offset, self._partial)
+                return True
+            requests = step.unpack_requests(self._partial)
+            request = next(requests, None)
+            scan = offset
+        else:
+            request = self._request
+            scan = self._scan
+
+        while request is not None:
+            size, delim = request
+            if size is not None:
+                end = offset + size
+                if end > len(buffer):
+                    self._needed = end
+                    break
+            else:
+                found = buffer.find(delim, scan)
+                if found < 0:
+                    # The delimiter may start in the data already
+                    # searched, but only in its last len(delim) - 1 bytes.
+                    scan = max(offset, len(buffer) - len(delim) + 1)
+                    self._needed = len(buffer) + 1
+                    break
+                end = found + len(delim)
+            data = bytes(buffer[offset:end])
+            offset = scan = end
+            try:
+                request = requests.send(data)
+            except StopIteration:
+                request = None
+        else:
+            self._offset = offset
+            self._requests = None
+            return True
+
+        self._offset = offset
+        self._requests = requests
+        self._request = request
+        self._scan = scan
+        return False
+
+    def _compact(self):
+        """Discards consumed bytes, if enough of them have built up.
+
+        Each byte is moved at most a constant number of times on
+        average, so this is amortized O(1) per byte received.
+        """
+        start = self._start
+        if start == len(self._buffer) or (
+                start >= _COMPACT_MINIMUM and
+                start * _COMPACT_FRACTION >= len(self._buffer)):
+            del self._buffer[:start]
+            self._start = 0
+            self._offset -= start
+            self._scan = max(0, self._scan - start)
+            self._needed = max(0, self._needed - start)
@@ -3,15 +3,16 @@
 class Delimiter(object):
     """A fixed-value boundary marker denoting the end of a string.
 
-    Common delimiters include ``b"\x00"``, ``b","``, and ``b"\\n"`` .
+    Common delimiters include ``b"\x00"``, ``b","``, ``b"\\n"`` and
+    ``b"\\r\\n"``.
 
     Args:
-      ``delimiter``: The delimiter.  A ``bytes`` of length 1.
+      ``delimiter``: The delimiter.  A non-empty ``bytes``.
     """
 
     def __init__(self, delimiter):
         assert isinstance(delimiter, bytes)
-        assert len(delimiter) == 1
+        assert len(delimiter) >= 1
         self._delimiter = delimiter
 
     @property
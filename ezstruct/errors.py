@@ -28,3 +28,49 @@ class InconsistentLength(EzStructError):
                 "length function returned %d." % (self.field.name,
                                                   self.val_len,
                                                   self.fn_len))
+
+
+class VariableLength(EzStructError):
+    """A fixed packed length was needed, but the structure's can vary."""
+    def __init__(self, ezs):
+        EzStructError.__init__(self)
+        self.struct = ezs
+
+    def __str__(self):
+        return "%s does not have a fixed length." % self.struct
+
+
+class TruncatedRecord(EzStructError):
+    """The input ended partway through a structure.
+
+    ``index`` is the number of complete structures which preceded it.
+    """
+    def __init__(self, index):
+        EzStructError.__init__(self)
+        self.index = index
+
+    def __str__(self):
+        return "Input ended partway through record %d." % self.index
+
+
+class IncompatibleField(EzStructError):
+    """A field can't be represented in some other format."""
+    def __init__(self, field, target):
+        EzStructError.__init__(self)
+        self.field = field
+        self.target = target
+
+    def __str__(self):
+        return "Field %s can't be represented in %s." % (self.field,
+                                                         self.target)
+
+
+class SchemaError(EzStructError):
+    """A declarative schema given to :py:func:`ezstruct.load_schema` is invalid."""
+    def __init__(self, where, problem):
+        EzStructError.__init__(self)
+        self.where = where
+        self.problem = problem
+
+    def __str__(self):
+        return "Invalid schema at %s: %s." % (self.where, self.problem)
@@ -2,19 +2,64 @@
 from __future__ import absolute_import
 
 from . import delimiter
+from . import errors
 from . import field_transform
 from . import field_type
 
 import codecs
-import collections
-import six
+import operator
 import struct
+from collections import abc as collections_abc
 
 
-if six.PY2:  # pragma: no cover
-    _StringClass = unicode  # pylint: disable=undefined-variable, invalid-name
-else:
-    _StringClass = str
+# Encodings, by their normalized names, which ``bytes.decode`` and
+# ``str.encode`` handle directly rather than through a codec lookup.
+_BUILTIN_ENCODINGS = frozenset(("ascii", "iso8859-1", "utf-8"))
+
+# The number of distinct strings kept by ``intern_strings=True``.
+_INTERN_LIMIT = 1024
+
+
+def _make_codec(encoding, errors, intern_limit):
+    """Builds the functions which encode and decode a string field's values.
+
+    The codec is looked up once, here, rather than for every value.
+    """
+    info = codecs.lookup(encoding)
+    if info.name in _BUILTIN_ENCODINGS:
+        encode = operator.methodcaller("encode", info.name, errors)
+        decode = operator.methodcaller("decode", info.name, errors)
+    else:
+        codec_encode = info.encode
+        codec_decode = info.decode
+
+        def encode(val):
+            return codec_encode(val, errors)[0]
+
+        def decode(val):
+            return codec_decode(val, errors)[0]
+    if intern_limit:
+        decode = _interning(decode, intern_limit)
+    return encode, decode
+
+
+def _interning(decode, limit):
+    """Wraps ``decode`` so that equal values share one string object.
+
+    Decoded strings are kept, keyed by their encoded bytes, until there
+    are ``limit`` of them; any others are decoded every time.
+    """
+    table = {}
+    lookup = table.get
+
+    def interned(val):
+        ret = lookup(val)
+        if ret is None:
+            ret = decode(val)
+            if len(table) < limit:
+                table[val] = ret
+        return ret
+    return interned
 
 
 class Field(object):  # pylint: disable=too-many-instance-attributes
@@ -22,7 +67,9 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
 
     Args:
       ``ft``:
-        The field type.  See :py:mod:`ezstruct.field_type` for possible values.
+        The field type.  See :py:mod:`ezstruct.field_type` for possible
+        values; this can also be an :py:class:`ezstruct.Struct`, to nest
+        one structure in another.
 
       ``name``:
         The key to use for the field value in the dictionary used to
@@ -52,6 +99,12 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
 
       ``string_encoding_errors_policy``: See :py:mod:`codecs`.
 
+      ``intern_strings``:
+        For string fields with few distinct values, such as host names
+        or labels, ``True`` or a maximum number of strings to keep.
+        Unpacking the same bytes again returns the string kept from the
+        first time, without decoding it.  ``True`` keeps up to 1024.
+
       ``length``:
         For variable-length fields (``"STRING"`` and ``"BYTES"``), the
         length of the field.  This can be:
@@ -73,6 +126,30 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
           unpacked so far.
 
       ``value_transform``: See :py:class:`ezstruct.FieldTransform`.
+
+      ``repeat_container``:
+        For repeated integer and floating-point fields, the type of
+        sequence the values are unpacked into:
+
+        * ``"list"`` (the default), a ``list``; or,
+        * ``"array"``, an ``array.array``.  The values are converted in
+          a single operation when packing and unpacking, and take up
+          much less memory than a list.
+
+      ``bits``:
+        For unsigned integer fields, a list of ``(name, width)`` pairs
+        dividing the integer into groups of bits, from the most
+        significant down.  The field's value is then a dict mapping
+        each name to the ``int`` in its bits; see
+        :py:class:`ezstruct.field_type.Bitfield`.  Names can be
+        ``None`` for unused bits.  For example, the flags of a TCP
+        header::
+
+          ezstruct.Field("UINT16", name="flags",
+                         bits=[("offset", 4), (None, 3), ("ns", 1),
+                               ("cwr", 1), ("ece", 1), ("urg", 1),
+                               ("ack", 1), ("psh", 1), ("rst", 1),
+                               ("syn", 1), ("fin", 1)])
     """
 
     # pylint: disable=too-many-arguments
@@ -83,7 +160,10 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
                  string_encoding=None,
                  string_encoding_errors_policy="strict",
                  length=None,
-                 value_transform=None):
+                 value_transform=None,
+                 repeat_container="list",
+                 bits=None,
+                 intern_strings=False):
         self._type = field_type.get(ft)
 
         assert isinstance(name, (type(None), str))
@@ -98,27 +178,37 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
                 assert repeat > 0
         self._repeat = repeat or 1
 
+        assert repeat_container in ("list", "array")
+        if repeat_container == "array":
+            assert self._type.array_typecode is not None
+            assert self._repeat != 1
+        self._repeat_container = repeat_container
+
         if default_pack_value is not None:
-            if self._repeat > 1:
-                assert isinstance(default_pack_value, collections.Iterable)
+            if self._repeat != 1:
+                assert isinstance(default_pack_value, collections_abc.Iterable)
         self._default_pack_value = default_pack_value
 
-        if self._type.unpacked_type is _StringClass:
+        if intern_strings is True:
+            intern_strings = _INTERN_LIMIT
+        assert isinstance(intern_strings, int) and intern_strings >= 0
+        self._encoder = self._decoder = None
+        if self._type.unpacked_type is str:
             assert string_encoding is not None
             # Raises exception if encoding not found.
-            codecs.lookup(string_encoding)
+            self._encoder, self._decoder = _make_codec(
+                string_encoding, string_encoding_errors_policy, intern_strings)
         else:
             assert string_encoding is None
+            assert not intern_strings
         self._string_encoding = string_encoding
         self._string_encoding_errors_policy = string_encoding_errors_policy
+        self._intern_strings = intern_strings
 
         if length is not None:
             assert self._type.variable_length
-            assert isinstance(length,
-                              (int,
-                               delimiter.Delimiter,
-                               Field,
-                               collections.Callable))
+            assert (isinstance(length, (int, delimiter.Delimiter, Field)) or
+                    callable(length))
             if isinstance(length, int):
                 assert length > 0
             elif isinstance(length, Field):
@@ -129,6 +219,32 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
                           (field_transform.FieldTransform, type(None)))
         self._value_transform = value_transform
 
+        self._bits = None
+        if bits is not None:
+            assert self._type.unpacked_type is int
+            assert self._type.pack_char.isupper(), "Bitfields must be unsigned"
+            assert repeat_container == "list"
+            self._bits = field_type.Bitfield(bits, 8 * self.fixed_size)
+
+        # Precompiled struct.Struct objects, keyed by byte order pack char.
+        self._structs = {}
+
+    def __getstate__(self):
+        # Precompiled structs can't be pickled, and are rebuilt on demand.
+        # Nor can the codec functions, which are rebuilt on unpickling.
+        state = self.__dict__.copy()
+        state["_structs"] = {}
+        state["_encoder"] = state["_decoder"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._string_encoding:
+            self._encoder, self._decoder = _make_codec(
+                self._string_encoding,
+                self._string_encoding_errors_policy,
+                self._intern_strings)
+
     def __str__(self):
         name = ""
         if self.name:
@@ -151,10 +267,104 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
     def repeat(self):  # pylint: disable=missing-docstring
         return self._repeat
 
+    @property
+    def repeat_container(self):  # pylint: disable=missing-docstring
+        return self._repeat_container
+
+    @property
+    def string_encoding(self):  # pylint: disable=missing-docstring
+        return self._string_encoding
+
+    @property
+    def encoder(self):
+        """The function encoding a string field's values, or ``None``."""
+        return self._encoder
+
+    @property
+    def decoder(self):
+        """The function decoding a string field's values, or ``None``."""
+        return self._decoder
+
     @property
     def value_transform(self):  # pylint: disable=missing-docstring
         return self._value_transform
 
+    @property
+    def bits(self):  # pylint: disable=missing-docstring
+        return self._bits
+
+    @property
+    def fixed_size(self):
+        """The packed size of a single value, or ``None`` if it can vary."""
+        nested = self._type.nested_struct
+        if nested is not None:
+            try:
+                return nested.calcsize()
+            except errors.VariableLength:
+                return None
+        if self._type.variable_length and not isinstance(self._length, int):
+            return None
+        return struct.calcsize("=%s" % self.struct_format)
+
+    @property
+    def struct_format(self):
+        """The :py:mod:`struct` format for one value, without a byte order.
+
+        For variable-length fields without a fixed ``int`` length, this
+        describes a single byte.
+        """
+        if self._type.variable_length and isinstance(self._length, int):
+            return "%d%s" % (self._length, self._type.pack_char)
+        return self._type.pack_char
+
+    def get_struct(self, order):
+        """Returns a precompiled :py:class:`struct.Struct` for one value.
+
+        For variable-length fields without a fixed ``int`` length, the
+        returned ``Struct`` describes a single byte.
+
+        Args:
+          ``order``: The ``ByteOrder`` of the enclosing structure.
+        """
+        compiled = self._structs.get(order.pack_char)
+        if compiled is None:
+            compiled = struct.Struct(order.pack_char + self.struct_format)
+            self._structs[order.pack_char] = compiled
+        return compiled
+
+    def encode(self, val):
+        """Applies the field's string encoding, if any, to ``val``."""
+        if self._encoder is not None:
+            return self._encoder(val)
+        return val
+
+    def decode(self, val):
+        """Reverses :py:meth:`encode`."""
+        if self._decoder is not None:
+            return self._decoder(val)
+        return val
+
+    def schema_key(self):
+        """A hashable description of the field's definition.
+
+        Fields with equal keys pack and unpack identically.  Length
+        functions and transforms are compared by identity, or by value
+        if they define equality, in which case the key may not be
+        hashable.
+        """
+        nested = self._type.nested_struct
+        return (str(self._type) if nested is None else nested.schema_key(),
+                self._name,
+                _schema_key(self._repeat),
+                self._repeat_container,
+                repr(self._default_pack_value),
+                self._string_encoding,
+                self._string_encoding_errors_policy,
+                self._intern_strings,
+                _schema_key(self._length),
+                self._value_transform,
+                self._bits.spec if self._bits is not None else None)
+
     def get_values_for_pack(self, data):
         """Retrieves the value to pack for this field from the unpacked form."""
         if self.name:
@@ -170,18 +380,11 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
           ``val``: The value to serialize.
           ``buf``: The :py:mod:`io` buffer to write the serialized data to.
         """
-        if self._string_encoding:
-            val = codecs.encode(val,
-                                self._string_encoding,
-                                self._string_encoding_errors_policy)
-
+        val = self.encode(val)
         if self._type.variable_length:
-            fmt = "%s%d%s" % (byte_order.pack_char,
-                              len(val),
-                              self._type.pack_char)
+            buf.write(val)
         else:
-            fmt = "%s%s" % (byte_order.pack_char, self._type.pack_char)
-        buf.write(struct.pack(fmt, val))
+            buf.write(self.get_struct(byte_order).pack(val))
 
     def unpack(self, byte_order, buf, length=None):
         """Deserialize the field.
@@ -201,17 +404,31 @@ class Field(object):  # pylint: disable=too-many-instance-attributes
         """
 
         if length is None:
-            fmt = "%s%s" % (byte_order.pack_char, self._type.pack_char)
-            length = struct.calcsize(fmt)
-        else:
-            fmt = "%s%d%s" % (byte_order.pack_char,
-                              length,
-                              self._type.pack_char)
+            compiled = self.get_struct(byte_order)
+            return self.decode(compiled.unpack(buf.read(compiled.size))[0])
+        return self.decode(read_exactly(buf, length))
 
-        data = buf.read(length)
-        ret = struct.unpack(fmt, data)[0]
-        if self._string_encoding:
-            ret = codecs.decode(ret,
-                                self._string_encoding,
-                                self._string_encoding_errors_policy)
-        return ret
+
+def _schema_key(val):
+    if isinstance(val, Field):
+        return val.schema_key()
+    elif isinstance(val, delimiter.Delimiter):
+        return ("Delimiter", val.delimiter)
+    return val
+
+
+def read_exactly(buf, length):
+    """Reads exactly ``length`` bytes from the :py:mod:`io` buffer ``buf``.
+
+    Raises:
+      :py:class:`struct.error` if the buffer ends first.
+    """
+    data = buf.read(length)
+    if len(data) != length:
+        short_read(length)
+    return data
+
+
+def short_read(length):
+    """Reports that fewer than ``length`` bytes of input were available."""
+    raise struct.error("unpack requires a buffer of %d bytes" % length)
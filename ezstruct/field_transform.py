@@ -3,7 +3,11 @@ Transforms to apply to a field's values.
 """
 
 from __future__ import absolute_import
+
 import collections
+import copy
+import threading
+from collections import abc as collections_abc
 
 
 class FieldTransform(object):
@@ -41,10 +45,173 @@ class FieldTransform(object):
       ``unpack_fn``:
         A callable to invoke just before setting the value in the
         unpack dict, after doing e.g. string decoding.
+
+      ``element_wise``:
+        If true, the functions are passed each value of a repeated
+        field in turn, rather than the list of them.  Fixed-size fields
+        with element-wise transforms can still be packed and unpacked
+        together with their neighbours.
+
+      ``cache_size``:
+        If set, each function's results are kept for up to this many of
+        the most recently used values, and returned again without
+        calling it.  Only use this for functions which always return the
+        same result for equal values.  Results are shared between
+        callers, apart from lists, dicts, sets and bytearrays, of which
+        each caller gets a shallow copy.  Values which
+        aren't hashable, other than lists of hashable values, are
+        always passed to the function.  The caches are safe to use from
+        several threads; see :py:meth:`cache_info`.
     """
 
-    def __init__(self, pack_fn, unpack_fn):
-        assert isinstance(pack_fn, collections.Callable)
-        assert isinstance(unpack_fn, collections.Callable)
+    def __init__(self, pack_fn, unpack_fn, element_wise=False,
+                 cache_size=None):
+        assert callable(pack_fn)
+        assert callable(unpack_fn)
+        if cache_size is not None:
+            assert isinstance(cache_size, int) and cache_size > 0
+            pack_fn = _LRUCache(pack_fn, cache_size)
+            unpack_fn = _LRUCache(unpack_fn, cache_size)
         self.pack = pack_fn
         self.unpack = unpack_fn
+        self.element_wise = element_wise
+        self.cache_size = cache_size
+
+    def cache_info(self):
+        """The counters of a transform made with ``cache_size``.
+
+        Returns:
+          A dict with ``"pack"`` and ``"unpack"`` entries, each a dict
+          of ``hits``, ``misses``, ``evictions`` (results dropped to
+          make room for newer ones), ``uncacheable`` (calls with values
+          which can't be hashed) and ``size`` (results currently kept).
+          ``None`` if the transform has no cache.
+        """
+        if self.cache_size is None:
+            return None
+        return {"pack": self.pack.info(), "unpack": self.unpack.info()}
+
+    def clear_cache(self):
+        """Drops any cached results, and resets the counters."""
+        if self.cache_size is not None:
+            self.pack.clear()
+            self.unpack.clear()
+
+
+class _LRUCache(object):
+    """Wraps a function, keeping its most recently used results.
+
+    Results are keyed by the type and value of the argument, so that
+    e.g. ``1`` and ``True`` don't share a result.  Lists are keyed as
+    tuples.  Results which are lists, dicts, sets or bytearrays are
+    copied each time they're returned, so that a caller modifying one
+    doesn't change the cached result.  The function is called without
+    holding the lock, so two threads may both compute a missing result;
+    the first one stored is kept.
+    """
+
+    def __init__(self, function, size):
+        self.__setstate__({"_function": function, "_size": size})
+
+    def clear(self):  # pylint: disable=missing-docstring
+        with self._lock:
+            self._results.clear()
+            self.hits = self.misses = self.evictions = self.uncacheable = 0
+
+    def __getstate__(self):
+        # Locks can't be pickled, so the cache starts out empty.
+        return {"_function": self._function, "_size": self._size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # The lock and the dict are only made here, so that every
+        # thread shares them, even across calls to clear().
+        self._lock = threading.Lock()
+        self._results = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = self.uncacheable = 0
+
+    def info(self):  # pylint: disable=missing-docstring
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "uncacheable": self.uncacheable,
+                    "size": len(self._results)}
+
+    def __call__(self, val):
+        if type(val) is list:  # pylint: disable=unidiomatic-typecheck
+            key = (list, tuple(val))
+        else:
+            key = (type(val), val)
+        results = self._results
+        try:
+            with self._lock:
+                # Popping and reinserting marks the result as most
+                # recently used.
+                result = results.pop(key)
+                results[key] = result
+                self.hits += 1
+            return _copy_mutable(result)
+        except KeyError:
+            pass
+        except TypeError:
+            with self._lock:
+                self.uncacheable += 1
+            return self._function(val)
+
+        result = self._function(val)
+        with self._lock:
+            self.misses += 1
+            if key not in results:
+                results[key] = result
+                if len(results) > self._size:
+                    results.popitem(last=False)
+                    self.evictions += 1
+        return _copy_mutable(result)
+
+
+def _copy_mutable(val):
+    """Returns a shallow copy of ``val`` if it's a mutable container."""
+    if isinstance(val, (list, dict, set, bytearray)):
+        return copy.copy(val)
+    return val
+
+
+class EnumTransform(FieldTransform):
+    """A transform between packed numbers and the values they stand for.
+
+    Both directions are looked up in dicts built when the transform is
+    made, and the transform is element-wise, so each value of a repeated
+    field is looked up in turn.  The ``Color`` field above could be::
+
+      ezstruct.Field("UINT8", name="color",
+                     value_transform=ezstruct.EnumTransform(Color))
+
+    Packing or unpacking a value which isn't in the table raises
+    ``KeyError``.
+
+    Args:
+      ``members``:
+        An :py:class:`enum.Enum` subclass, whose members are packed as
+        their values; a dict mapping each packed value to its unpacked
+        value; or a sequence of unpacked values, packed as their
+        positions in it.
+    """
+
+    def __init__(self, members):
+        if isinstance(members, type):
+            unpack_table = dict((member.value, member) for member in members)
+        elif isinstance(members, collections_abc.Mapping):
+            unpack_table = dict(members)
+        else:
+            unpack_table = dict(enumerate(members))
+        pack_table = dict((val, packed)
+                          for packed, val in unpack_table.items())
+        assert len(pack_table) == len(unpack_table), (
+            "Unpacked values must be distinct")
+        self.pack_table = pack_table
+        self.unpack_table = unpack_table
+        FieldTransform.__init__(self,
+                                pack_table.__getitem__,
+                                unpack_table.__getitem__,
+                                element_wise=True)
@@ -52,21 +52,35 @@ Strings:
   ``"STRING"``
     A string.  Fields of this type must have
     both ``length`` and ``string_encoding`` specified.
+
+Any unsigned integer type can also be divided into named groups of
+bits; see :py:class:`Bitfield`.
+
+Nested structures:
+
+  An :py:class:`ezstruct.Struct`
+    The structure, packed with its own byte order, and unpacked into
+    a dict.  If it has a fixed size, and the same byte order as the
+    enclosing structure, its fields are packed and unpacked along with
+    the enclosing structure's, as though they were part of it.
 """
 from __future__ import absolute_import
 
-import six
+import array
+import struct
 
 
 class _FieldType(object):
     """Abstract base class for field types."""
     _unpacked_type = None
     _variable_length = False
+    _nested_struct = None
 
     def __init__(self, names, pack_char):
         assert self.__class__.unpacked_type
         self._names = names
         self._pack_char = pack_char
+        self._array_typecode = self._find_array_typecode()
 
     def __str__(self):
         return self._names[0]
@@ -86,6 +100,23 @@ class _FieldType(object):
         """Can the number of bytes this takes when packed vary?"""
         return self._variable_length
 
+    @property
+    def array_typecode(self):
+        """The :py:mod:`array` typecode for this type, or ``None``.
+
+        Values of this type can be stored in an ``array.array`` with
+        this typecode without conversion, except for byte order.
+        """
+        return self._array_typecode
+
+    @property
+    def nested_struct(self):
+        """The :py:class:`ezstruct.Struct` for nested structures, or ``None``."""
+        return self._nested_struct
+
+    def _find_array_typecode(self):  # pylint: disable=no-self-use
+        return None
+
 
 class _BoolFieldType(_FieldType):
     """Boolean values."""
@@ -94,10 +125,7 @@ class _BoolFieldType(_FieldType):
 
 class _BytesFieldType(_FieldType):
     """Raw bytes."""
-    if six.PY2:  # pragma: no cover
-        _unpacked_type = str
-    else:
-        _unpacked_type = bytes
+    _unpacked_type = bytes
     variable_length = True
 
 
@@ -105,22 +133,122 @@ class _IntFieldType(_FieldType):
     """Integers."""
     _unpacked_type = int
 
+    def _find_array_typecode(self):
+        size = struct.calcsize("=" + self._pack_char)
+        if self._pack_char.islower():
+            typecodes = "bhilq"
+        else:
+            typecodes = "BHILQ"
+        for typecode in typecodes:
+            if array.array(typecode).itemsize == size:
+                return typecode
+        return None  # pragma: no cover
+
 
 class _FloatFieldType(_FieldType):
     """Floating-point numbers."""
     _unpacked_type = float
 
+    def _find_array_typecode(self):
+        return self._pack_char
+
 
 class _StringFieldType(_FieldType):
     """Strings (ASCII, Unicode, etc.)"""
-    if six.PY2:  # pragma: no cover
-        _unpacked_type = unicode  # pylint: disable=undefined-variable
-    else:
-        _unpacked_type = str
+    _unpacked_type = str
     require_string_encoding = True
     variable_length = True
 
 
+class _StructFieldType(_FieldType):
+    """Nested structures."""
+    _unpacked_type = dict
+
+    def __init__(self, ezs):
+        assert hasattr(ezs, "fields") and hasattr(ezs, "byte_order"), (
+            "Unknown field type %r" % (ezs, ))
+        self._nested_struct = ezs
+        _FieldType.__init__(self, (str(ezs), ), None)
+
+
+class Bitfield(object):
+    """Named groups of bits within an unsigned integer field.
+
+    Made by :py:class:`ezstruct.Field` from its ``bits`` argument.  The
+    shift and mask for each group are worked out once, and built into
+    generated functions which convert between the packed integer and a
+    dict with an ``int`` for each named group: ``pack`` and ``unpack``
+    for one value, and ``pack_many`` and ``unpack_many`` for a list of
+    them.
+
+    Args:
+      ``bits``:
+        A list of ``(name, width)`` pairs, from the most significant
+        bits down.  Bits named ``None`` are packed as zero, and left out
+        of the dict.  Any bits left over at the bottom of the integer
+        are treated the same way.
+
+      ``width``: The number of bits in the integer.
+    """
+
+    def __init__(self, bits, width):
+        # Pairs may be given as lists, but the spec is part of the
+        # field's schema_key, so it has to be hashable.
+        self.spec = tuple(tuple(pair) for pair in bits)
+        self._width = width
+        self._members = []
+        position = width
+        for name, size in self.spec:
+            assert isinstance(name, (type(None), str))
+            assert isinstance(size, int) and size > 0
+            position -= size
+            assert position >= 0, "Bitfield is wider than %d bits" % width
+            if name is not None:
+                self._members.append((name, position, (1 << size) - 1))
+        names = [name for name, _, _ in self._members]
+        assert len(set(names)) == len(names), "Duplicate bitfield names"
+
+        checks = []
+        terms = []
+        for index, (name, shift, mask) in enumerate(self._members):
+            checks.append("v%d = get(%r, 0)" % (index, name))
+            checks.append("assert not v%d & %d, %r" % (
+                index, ~mask, "%s doesn't fit in its bits" % name))
+            terms.append("v%d << %d" % (index, shift) if shift else
+                         "v%d" % index)
+        packed = " | ".join(terms) or "0"
+        unpacked = "{%s}" % ", ".join(
+            "%r: raw >> %d & %d" % member for member in self._members)
+
+        lines = ["def pack(val):",
+                 "    get = val.get"]
+        lines.extend("    " + line for line in checks)
+        lines.append("    return %s" % packed)
+        lines.extend(["def pack_many(vals):",
+                      "    ret = []",
+                      "    append = ret.append",
+                      "    for val in vals:",
+                      "        get = val.get"])
+        lines.extend("        " + line for line in checks)
+        lines.append("        append(%s)" % packed)
+        lines.append("    return ret")
+        lines.append("def unpack(raw):")
+        lines.append("    return %s" % unpacked)
+        lines.append("def unpack_many(raws):")
+        lines.append("    return [%s for raw in raws]" % unpacked)
+        namespace = {}
+        exec("\n".join(lines) + "\n", namespace)
+        self.pack = namespace["pack"]
+        self.unpack = namespace["unpack"]
+        self.unpack_many = namespace["unpack_many"]
+        self.pack_many = namespace["pack_many"]
+
+    def __reduce__(self):
+        # The generated functions can't be pickled, so they're rebuilt.
+        return (Bitfield, (self.spec, self._width))
+
+
+
 _FIELD_TYPES = {}
 
 
@@ -146,4 +274,6 @@ _register_field_type(_StringFieldType, ("STRING",), "s")
 
 
 def get(name):  # pylint: disable=missing-docstring
+    if not isinstance(name, str):
+        return _StructFieldType(name)
     return _FIELD_TYPES[name]
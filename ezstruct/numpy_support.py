@@ -0,0 +1,210 @@
+"""Conversions between structures and NumPy structured arrays.
+
+NumPy is optional; these functions raise ``ImportError`` if it isn't
+installed.
+"""
+from __future__ import absolute_import
+
+from . import errors
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+# NumPy type codes for each struct module format character, at the
+# standard sizes used by ezstruct.
+_NUMPY_TYPES = {"?": "b1",
+                "b": "i1",
+                "B": "u1",
+                "h": "i2",
+                "H": "u2",
+                "l": "i4",
+                "L": "u4",
+                "q": "i8",
+                "Q": "u8",
+                "f": "f4",
+                "d": "f8"}
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("NumPy is required for structured array support.")
+
+
+def _layout(ezs):
+    """Yields ``(field, NumPy format, offset)`` for each field of ``ezs``.
+
+    Raises:
+      :py:class:`ezstruct.errors.IncompatibleField`
+    """
+    offset = 0
+    for the_field in ezs.fields:
+        size = the_field.fixed_size
+        if (size is None or
+                the_field.type.nested_struct is not None or
+                the_field.bits is not None or
+                not isinstance(the_field.repeat, int) or
+                the_field.string_encoding or
+                the_field.value_transform is not None):
+            raise errors.IncompatibleField(the_field, "NumPy structured arrays")
+
+        if the_field.type.variable_length:
+            fmt = "S%d" % size
+        else:
+            fmt = ezs.byte_order.pack_char + _NUMPY_TYPES[
+                the_field.type.pack_char]
+        if the_field.repeat != 1:
+            fmt = (fmt, (the_field.repeat,))
+        yield the_field, fmt, offset
+        offset += size * the_field.repeat
+
+
+def to_dtype(ezs):
+    """Builds the NumPy structured dtype matching an ``ezstruct.Struct``.
+
+    Unnamed fields become padding.
+
+    Raises:
+      :py:class:`ezstruct.errors.IncompatibleField` if a field has no
+      fixed layout, e.g. because it has a variable length or repeat
+      count, a string encoding, or a value transform.
+    """
+    _require_numpy()
+    layout = [(the_field.name, fmt, offset)
+              for the_field, fmt, offset in _layout(ezs)
+              if the_field.name]
+    return numpy.dtype({"names": [name for name, _, _ in layout],
+                        "formats": [fmt for _, fmt, _ in layout],
+                        "offsets": [offset for _, _, offset in layout],
+                        "itemsize": ezs.calcsize()})
+
+
+def unpack_array(ezs, buffer, offset=0, count=-1):
+    """Views packed structures in ``buffer`` as a NumPy structured array.
+
+    See :py:meth:`ezstruct.Struct.unpack_array`.
+    """
+    dtype = to_dtype(ezs)
+    available = memoryview(buffer).nbytes - offset
+    if count < 0:
+        count, extra = divmod(available, dtype.itemsize)
+        if extra:
+            raise errors.TruncatedRecord(count)
+    elif count * dtype.itemsize > available:
+        raise errors.TruncatedRecord(available // dtype.itemsize)
+    return numpy.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+
+
+def _column_count(columns):
+    count = None
+    for column in columns.values():
+        if count is None:
+            count = len(column)
+        assert len(column) == count, "Columns differ in length"
+    return count or 0
+
+
+def _rows(columns, count):
+    """Yields a dict per record from a dict of columns."""
+    names = list(columns)
+    values = []
+    for name in names:
+        column = columns[name]
+        if hasattr(column, "tolist"):
+            column = column.tolist()
+        values.append(column)
+    if not names:
+        return ({} for _ in range(count))
+    return (dict(zip(names, row)) for row in zip(*values))
+
+
+def _as_column(val, dtype, count):
+    """Converts a column of values to an array to be stored as ``dtype``.
+
+    Returns:
+      The array, or ``None`` if NumPy would store any of the values
+      differently from :py:meth:`ezstruct.Struct.pack_bytes`, e.g.
+      because they're out of range, of the wrong type, or of the wrong
+      length, so that the column must be packed record by record.
+    """
+    dtype = numpy.dtype(dtype)
+    base = dtype.base
+    try:
+        array = numpy.asarray(val)
+    except ValueError:
+        return None
+    if array.shape not in (dtype.shape, (count, ) + dtype.shape):
+        return None
+
+    kind = array.dtype.kind
+    if base.kind == "S":
+        if kind != "S":
+            return None
+        if array.dtype.itemsize == base.itemsize and array is val:
+            # Already stored at the field's width, so e.g. the result of
+            # unpack_array, whose values may end in NULs.
+            return array
+        # NumPy drops trailing NULs, so values which end in them are
+        # packed record by record.
+        if not (numpy.char.str_len(array) == base.itemsize).all():
+            return None
+    elif base.kind == "b":
+        if kind not in "biuf":
+            return None
+    elif base.kind in "iu":
+        if kind not in "biu":
+            return None
+        if not numpy.can_cast(array.dtype, base, casting="safe") and array.size:
+            info = numpy.iinfo(base)
+            if array.min() < info.min or array.max() > info.max:
+                return None
+    else:
+        if kind not in "biuf":
+            return None
+        if not numpy.can_cast(array.dtype, base, casting="safe") and array.size:
+            finite = array[numpy.isfinite(array)]
+            if finite.size and abs(finite).max() > numpy.finfo(base).max:
+                return None
+    return array
+
+
+def pack_columns(ezs, columns, count=None):
+    """Packs records given as columns.  See :py:meth:`ezstruct.Struct.pack_columns`."""
+    if count is None:
+        count = _column_count(columns)
+    try:
+        layout = list(_layout(ezs))
+    except errors.IncompatibleField:
+        layout = None
+    if numpy is None or layout is None:
+        return b"".join([ezs.pack_bytes(row) for row in _rows(columns, count)])
+
+    # Every field, named or not, gets a positional name in the packing
+    # dtype, so that unnamed fields' default values are written too.
+    array = numpy.zeros(count, dtype=numpy.dtype({
+        "names": ["f%d" % index for index in range(len(layout))],
+        "formats": [fmt for _, fmt, _ in layout],
+        "offsets": [offset for _, _, offset in layout],
+        "itemsize": ezs.calcsize()}))
+    for index, (the_field, fmt, _) in enumerate(layout):
+        if the_field.name in columns:
+            val = columns[the_field.name]
+        else:
+            val = the_field.get_values_for_pack({})
+            if val is None:
+                raise KeyError(the_field.name)
+        val = _as_column(val, fmt, count)
+        if val is None:
+            return b"".join([ezs.pack_bytes(row)
+                             for row in _rows(columns, count)])
+        array["f%d" % index] = val
+    return array.tobytes()
+
+
+def pack_array(ezs, array):
+    """Packs a structured array.  See :py:meth:`ezstruct.Struct.pack_array`."""
+    _require_numpy()
+    columns = dict((name, array[name]) for name in array.dtype.names)
+    return pack_columns(ezs, columns, len(array))
@@ -0,0 +1,97 @@
+"""Decoding large files of records on several processes at once.
+
+The file is split into chunks of whole records, which are decoded by a
+pool of worker processes.  Each worker needs the structure definition,
+which is either pickled along with each chunk, or given as the name of
+a module-level variable that workers import.  Names must be used for
+structures which can't be pickled, e.g. because they have lambdas as
+length functions or value transforms.
+"""
+from __future__ import absolute_import
+
+from . import record_file
+
+import concurrent.futures
+import importlib
+import mmap
+
+
+# The default number of bytes of the file each worker decodes at a time.
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def decode_file(path, ezs, workers=None, chunk_size=_CHUNK_SIZE,
+                index_path=None):
+    """Unpacks every record of a file, using a pool of processes.
+
+    If the structure has a fixed size, the file is split into chunks
+    directly.  Otherwise, record boundaries come from an offset index,
+    built by reading through the file, or loaded from ``index_path``;
+    see :py:class:`ezstruct.RecordFile`.  Building the index only reads
+    length and count prefixes, so it's cheaper than decoding the file.
+
+    Args:
+      ``path``: The file to decode.
+
+      ``ezs``:
+        The :py:class:`ezstruct.Struct` of each record, or the name of a
+        variable holding it, as ``"package.module:variable"``.
+
+      ``workers``:
+        The number of processes to use.  By default, there's one per CPU.
+
+      ``chunk_size``: The number of bytes to decode in each task.
+      ``index_path``: Where to keep the offset index.
+
+    Returns:
+      A generator of dicts containing the unpacked records, in the order
+      they appear in the file.  Chunks are decoded ahead of the one being
+      yielded, as workers become free.
+
+    Raises:
+      :py:class:`ezstruct.errors.TruncatedRecord` if the file ends
+      partway through a record.
+    """
+    with record_file.RecordFile(path, resolve(ezs), index_path) as records:
+        chunks = records.split(chunk_size)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = executor.map(_decode_chunk,
+                               [path] * len(chunks),
+                               [ezs] * len(chunks),
+                               [start for start, _ in chunks],
+                               [end for _, end in chunks])
+        for chunk in results:
+            for ret in chunk:
+                yield ret
+
+
+_RESOLVED = {}
+
+
+def resolve(ezs):
+    """Returns the :py:class:`ezstruct.Struct` named by ``ezs``.
+
+    Args:
+      ``ezs``:
+        Either a ``Struct``, which is returned as it is, or a string
+        ``"package.module:variable"``.
+    """
+    if not isinstance(ezs, str):
+        return ezs
+    the_struct = _RESOLVED.get(ezs)
+    if the_struct is None:
+        module, _, name = ezs.partition(":")
+        the_struct = getattr(importlib.import_module(module), name)
+        _RESOLVED[ezs] = the_struct
+    return the_struct
+
+
+def _decode_chunk(path, ezs, start, end):
+    """Unpacks the records between two offsets of a file, in a worker."""
+    with open(path, "rb") as data_file:
+        data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunk = data[start:end]
+        finally:
+            data.close()
+    return list(resolve(ezs).iter_unpack(chunk))
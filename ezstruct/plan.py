@@ -0,0 +1,1238 @@
+"""Precompiled execution plans for packing and unpacking structures.
+
+A plan is a list of *steps*.  Each run of adjacent fixed-size fields
+becomes a single :py:class:`_FixedRun`, backed by one precompiled
+:py:class:`struct.Struct`.  Every other field gets a
+:py:class:`_FieldStep`, whose length and repeat handling is resolved
+once, when the plan is built, rather than for every value.
+"""
+from __future__ import absolute_import
+
+from . import delimiter
+from . import errors
+from . import field
+
+import array
+import io
+import struct
+import sys
+
+
+# Bytes read at a time when scanning unpeekable streams for a delimiter.
+_SCAN_CHUNK_SIZE = 4096
+
+
+def _needs_byteswap(order):
+    """Must native-order data be byte-swapped to get ``order``?"""
+    if order.pack_char == "<":
+        return sys.byteorder != "little"
+    elif order.pack_char == ">":
+        return sys.byteorder != "big"
+    return False
+
+
+def _nested_run(order, the_field):
+    """The :py:class:`_FixedRun` of a nested structure, if it can be folded.
+
+    Nested structures are folded into the enclosing :py:class:`_FixedRun`
+    if their plan is a single run, in the same byte order.
+    """
+    nested = the_field.type.nested_struct
+    if nested is None or nested.byte_order.pack_char != order.pack_char:
+        return None
+    # The nested structure's own plan is used if it has one, but isn't
+    # built here, since that would compile a lazily-compiled structure
+    # which may never be used by itself.
+    steps = nested._plan  # pylint: disable=protected-access
+    if steps is None:
+        steps = compile_plan(nested.byte_order, nested.fields)
+    return single_run(steps)
+
+
+class _FoldedBits(object):
+    """Adapts a field's ``Bitfield`` for a :py:class:`_FixedRun`.
+
+    It has the same interface as a nested structure's run, so that the
+    run packs and unpacks the field's integers, and converts them to and
+    from dicts all at once.
+    """
+    value_count = 1
+
+    def __init__(self, the_field):
+        self._bits = the_field.bits
+        self.format = the_field.struct_format
+
+    def values_for_pack(self, val):  # pylint: disable=missing-docstring
+        return (self._bits.pack(val), )
+
+    def split(self, vals, start, stop):  # pylint: disable=missing-docstring
+        if stop is None:
+            return self._bits.unpack(vals[start])
+        return self._bits.unpack_many(vals[start:stop])
+
+
+class _FoldedTransform(object):
+    """Adapts an element-wise value transform for a :py:class:`_FixedRun`.
+
+    See :py:class:`_FoldedBits`.  The transform is applied to each of
+    the field's values as they're flattened and stored by the run.
+    """
+    value_count = 1
+
+    def __init__(self, the_field):
+        self._pack = the_field.value_transform.pack
+        self._unpack = the_field.value_transform.unpack
+        self.format = the_field.struct_format
+
+    def values_for_pack(self, val):  # pylint: disable=missing-docstring
+        return (self._pack(val), )
+
+    def split(self, vals, start, stop):  # pylint: disable=missing-docstring
+        if stop is None:
+            return self._unpack(vals[start])
+        return list(map(self._unpack, vals[start:stop]))
+
+
+def _folds_transform(the_field):
+    """Can a field's value transform be applied within a :py:class:`_FixedRun`?"""
+    return (the_field.value_transform.element_wise and
+            the_field.bits is None and
+            not the_field.type.variable_length and
+            the_field.type.nested_struct is None)
+
+
+def _composite(order, the_field):
+    """The nested run, or other adapter, for a field in a :py:class:`_FixedRun`.
+
+    Returns:
+      ``None`` for fields whose values are packed as they are.
+    """
+    if the_field.bits is not None:
+        return _FoldedBits(the_field)
+    if the_field.value_transform is not None:
+        return _FoldedTransform(the_field)
+    return _nested_run(order, the_field)
+
+
+class _EachTransform(object):
+    """Applies an element-wise value transform to each of a list of values."""
+
+    def __init__(self, transform):
+        self._pack = transform.pack
+        self._unpack = transform.unpack
+
+    def pack(self, vals):  # pylint: disable=missing-docstring
+        return list(map(self._pack, vals))
+
+    def unpack(self, vals):  # pylint: disable=missing-docstring
+        return list(map(self._unpack, vals))
+
+
+class _BitsTransform(object):
+    """Combines a field's ``Bitfield`` with its value transform, if any.
+
+    The transform is applied to the dicts, not to the packed integers.
+    """
+
+    def __init__(self, the_field, transform):
+        self._bits = the_field.bits
+        self._transform = transform
+        self._scalar = the_field.repeat == 1
+
+    def pack(self, vals):  # pylint: disable=missing-docstring
+        if self._transform is not None:
+            vals = self._transform.pack(vals)
+        if self._scalar:
+            return self._bits.pack(vals)
+        return self._bits.pack_many(vals)
+
+    def unpack(self, vals):  # pylint: disable=missing-docstring
+        if self._scalar:
+            vals = self._bits.unpack(vals)
+        else:
+            vals = self._bits.unpack_many(vals)
+        if self._transform is not None:
+            vals = self._transform.unpack(vals)
+        return vals
+
+
+def value_transform(the_field, transform=None):
+    """The transform to apply to a field's values, including its bitfield.
+
+    Element-wise transforms of repeated fields are applied to each value.
+
+    Args:
+      ``the_field``: The field.
+
+      ``transform``:
+        Used in place of the field's own value transform, e.g. to
+        instrument it.
+    """
+    if transform is None:
+        transform = the_field.value_transform
+    if (transform is not None and transform.element_wise and
+            the_field.repeat != 1):
+        transform = _EachTransform(transform)
+    if the_field.bits is not None:
+        return _BitsTransform(the_field, transform)
+    return transform
+
+
+def _is_fixed(order, the_field):
+    """Can ``the_field`` be folded into a :py:class:`_FixedRun`?
+
+    String fields aren't, since their encoded length can differ from the
+    declared one, and nor are fields with value transforms which aren't
+    element-wise.
+    """
+    if (the_field.value_transform is not None and
+            not _folds_transform(the_field)):
+        return False
+    if (the_field.string_encoding or
+            the_field.repeat_container != "list" or
+            not isinstance(the_field.repeat, int)):
+        return False
+    if the_field.type.nested_struct is not None:
+        return _nested_run(order, the_field) is not None
+    return the_field.fixed_size is not None
+
+
+class _FixedRun(object):
+    """Adjacent fixed-size fields, handled by a single ``struct.Struct``.
+
+    Nested structures with a single run of their own are folded in, so
+    their values are packed and unpacked by the same ``struct.Struct``.
+    So are bitfields, whose integers are converted all at once, and
+    element-wise value transforms, such as ``EnumTransform``.
+
+    Args:
+      ``order``: The ``ByteOrder`` of the enclosing structure.
+      ``fields``: The fields in the run.
+    """
+
+    def __init__(self, order, fields):
+        self.fields = fields
+        fmt = []
+        self._pack_members = []
+        self._unpack_members = []
+        # Whether any fields are nested structures or bitfields.
+        self.nested = False
+        index = 0
+        for the_field in fields:
+            repeat = the_field.repeat
+            nested = _composite(order, the_field)
+            if nested is not None:
+                if not isinstance(nested, _FoldedTransform):
+                    self.nested = True
+                fmt.append(nested.format * repeat)
+                width = nested.value_count
+            elif repeat == 1:
+                fmt.append(the_field.struct_format)
+                width = 1
+            elif the_field.type.variable_length:
+                fmt.append(the_field.struct_format * repeat)
+                width = 1
+            else:
+                fmt.append("%d%s" % (repeat, the_field.struct_format))
+                width = 1
+
+            if the_field.type.variable_length:
+                length = the_field.length
+            else:
+                length = None
+            self._pack_members.append((the_field,
+                                       None if repeat == 1 else repeat,
+                                       length,
+                                       nested))
+            if the_field.name:
+                self._unpack_members.append(
+                    (the_field.name,
+                     index,
+                     None if repeat == 1 else index + repeat * width,
+                     nested))
+            index += repeat * width
+        # The format without a byte order, for enclosing runs to fold in.
+        self.format = "".join(fmt)
+        # The number of values self.struct packs and unpacks.
+        self.value_count = index
+        self.struct = struct.Struct(order.pack_char + self.format)
+        self.size = self.struct.size
+
+    def values_for_pack(self, data):
+        """Flattens ``data`` into the arguments for ``self.struct.pack``."""
+        vals = []
+        for the_field, repeat, length, nested in self._pack_members:
+            val = the_field.get_values_for_pack(data)
+            if nested is not None:
+                if repeat is None:
+                    vals.extend(nested.values_for_pack(val))
+                else:
+                    assert len(val) == repeat
+                    for elt in val:
+                        vals.extend(nested.values_for_pack(elt))
+            elif repeat is None:
+                if length is not None:
+                    assert len(val) == length
+                vals.append(val)
+            else:
+                assert len(val) == repeat
+                if length is not None:
+                    for elt in val:
+                        assert len(elt) == length
+                vals.extend(val)
+        return vals
+
+    def store(self, vals, ret):
+        """Copies the values unpacked by ``self.struct`` into ``ret``."""
+        for name, start, stop, nested in self._unpack_members:
+            if nested is not None:
+                ret[name] = nested.split(vals, start, stop)
+            elif stop is None:
+                ret[name] = vals[start]
+            else:
+                ret[name] = list(vals[start:stop])
+
+    def split(self, vals, start, stop):
+        """Builds dicts from a nested run's values in ``vals[start:stop]``.
+
+        Returns:
+          A dict, if ``stop`` is ``None``; otherwise, a list of them.
+        """
+        width = self.value_count
+        if stop is None:
+            ret = {}
+            self.store(vals[start:start + width], ret)
+            return ret
+        rets = []
+        for elt_start in range(start, stop, width):
+            ret = {}
+            self.store(vals[elt_start:elt_start + width], ret)
+            rets.append(ret)
+        return rets
+
+    def pack(self, data, out):
+        """Appends the packed form of the run's fields to the list ``out``."""
+        out.append(self.struct.pack(*self.values_for_pack(data)))
+
+    def pack_into(self, data, buffer, offset):
+        """Packs the run's fields into ``buffer`` at ``offset``.
+
+        Returns:
+          The offset just past the run.
+        """
+        self.struct.pack_into(buffer, offset, *self.values_for_pack(data))
+        return offset + self.size
+
+    def packed_size(self, data):  # pylint: disable=unused-argument
+        """The number of bytes :py:meth:`pack` would produce for ``data``."""
+        return self.size
+
+    def unpack(self, buf, ret):
+        """Unpacks the run's fields from the :py:mod:`io` buffer ``buf``."""
+        self.store(self.struct.unpack(buf.read(self.size)), ret)
+
+    def unpack_from(self, buffer, offset, ret):
+        """Unpacks the run's fields from ``buffer`` at ``offset``.
+
+        Returns:
+          The offset just past the run.
+        """
+        end = offset + self.size
+        if end > len(buffer):
+            field.short_read(self.size)
+        self.store(self.struct.unpack_from(buffer, offset), ret)
+        return end
+
+    def skip_from(self, buffer, offset, ret):  # pylint: disable=unused-argument
+        """Finds the end of the run in ``buffer`` at ``offset``, without unpacking it.
+
+        Returns:
+          The offset just past the run.
+        """
+        end = offset + self.size
+        if end > len(buffer):
+            field.short_read(self.size)
+        return end
+
+    def unpack_requests(self, ret):
+        """Unpacks the run's fields into ``ret``, without doing any I/O.
+
+        See :py:func:`compile_plan`.
+        """
+        data = yield self.size, None
+        self.store(self.struct.unpack(data), ret)
+
+
+class _FieldStep(object):  # pylint: disable=too-many-instance-attributes
+    """A field which can't be coalesced into a :py:class:`_FixedRun`.
+
+    Args:
+      ``order``: The ``ByteOrder`` of the enclosing structure.
+      ``the_field``: The field.
+    """
+
+    def __init__(self, order, the_field):
+        self.field = the_field
+        self._name = the_field.name
+        self._transform = value_transform(the_field)
+
+        self._scalar = False
+        self._repeat = None
+        self._repeat_struct = None
+        if isinstance(the_field.repeat, field.Field):
+            self._repeat_struct = the_field.repeat.get_struct(order)
+        elif the_field.repeat == 1:
+            self._scalar = True
+        else:
+            self._repeat = the_field.repeat
+
+        self._encode = None
+        self._decode = None
+        if the_field.string_encoding:
+            self._encode = the_field.encoder
+            self._decode = the_field.decoder
+
+        length = the_field.length
+        self._value_struct = None
+        self._delimiter = None
+        self._length_struct = None
+        self._length_fn = None
+        self._length = None
+        if not the_field.type.variable_length:
+            self._value_struct = the_field.get_struct(order)
+            self._pack_value = self._pack_fixed
+            self._unpack_value = self._unpack_fixed
+            self._unpack_value_from = self._unpack_fixed_from
+        elif isinstance(length, delimiter.Delimiter):
+            self._delimiter = length.delimiter
+            self._pack_value = self._pack_delimited
+            self._unpack_value = self._unpack_delimited
+            self._unpack_value_from = self._unpack_delimited_from
+        elif isinstance(length, field.Field):
+            self._length_struct = length.get_struct(order)
+            self._pack_value = self._pack_prefixed
+            self._unpack_value = self._unpack_prefixed
+            self._unpack_value_from = self._unpack_prefixed_from
+        elif isinstance(length, int) or length is None:
+            # Without a length, a single byte is unpacked, as per the
+            # struct module's "s" format.
+            self._length = length
+            self._pack_value = self._pack_sized
+            self._unpack_value = self._unpack_sized
+            self._unpack_value_from = self._unpack_sized_from
+        else:
+            self._length_fn = length
+            self._pack_value = self._pack_computed
+            self._unpack_value = self._unpack_computed
+            self._unpack_value_from = self._unpack_computed_from
+
+        # Bytes added to each variable-length value.
+        self._overhead = 0
+        if self._delimiter is not None:
+            self._overhead = len(self._delimiter)
+        elif self._length_struct is not None:
+            self._overhead = self._length_struct.size
+
+        # The packed size, if it never varies.
+        self.size = None
+        value_size = the_field.fixed_size
+        if (value_size is not None and
+                self._encode is None and
+                self._repeat_struct is None):
+            self.size = value_size * (self._repeat or 1)
+
+    def _values(self, data):
+        """The values to pack for ``data``, with any transform applied."""
+        vals = self.field.get_values_for_pack(data)
+        if self._transform is not None:
+            vals = self._transform.pack(vals)
+
+        if self._scalar:
+            return (vals, )
+        elif self._repeat_struct is None:
+            assert len(vals) == self._repeat
+        return vals
+
+    def pack(self, data, out):
+        """Appends the packed form of the field to the list ``out``."""
+        vals = self._values(data)
+        if self._repeat_struct is not None:
+            out.append(self._repeat_struct.pack(len(vals)))
+        for val in vals:
+            self._pack_value(val, data, out)
+
+    def pack_into(self, data, buffer, offset):
+        """Packs the field into ``buffer`` at ``offset``.
+
+        Returns:
+          The offset just past the field.
+        """
+        chunks = []
+        self.pack(data, chunks)
+        return write_chunks(chunks, buffer, offset)
+
+    def packed_size(self, data):
+        """The number of bytes :py:meth:`pack` would produce for ``data``."""
+        vals = self._values(data)
+        size = 0
+        if self._repeat_struct is not None:
+            size = self._repeat_struct.size
+        if self._value_struct is not None:
+            return size + len(vals) * self._value_struct.size
+        for val in vals:
+            size += len(self._encoded(val)) + self._overhead
+        return size
+
+    def _encoded(self, val):
+        if self._encode is not None:
+            return self._encode(val)
+        return val
+
+    def _pack_fixed(self, val, data, out):  # pylint: disable=unused-argument
+        out.append(self._value_struct.pack(val))
+
+    def _pack_delimited(self, val, data, out):  # pylint: disable=unused-argument
+        out.append(self._encoded(val))
+        out.append(self._delimiter)
+
+    def _pack_prefixed(self, val, data, out):  # pylint: disable=unused-argument
+        # The prefix counts encoded bytes, since that's what unpacking reads.
+        val = self._encoded(val)
+        out.append(self._length_struct.pack(len(val)))
+        out.append(val)
+
+    def _pack_sized(self, val, data, out):  # pylint: disable=unused-argument
+        if self._length is not None:
+            assert len(val) == self._length
+        out.append(self._encoded(val))
+
+    def _pack_computed(self, val, data, out):
+        fn_len = self._length_fn(data)
+        val_len = len(val)
+        if fn_len != val_len:
+            raise errors.InconsistentLength(self.field, fn_len, val_len)
+        out.append(self._encoded(val))
+
+    def unpack(self, buf, ret):
+        """Unpacks the field from the :py:mod:`io` buffer ``buf`` into ``ret``.
+
+        ``ret`` also serves as the data unpacked so far, for fields with
+        a length function.
+        """
+        if self._scalar:
+            vals = self._unpack_value(buf, ret)
+        else:
+            count = self._repeat
+            if count is None:
+                count = self._repeat_struct.unpack(
+                    buf.read(self._repeat_struct.size))[0]
+            vals = [self._unpack_value(buf, ret) for _ in range(count)]
+
+        if self._transform is not None:
+            vals = self._transform.unpack(vals)
+        if self._name:
+            ret[self._name] = vals
+
+    def unpack_requests(self, ret):
+        """Unpacks the field into ``ret``, without doing any I/O.
+
+        See :py:func:`compile_plan`.
+        """
+        count = self._repeat
+        if self._scalar:
+            count = 1
+        elif count is None:
+            data = yield self._repeat_struct.size, None
+            count = self._repeat_struct.unpack(data)[0]
+
+        vals = []
+        if self._value_struct is not None:
+            # Fixed-size values are asked for all at once.
+            data = yield count * self._value_struct.size, None
+            vals = [val for val, in self._value_struct.iter_unpack(data)]
+            count = 0
+        for _ in range(count):
+            if self._delimiter is not None:
+                val = yield None, self._delimiter
+                val = val[:-len(self._delimiter)]
+            else:
+                if self._length_struct is not None:
+                    data = yield self._length_struct.size, None
+                    length = self._length_struct.unpack(data)[0]
+                elif self._length_fn is not None:
+                    length = self._length_fn(ret)
+                else:
+                    length = self._length or 1
+                val = yield length, None
+            if self._decode is not None:
+                val = self._decode(val)
+            vals.append(val)
+
+        if self._scalar:
+            vals = vals[0]
+        if self._transform is not None:
+            vals = self._transform.unpack(vals)
+        if self._name:
+            ret[self._name] = vals
+
+    async def unpack_async(self, reader, ret):
+        """Unpacks the field from an ``asyncio.StreamReader`` into ``ret``.
+
+        Like :py:meth:`unpack_requests`, but reading directly from
+        ``reader``, which saves resuming a generator for each read.
+        """
+        if self._scalar:
+            if self._value_struct is not None:
+                vals = self._value_struct.unpack(
+                    await reader.readexactly(self._value_struct.size))[0]
+            else:
+                vals = await self._read_value_async(reader, ret)
+        else:
+            count = self._repeat
+            if count is None:
+                count = self._repeat_struct.unpack(
+                    await reader.readexactly(self._repeat_struct.size))[0]
+            if self._value_struct is not None:
+                # Fixed-size values are read all at once.
+                data = await reader.readexactly(
+                    count * self._value_struct.size)
+                vals = [val for val, in self._value_struct.iter_unpack(data)]
+            else:
+                vals = [await self._read_value_async(reader, ret)
+                        for _ in range(count)]
+
+        if self._transform is not None:
+            vals = self._transform.unpack(vals)
+        if self._name:
+            ret[self._name] = vals
+
+    async def _read_value_async(self, reader, ret):
+        delim = self._delimiter
+        if delim is not None:
+            val = (await reader.readuntil(delim))[:-len(delim)]
+        else:
+            if self._length_struct is not None:
+                length = self._length_struct.unpack(
+                    await reader.readexactly(self._length_struct.size))[0]
+            elif self._length_fn is not None:
+                length = self._length_fn(ret)
+            else:
+                length = self._length or 1
+            val = await reader.readexactly(length)
+        if self._decode is not None:
+            val = self._decode(val)
+        return val
+
+    def _read_value(self, buf, length):
+        val = field.read_exactly(buf, length)
+        if self._decode is not None:
+            val = self._decode(val)
+        return val
+
+    def _unpack_fixed(self, buf, ret):  # pylint: disable=unused-argument
+        return self._value_struct.unpack(buf.read(self._value_struct.size))[0]
+
+    def _unpack_delimited(self, buf, ret):  # pylint: disable=unused-argument
+        val = read_delimited(buf, self._delimiter)
+        if self._decode is not None:
+            val = self._decode(val)
+        return val
+
+    def _unpack_prefixed(self, buf, ret):  # pylint: disable=unused-argument
+        length = self._length_struct.unpack(
+            buf.read(self._length_struct.size))[0]
+        return self._read_value(buf, length)
+
+    def _unpack_sized(self, buf, ret):  # pylint: disable=unused-argument
+        return self._read_value(buf, self._length or 1)
+
+    def _unpack_computed(self, buf, ret):
+        return self._read_value(buf, self._length_fn(ret))
+
+    def unpack_from(self, buffer, offset, ret):
+        """Unpacks the field from ``buffer`` at ``offset`` into ``ret``.
+
+        Returns:
+          The offset just past the field.
+        """
+        if self._scalar:
+            vals, offset = self._unpack_value_from(buffer, offset, ret)
+        else:
+            count = self._repeat
+            if count is None:
+                count, offset = unpack_one_from(self._repeat_struct,
+                                                buffer,
+                                                offset)
+            vals = []
+            for _ in range(count):
+                val, offset = self._unpack_value_from(buffer, offset, ret)
+                vals.append(val)
+
+        if self._transform is not None:
+            vals = self._transform.unpack(vals)
+        if self._name:
+            ret[self._name] = vals
+        return offset
+
+    def skip_from(self, buffer, offset, ret):
+        """Finds the end of the field in ``buffer`` at ``offset``, without unpacking it.
+
+        Only length and count prefixes are unpacked.  ``ret`` is only used
+        by fields with a length function.
+
+        Returns:
+          The offset just past the field.
+        """
+        start = offset
+        if self.size is not None:
+            end = offset + self.size
+        else:
+            count = self._repeat
+            if self._scalar:
+                count = 1
+            elif count is None:
+                count, offset = unpack_one_from(self._repeat_struct,
+                                                buffer,
+                                                offset)
+            if self._value_struct is not None:
+                end = offset + count * self._value_struct.size
+            else:
+                end = offset
+                for _ in range(count):
+                    end = self._skip_value(buffer, end, ret)
+        if end > len(buffer):
+            field.short_read(end - start)
+        return end
+
+    def _skip_value(self, buffer, offset, ret):
+        if self._delimiter is not None:
+            end = find(buffer, self._delimiter, offset)
+            if end < 0:
+                raise errors.DelimiterNotFound(self._delimiter)
+            return end + len(self._delimiter)
+        elif self._length_struct is not None:
+            length, offset = unpack_one_from(self._length_struct, buffer, offset)
+            return offset + length
+        elif self._length_fn is not None:
+            return offset + self._length_fn(ret)
+        return offset + (self._length or 1)
+
+    def _take_value(self, buffer, offset, length):
+        val = take(buffer, offset, length)
+        if self._decode is not None:
+            val = self._decode(val)
+        return val, offset + length
+
+    def _unpack_fixed_from(self, buffer, offset, ret):  # pylint: disable=unused-argument
+        return unpack_one_from(self._value_struct, buffer, offset)
+
+    def _unpack_delimited_from(self, buffer, offset, ret):  # pylint: disable=unused-argument
+        val, offset = take_delimited(buffer, offset, self._delimiter)
+        if self._decode is not None:
+            val = self._decode(val)
+        return val, offset
+
+    def _unpack_prefixed_from(self, buffer, offset, ret):  # pylint: disable=unused-argument
+        length, offset = unpack_one_from(self._length_struct, buffer, offset)
+        return self._take_value(buffer, offset, length)
+
+    def _unpack_sized_from(self, buffer, offset, ret):  # pylint: disable=unused-argument
+        return self._take_value(buffer, offset, self._length or 1)
+
+    def _unpack_computed_from(self, buffer, offset, ret):
+        return self._take_value(buffer, offset, self._length_fn(ret))
+
+
+class _ArrayStep(object):
+    """A repeated numeric field whose values are kept in an ``array.array``.
+
+    Args:
+      ``order``: The ``ByteOrder`` of the enclosing structure.
+      ``the_field``: The field.
+    """
+
+    def __init__(self, order, the_field):
+        self.field = the_field
+        self._name = the_field.name
+        self._transform = value_transform(the_field)
+        self._typecode = the_field.type.array_typecode
+        self._itemsize = the_field.fixed_size
+        self._byteswap = _needs_byteswap(order)
+
+        self._repeat = None
+        self._repeat_struct = None
+        self.size = None
+        if isinstance(the_field.repeat, field.Field):
+            self._repeat_struct = the_field.repeat.get_struct(order)
+        else:
+            self._repeat = the_field.repeat
+            self.size = self._repeat * self._itemsize
+
+    def _values(self, data):
+        """The values to pack for ``data``, as an ``array.array``."""
+        vals = self.field.get_values_for_pack(data)
+        if self._transform is not None:
+            vals = self._transform.pack(vals)
+        if self._repeat is not None:
+            assert len(vals) == self._repeat
+        return vals
+
+    def pack(self, data, out):
+        """Appends the packed form of the field to the list ``out``."""
+        vals = self._values(data)
+        if self._repeat_struct is not None:
+            out.append(self._repeat_struct.pack(len(vals)))
+        if (not isinstance(vals, array.array) or
+                vals.typecode != self._typecode or
+                self._byteswap):
+            vals = array.array(self._typecode, vals)
+            if self._byteswap:
+                vals.byteswap()
+        out.append(vals.tobytes())
+
+    def pack_into(self, data, buffer, offset):
+        """Packs the field into ``buffer`` at ``offset``.
+
+        Returns:
+          The offset just past the field.
+        """
+        chunks = []
+        self.pack(data, chunks)
+        return write_chunks(chunks, buffer, offset)
+
+    def packed_size(self, data):
+        """The number of bytes :py:meth:`pack` would produce for ``data``."""
+        size = len(self._values(data)) * self._itemsize
+        if self._repeat_struct is not None:
+            size += self._repeat_struct.size
+        return size
+
+    def _finish(self, data, ret):
+        vals = array.array(self._typecode)
+        vals.frombytes(data)
+        if self._byteswap:
+            vals.byteswap()
+        if self._transform is not None:
+            vals = self._transform.unpack(vals)
+        if self._name:
+            ret[self._name] = vals
+
+    def unpack(self, buf, ret):
+        """Unpacks the field from the :py:mod:`io` buffer ``buf`` into ``ret``."""
+        count = self._repeat
+        if count is None:
+            count = self._repeat_struct.unpack(
+                buf.read(self._repeat_struct.size))[0]
+        self._finish(field.read_exactly(buf, count * self._itemsize), ret)
+
+    def unpack_from(self, buffer, offset, ret):
+        """Unpacks the field from ``buffer`` at ``offset`` into ``ret``.
+
+        Returns:
+          The offset just past the field.
+        """
+        count = self._repeat
+        if count is None:
+            count, offset = unpack_one_from(self._repeat_struct, buffer, offset)
+        end = offset + count * self._itemsize
+        if end > len(buffer):
+            field.short_read(end - offset)
+        self._finish(memoryview(buffer)[offset:end], ret)
+        return end
+
+    def skip_from(self, buffer, offset, ret):  # pylint: disable=unused-argument
+        """Finds the end of the field in ``buffer`` at ``offset``, without unpacking it.
+
+        Returns:
+          The offset just past the field.
+        """
+        start = offset
+        count = self._repeat
+        if count is None:
+            count, offset = unpack_one_from(self._repeat_struct, buffer, offset)
+        end = offset + count * self._itemsize
+        if end > len(buffer):
+            field.short_read(end - start)
+        return end
+
+    def unpack_requests(self, ret):
+        """Unpacks the field into ``ret``, without doing any I/O.
+
+        See :py:func:`compile_plan`.
+        """
+        count = self._repeat
+        if count is None:
+            data = yield self._repeat_struct.size, None
+            count = self._repeat_struct.unpack(data)[0]
+        data = yield count * self._itemsize, None
+        self._finish(data, ret)
+
+
+class _StructStep(object):
+    """A nested structure which can't be folded into a :py:class:`_FixedRun`.
+
+    It is packed and unpacked by the nested structure's own plan.
+
+    Args:
+      ``order``: The ``ByteOrder`` of the enclosing structure.
+      ``the_field``: The field.
+    """
+
+    def __init__(self, order, the_field):
+        self.field = the_field
+        self._struct = the_field.type.nested_struct
+        self._name = the_field.name
+        self._transform = value_transform(the_field)
+
+        self._scalar = False
+        self._repeat = None
+        self._repeat_struct = None
+        if isinstance(the_field.repeat, field.Field):
+            self._repeat_struct = the_field.repeat.get_struct(order)
+        elif the_field.repeat == 1:
+            self._scalar = True
+        else:
+            self._repeat = the_field.repeat
+
+        self.size = None
+        value_size = the_field.fixed_size
+        if value_size is not None and self._repeat_struct is None:
+            self.size = value_size * (self._repeat or 1)
+
+    def _steps(self):
+        return self._struct._get_plan()  # pylint: disable=protected-access
+
+    def _values(self, data):
+        vals = self.field.get_values_for_pack(data)
+        if self._transform is not None:
+            vals = self._transform.pack(vals)
+        if self._scalar:
+            return (vals, )
+        elif self._repeat_struct is None:
+            assert len(vals) == self._repeat
+        return vals
+
+    def _finish(self, vals, ret):
+        if self._scalar:
+            vals = vals[0]
+        if self._transform is not None:
+            vals = self._transform.unpack(vals)
+        if self._name:
+            ret[self._name] = vals
+
+    def pack(self, data, out):
+        """Appends the packed form of the field to the list ``out``."""
+        vals = self._values(data)
+        if self._repeat_struct is not None:
+            out.append(self._repeat_struct.pack(len(vals)))
+        steps = self._steps()
+        for val in vals:
+            for step in steps:
+                step.pack(val, out)
+
+    def pack_into(self, data, buffer, offset):
+        """Packs the field into ``buffer`` at ``offset``.
+
+        Returns:
+          The offset just past the field.
+        """
+        chunks = []
+        self.pack(data, chunks)
+        return write_chunks(chunks, buffer, offset)
+
+    def packed_size(self, data):
+        """The number of bytes :py:meth:`pack` would produce for ``data``."""
+        vals = self._values(data)
+        size = 0
+        if self._repeat_struct is not None:
+            size = self._repeat_struct.size
+        return size + sum(self._struct.packed_size(val) for val in vals)
+
+    def unpack(self, buf, ret):
+        """Unpacks the field from the :py:mod:`io` buffer ``buf`` into ``ret``."""
+        count = self._repeat
+        if self._scalar:
+            count = 1
+        elif count is None:
+            count = self._repeat_struct.unpack(
+                buf.read(self._repeat_struct.size))[0]
+        steps = self._steps()
+        vals = []
+        for _ in range(count):
+            val = {}
+            for step in steps:
+                step.unpack(buf, val)
+            vals.append(val)
+        self._finish(vals, ret)
+
+    def unpack_from(self, buffer, offset, ret):
+        """Unpacks the field from ``buffer`` at ``offset`` into ``ret``.
+
+        Returns:
+          The offset just past the field.
+        """
+        count = self._repeat
+        if self._scalar:
+            count = 1
+        elif count is None:
+            count, offset = unpack_one_from(self._repeat_struct, buffer, offset)
+        steps = self._steps()
+        vals = []
+        for _ in range(count):
+            val = {}
+            for step in steps:
+                offset = step.unpack_from(buffer, offset, val)
+            vals.append(val)
+        self._finish(vals, ret)
+        return offset
+
+    def skip_from(self, buffer, offset, ret):  # pylint: disable=unused-argument
+        """Finds the end of the field in ``buffer`` at ``offset``, without unpacking it.
+
+        Returns:
+          The offset just past the field.
+        """
+        count = self._repeat
+        if self._scalar:
+            count = 1
+        elif count is None:
+            count, offset = unpack_one_from(self._repeat_struct, buffer, offset)
+        steps = self._steps()
+        for _ in range(count):
+            # The nested structure is unpacked, in case it has length
+            # functions that depend on its own values.
+            val = {}
+            for step in steps:
+                offset = step.unpack_from(buffer, offset, val)
+        return offset
+
+    def unpack_requests(self, ret):
+        """Unpacks the field into ``ret``, without doing any I/O.
+
+        See :py:func:`compile_plan`.
+        """
+        count = self._repeat
+        if self._scalar:
+            count = 1
+        elif count is None:
+            data = yield self._repeat_struct.size, None
+            count = self._repeat_struct.unpack(data)[0]
+        steps = self._steps()
+        vals = []
+        for _ in range(count):
+            val = {}
+            for step in steps:
+                requests = step.unpack_requests(val)
+                try:
+                    request = next(requests)
+                    while True:
+                        data = yield request
+                        request = requests.send(data)
+                except StopIteration:
+                    pass
+            vals.append(val)
+        self._finish(vals, ret)
+
+
+def write_chunks(chunks, buffer, offset):
+    """Copies each of ``chunks`` into ``buffer``, starting at ``offset``.
+
+    Returns:
+      The offset just past the last chunk.
+
+    Raises:
+      :py:class:`struct.error` if ``buffer`` is too small.
+    """
+    for chunk in chunks:
+        end = offset + len(chunk)
+        if end > len(buffer):
+            raise struct.error("pack_into requires a buffer of at least "
+                               "%d bytes" % end)
+        buffer[offset:end] = chunk
+        offset = end
+    return offset
+
+
+def read_delimited(buf, delim):
+    """Reads a value terminated by ``delim`` from the :py:mod:`io` buffer ``buf``.
+
+    The delimiter is consumed, but not included in the returned bytes.
+    Buffers with ``peek`` are scanned a buffered chunk at a time, so
+    nothing past the delimiter is consumed; otherwise, ``buf`` must be
+    seekable, and is read a chunk at a time and then repositioned.
+
+    Raises:
+      :py:class:`ezstruct.errors.DelimiterNotFound`
+    """
+    peek = getattr(buf, "peek", None)
+    if peek is None:
+        assert buf.seekable()
+
+    parts = []
+    # The end of the data scanned so far, in case a multi-byte delimiter
+    # spans two chunks.
+    tail = b""
+    while True:
+        if peek is not None:
+            chunk = peek(1)
+        else:
+            chunk = buf.read(_SCAN_CHUNK_SIZE)
+        if not chunk:
+            raise errors.DelimiterNotFound(delim)
+
+        window = tail + chunk if tail else chunk
+        pos = window.find(delim)
+        if pos >= 0:
+            # How much of the chunk the value and delimiter take up.
+            used = pos + len(delim) - len(tail)
+            if peek is not None:
+                parts.append(buf.read(used))
+            else:
+                parts.append(chunk[:used])
+                buf.seek(used - len(chunk), io.SEEK_CUR)
+            return b"".join(parts)[:-len(delim)]
+
+        if peek is not None:
+            buf.read(len(chunk))
+        parts.append(chunk)
+        tail = window[len(window) - len(delim) + 1:]
+
+
+def unpack_one_from(compiled, buffer, offset):
+    """Unpacks a single-value ``struct.Struct`` from ``buffer`` at ``offset``.
+
+    Returns:
+      A ``(value, offset just past the value)`` tuple.
+    """
+    end = offset + compiled.size
+    if end > len(buffer):
+        field.short_read(compiled.size)
+    return compiled.unpack_from(buffer, offset)[0], end
+
+
+def take(buffer, offset, length):
+    """Copies ``length`` bytes at ``offset`` out of ``buffer`` into a ``bytes``."""
+    end = offset + length
+    if end > len(buffer):
+        field.short_read(length)
+    val = buffer[offset:end]
+    if type(val) is not bytes:  # pylint: disable=unidiomatic-typecheck
+        val = bytes(val)
+    return val
+
+
+def find(buffer, delim, start):
+    """Like ``bytes.find``, for any buffer ``unpack_from`` accepts."""
+    if not isinstance(buffer, memoryview):
+        return buffer.find(delim, start)
+    # memoryview has no find(), so search it a chunk at a time.  Chunks
+    # overlap so that a delimiter spanning two chunks is still found.
+    chunk_size = max(4096, 4 * len(delim))
+    end = len(buffer)
+    while start < end:
+        chunk = buffer[start:start + chunk_size].tobytes()
+        pos = chunk.find(delim)
+        if pos >= 0:
+            return start + pos
+        if start + chunk_size >= end:
+            break
+        start += chunk_size - len(delim) + 1
+    return -1
+
+
+def take_delimited(buffer, offset, delim):
+    """Copies the value terminated by ``delim`` at ``offset`` out of ``buffer``.
+
+    Returns:
+      A ``(value, offset just past the delimiter)`` tuple.
+
+    Raises:
+      :py:class:`ezstruct.errors.DelimiterNotFound`
+    """
+    end = find(buffer, delim, offset)
+    if end < 0:
+        raise errors.DelimiterNotFound(delim)
+    return take(buffer, offset, end - offset), end + len(delim)
+
+
+def single_run(steps):
+    """Returns the only step of a plan, if it is a :py:class:`_FixedRun`."""
+    if len(steps) == 1 and isinstance(steps[0], _FixedRun):
+        return steps[0]
+    return None
+
+
+def skipper(steps):
+    """Returns a function finding where a structure ends, without unpacking it.
+
+    The function takes ``(buffer, offset)`` and returns the offset just
+    past the structure at ``offset``, like :py:meth:`skip_from` does for
+    a single step.  Only length and count prefixes are unpacked, unless
+    a field has a length function, which may need the values before it.
+
+    Raises:
+      :py:class:`struct.error` or
+      :py:class:`ezstruct.errors.DelimiterNotFound` if ``buffer`` ends
+      partway through the structure.
+    """
+    if any(getattr(step, "_length_fn", None) is not None for step in steps):
+        methods = [step.unpack_from for step in steps]
+    else:
+        methods = [step.skip_from for step in steps]
+
+    def skip_from(buffer, offset):
+        ret = {}
+        for method in methods:
+            offset = method(buffer, offset, ret)
+        return offset
+    return skip_from
+
+
+def compile_plan(order, fields):
+    """Builds the list of steps for a structure.
+
+    Args:
+      ``order``: The structure's ``ByteOrder``.
+      ``fields``: The structure's fields.
+
+    Returns:
+      A list of steps, each of which has ``pack(data, out)``,
+      ``pack_into(data, buffer, offset)``, ``packed_size(data)``,
+      ``unpack(buf, ret)``, ``unpack_from(buffer, offset, ret)``,
+      ``skip_from(buffer, offset, ret)`` and ``unpack_requests(ret)``
+      methods, and a ``size`` attribute which
+      is the step's packed size if it never varies and ``None``
+      otherwise.
+
+      ``unpack_requests`` returns a generator for callers which do their
+      own I/O.  It yields ``(size, None)`` to request exactly ``size``
+      bytes, or ``(None, delimiter)`` to request the bytes up to and
+      including ``delimiter``, and must be sent the requested bytes.
+    """
+    steps = []
+    run = []
+    for the_field in fields:
+        if _is_fixed(order, the_field):
+            run.append(the_field)
+            continue
+        if run:
+            steps.append(_FixedRun(order, run))
+            run = []
+        if the_field.repeat_container == "array":
+            steps.append(_ArrayStep(order, the_field))
+        elif the_field.type.nested_struct is not None:
+            steps.append(_StructStep(order, the_field))
+        else:
+            steps.append(_FieldStep(order, the_field))
+    if run:
+        steps.append(_FixedRun(order, run))
+    return steps
+
+
+def compile_field_steps(order, fields):
+    """Builds one step per field, without coalescing any of them.
+
+    This is for callers which handle fields individually, such as
+    :py:class:`ezstruct.view.StructView`.  See :py:func:`compile_plan`.
+    """
+    return [compile_plan(order, [the_field])[0] for the_field in fields]
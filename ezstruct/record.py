@@ -0,0 +1,164 @@
+"""Compact record classes for unpacked structures."""
+from __future__ import absolute_import
+
+import array
+import keyword
+import re
+
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class Record(object):
+    """Base class of the classes made by :py:meth:`ezstruct.Struct.record_class`.
+
+    Each named field of the structure is stored in a slot, rather than
+    in a dict.  Fields can be read and set as attributes or as items,
+    and records can be passed to :py:meth:`ezstruct.Struct.pack` as they
+    are, in place of a dict.
+
+    A record can be built with the fields' values either in order or by
+    name.  Fields without a value are packed with their
+    ``default_pack_value``.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self._fields):
+            raise TypeError("%s takes at most %d values" % (
+                type(self).__name__, len(self._fields)))
+        for name, val in zip(self._fields, args):
+            self._init_field(name, val)
+        for name, val in kwargs.items():
+            if name not in self._fields:
+                raise TypeError("%s has no field %r" % (type(self).__name__,
+                                                        name))
+            self._init_field(name, val)
+
+    def _init_field(self, name, val):
+        setattr(self, name, val)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, val):
+        try:
+            setattr(self, name, val)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._fields and hasattr(self, name)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):  # pylint: disable=unidiomatic-typecheck
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__,
+                           ", ".join("%s=%r" % (name, self[name])
+                                     for name in self.keys()))
+
+    def get(self, name, default=None):
+        """Like ``dict.get``."""
+        return getattr(self, name, default)
+
+    def keys(self):
+        """The names of the fields which have values."""
+        return [name for name in self._fields if hasattr(self, name)]
+
+    def to_dict(self):
+        """The record's fields, as a dict like :py:meth:`ezstruct.Struct.unpack` returns."""
+        return dict((name, self[name]) for name in self.keys())
+
+
+class FrozenDict(dict):
+    """A ``dict`` which can't be modified, used for values of frozen records."""
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("%s is read-only" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, dict.__repr__(self))
+
+
+def freeze(val):
+    """Returns an immutable copy of an unpacked value.
+
+    Lists and arrays become tuples, sets become frozensets, and dicts
+    become :py:class:`FrozenDict`, with their contents frozen in turn.
+    Other values, such as instances of a ``repeat_container`` or the
+    results of a value transform, are returned as they are, so they
+    should be immutable themselves.
+    """
+    if isinstance(val, (list, tuple, array.array)):
+        return tuple(freeze(elt) for elt in val)
+    if isinstance(val, (set, frozenset)):
+        return frozenset(freeze(elt) for elt in val)
+    if isinstance(val, dict):
+        return FrozenDict((key, freeze(elt)) for key, elt in val.items())
+    if isinstance(val, bytearray):
+        return bytes(val)
+    return val
+
+
+class FrozenRecord(Record):
+    """A :py:class:`Record` whose fields can't be changed.
+
+    Values are frozen with :py:func:`freeze` as the record is built, so
+    that nothing reachable from it can be modified either.  This makes
+    frozen records safe to share, e.g. between the callers of a
+    :py:meth:`ezstruct.Struct.enable_decode_cache` structure, and
+    hashable, if their values are.
+    """
+    __slots__ = ()
+
+    def _init_field(self, name, val):
+        object.__setattr__(self, name, freeze(val))
+
+    def __setattr__(self, name, val):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    __delattr__ = __setattr__
+
+    def __setitem__(self, name, val):
+        raise TypeError("%s is read-only" % type(self).__name__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name, None) for name in self._fields))
+
+
+def make_record_class(ezs, class_name="Record", frozen=False):
+    """Builds a :py:class:`Record` subclass for the named fields of ``ezs``.
+
+    If ``frozen`` is true, the class is a :py:class:`FrozenRecord`.
+    """
+    base = FrozenRecord if frozen else Record
+    names = tuple(the_field.name for the_field in ezs.fields if the_field.name)
+    for name in names:
+        assert _IDENTIFIER.match(name) and not keyword.iskeyword(name), (
+            "Field name %r isn't an identifier" % name)
+        assert not hasattr(base, name), (
+            "Field name %r clashes with a Record attribute" % name)
+    return type(class_name, (base, ), {"__slots__": names,
+                                       "_fields": names})
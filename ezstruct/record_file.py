@@ -0,0 +1,317 @@
+"""Random access to files of consecutive packed structures."""
+from __future__ import absolute_import
+
+from . import errors
+from . import plan
+
+import array
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+
+# Sidecar index files start with this magic number, the size and
+# modification time (in nanoseconds) of the data file they index, a
+# digest of the structure's definition, and the number of records in
+# the file, followed by the offset of each record and then the size of
+# the data file again.  All values are little-endian.
+_INDEX_MAGIC = b"EZSIDX02"
+_INDEX_HEADER = struct.Struct("<8sQq16sQ")
+_INDEX_TYPECODE = "Q"
+
+
+class RecordFile(object):
+    """A memory-mapped file of consecutive packed structures.
+
+    Records can be counted, indexed and sliced like a list, and only the
+    records asked for are unpacked::
+
+      with ezstruct.RecordFile("events.bin", event) as events:
+          print(len(events), events[-1])
+          for record in events[1000:1010]:
+              handle(record)
+
+    If the structure has a fixed size, the offset of each record is
+    computed.  Otherwise, the first time the file is opened, it is read
+    through once to find where each record starts.  Those offsets can be
+    saved in a sidecar index file, so that later opens don't need to
+    read the file again.
+
+    Args:
+      ``path``: The file to read.
+      ``ezs``: The :py:class:`ezstruct.Struct` of each record.
+
+      ``index_path``:
+        Where to keep the offset index, for structures without a fixed
+        size.  If the file exists and matches the size and modification
+        time of the data file and the structure's definition, it is
+        used; otherwise the index is built and written there.
+
+    Raises:
+      :py:class:`ezstruct.errors.TruncatedRecord` if the file ends
+      partway through a record.
+    """
+
+    def __init__(self, path, ezs, index_path=None):
+        self.struct = ezs
+        self._file = open(path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self._size = stat.st_size
+        self._mtime = stat.st_mtime_ns
+        if self._size:
+            self._buffer = mmap.mmap(self._file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped.
+            self._buffer = b""
+
+        try:
+            self._record_size = self._fixed_size()
+            self._offsets = None
+            if self._record_size is None:
+                self._offsets = self._load_index(index_path)
+        except Exception:
+            self.close()
+            raise
+
+    def _fixed_size(self):
+        try:
+            record_size = self.struct.calcsize()
+        except errors.VariableLength:
+            return None
+        if self._size % record_size:
+            raise errors.TruncatedRecord(self._size // record_size)
+        return record_size
+
+    def _load_index(self, index_path):
+        """Reads the offset index from ``index_path``, or builds it."""
+        # Everything in the index's header but the record count.
+        key = (_INDEX_MAGIC, self._size, self._mtime,
+               _schema_digest(self.struct))
+        if index_path is not None and os.path.exists(index_path):
+            offsets = _read_index(index_path, key)
+            if offsets is not None:
+                return offsets
+
+        # Records are only skipped over, not unpacked.
+        skip_from = plan.skipper(
+            self.struct._get_plan())  # pylint: disable=protected-access
+        buffer = self._buffer
+        offsets = array.array(_INDEX_TYPECODE, [0])
+        offset = 0
+        while offset < self._size:
+            try:
+                offset = skip_from(buffer, offset)
+            except (struct.error, errors.DelimiterNotFound):
+                raise errors.TruncatedRecord(len(offsets) - 1)
+            offsets.append(offset)
+
+        if index_path is not None:
+            _write_index(index_path, key, offsets)
+        return offsets
+
+    def close(self):
+        """Unmaps and closes the file."""
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = b""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        if self._offsets is None:
+            return self._size // self._record_size
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        count = len(self)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError("RecordFile index out of range")
+        return self.struct.unpack_from(self._buffer, self.offset(index))[0]
+
+    def bisect(self, key_field, value):
+        """Binary searches records sorted on a field, like :py:func:`bisect.bisect_left`.
+
+        Only the key field of the records visited is unpacked, so a
+        search touches O(log N) pages of the file.  The structure must
+        have a fixed size.
+
+        Args:
+          ``key_field``:
+            The name of the field the records are sorted on.  It can't
+            be repeated or have a variable length.
+
+          ``value``: The key value to look for.
+
+        Returns:
+          The index of the first record whose key isn't less than
+          ``value``, or ``len(self)`` if there's none.
+
+        Raises:
+          :py:class:`ezstruct.errors.VariableLength` if the structure's
+          size can vary.
+        """
+        get_key = self._key_getter(key_field)
+        low = 0
+        high = len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if get_key(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_range(self, key_field, low, high):
+        """Finds the records whose key is at least ``low`` and less than ``high``.
+
+        Records must be sorted on ``key_field``; see :py:meth:`bisect`.
+
+        Returns:
+          A generator of the matching records, which are unpacked as it
+          is consumed.
+        """
+        start = self.bisect(key_field, low)
+        stop = self.bisect(key_field, high)
+        return (self[index] for index in range(start, stop))
+
+    def _key_getter(self, key_field):
+        """Returns a function unpacking ``key_field`` from record N."""
+        if self._offsets is not None:
+            raise errors.VariableLength(self.struct)
+
+        field_offset = 0
+        for the_field in self.struct.fields:
+            if the_field.name == key_field:
+                break
+            field_offset += the_field.fixed_size * the_field.repeat
+        else:
+            raise KeyError(key_field)
+        if (the_field.repeat != 1 or
+                the_field.type.variable_length or
+                the_field.type.nested_struct is not None or
+                the_field.bits is not None):
+            raise errors.IncompatibleField(the_field, "a sort key")
+
+        compiled = the_field.get_struct(self.struct.byte_order)
+        transform = the_field.value_transform
+        record_size = self._record_size
+        buffer = self._buffer
+
+        def get_key(index):
+            val = compiled.unpack_from(buffer,
+                                       index * record_size + field_offset)[0]
+            if transform is not None:
+                val = transform.unpack(val)
+            return val
+        return get_key
+
+    def split(self, chunk_size):
+        """Divides the file into chunks of whole records.
+
+        Args:
+          ``chunk_size``:
+            The number of bytes each chunk should have.  Chunks are made
+            as close to this size as record boundaries allow, but have
+            at least one record.
+
+        Returns:
+          A list of ``(start, end)`` byte offsets of the chunks, in order.
+        """
+        if self._offsets is None:
+            per_chunk = max(1, chunk_size // self._record_size)
+            offsets = [index * self._record_size
+                       for index in range(0, len(self), per_chunk)]
+            offsets.append(self._size)
+        else:
+            offsets = [0]
+            while offsets[-1] < self._size:
+                index = bisect.bisect_left(self._offsets,
+                                           offsets[-1] + chunk_size)
+                # Even if chunk_size is zero or less, each chunk has a
+                # record.
+                index = max(index,
+                            bisect.bisect_right(self._offsets, offsets[-1]))
+                offsets.append(self._offsets[min(index, len(self))])
+        if self._size == 0:
+            return []
+        return list(zip(offsets, offsets[1:]))
+
+    def offset(self, index):
+        """The offset in the file of record number ``index``."""
+        if self._offsets is None:
+            return index * self._record_size
+        return self._offsets[index]
+
+
+def _schema_digest(ezs):
+    """Hashes the structure's definition, for checking sidecar indexes.
+
+    Length functions and transforms are described by name, so that the
+    digest is the same in every process.
+    """
+    return hashlib.sha256(repr(_stable_key(ezs.schema_key())).encode(
+        "utf-8")).digest()[:16]
+
+
+def _stable_key(key):
+    if isinstance(key, tuple):
+        return tuple(_stable_key(val) for val in key)
+    elif key is None or isinstance(key, (bool, float, int, str, bytes)):
+        return key
+    return "%s.%s" % (getattr(key, "__module__", None),
+                      getattr(key, "__qualname__", type(key).__name__))
+
+
+def _read_index(index_path, key):
+    """Reads a sidecar index, returning ``None`` if it doesn't match.
+
+    ``key`` is the header the index should have, apart from the record
+    count.
+    """
+    with open(index_path, "rb") as index_file:
+        header = index_file.read(_INDEX_HEADER.size)
+        if len(header) != _INDEX_HEADER.size:
+            return None
+        header = _INDEX_HEADER.unpack(header)
+        if header[:-1] != key:
+            return None
+        data_size = header[1]
+        count = header[-1]
+
+        offsets = array.array(_INDEX_TYPECODE)
+        data = index_file.read((count + 1) * offsets.itemsize)
+        if len(data) != (count + 1) * offsets.itemsize:
+            return None
+        offsets.frombytes(data)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        if offsets[-1] != data_size:
+            return None
+        return offsets
+
+
+def _write_index(index_path, key, offsets):
+    if sys.byteorder != "little":
+        offsets = array.array(_INDEX_TYPECODE, offsets)
+        offsets.byteswap()
+    with open(index_path, "wb") as index_file:
+        index_file.write(_INDEX_HEADER.pack(*(key + (len(offsets) - 1, ))))
+        index_file.write(offsets.tobytes())
@@ -0,0 +1,192 @@
+"""Structures described by plain data, such as JSON.
+
+A schema is a dict mapping the name of each structure to its
+description::
+
+  {"Header": {"byte_order": "NET_ENDIAN",
+              "fields": [{"type": "UINT8", "name": "version"},
+                         {"type": "UINT16", "name": "flags",
+                          "bits": [["offset", 4], [null, 12]]}]},
+   "Message": {"byte_order": "NET_ENDIAN",
+               "fields": [{"type": "Header", "name": "header"},
+                          {"type": "UINT8", "name": "kind",
+                           "enum": ["ping", "pong"]},
+                          {"type": "STRING", "name": "topic",
+                           "string_encoding": "utf-8",
+                           "length": {"delimiter": "00"}},
+                          {"type": "BYTES", "name": "payload",
+                           "length": {"type": "UINT16"}}]}}
+
+Each field is described by the arguments to :py:class:`ezstruct.Field`,
+with these differences:
+
+* ``type`` is the field type, or the name of another structure in the
+  schema to nest.
+* A ``repeat`` or ``length`` which is itself a field is described the
+  same way, and a delimiter is given as ``{"delimiter": "<hex>"}``.
+* ``bits`` is a list of ``[name, width]`` pairs.
+* ``enum`` is a list, or an object mapping packed numbers to values,
+  for an :py:class:`ezstruct.EnumTransform`.
+
+Length functions and other value transforms can't be described, since
+they're code.
+"""
+from __future__ import absolute_import
+
+from . import byte_order
+from . import delimiter
+from . import errors
+from . import field
+from . import field_transform
+from . import field_type
+from . import struct
+
+import binascii
+import json
+
+
+# The arguments of ezstruct.Field which are passed through unchanged.
+_FIELD_ARGUMENTS = frozenset(("name",
+                              "repeat_container",
+                              "default_pack_value",
+                              "string_encoding",
+                              "string_encoding_errors_policy",
+                              "intern_strings"))
+
+
+def load_schema(schema, codegen="lazy", code_cache=None):
+    """Builds the structures described by a schema.
+
+    Args:
+      ``schema``:
+        The schema, as a dict, a JSON string, or a file of JSON.
+
+      ``codegen``:
+        Passed to each :py:class:`ezstruct.Struct`.  By default,
+        structures are compiled when they're first used, so that only
+        the ones a process uses are compiled; see
+        :py:meth:`ezstruct.Struct.warm_up`.
+
+      ``code_cache``:
+        A directory in which to keep compiled code, for processes which
+        load the same schema; see :py:class:`ezstruct.Struct`.
+
+    Returns:
+      A dict mapping each structure's name to its
+      :py:class:`ezstruct.Struct`.
+
+    Raises:
+      :py:class:`ezstruct.errors.SchemaError` if the schema is invalid.
+    """
+    if hasattr(schema, "read"):
+        schema = json.load(schema)
+    elif isinstance(schema, str):
+        schema = json.loads(schema)
+    if not isinstance(schema, dict):
+        raise errors.SchemaError("the top level",
+                                 "expected an object of structures")
+    loader = _Loader(schema, codegen, code_cache)
+    return dict((name, loader.struct(name)) for name in schema)
+
+
+class _Loader(object):
+    """Builds a schema's structures, each after those nested in it."""
+
+    def __init__(self, schema, codegen, code_cache):
+        self._schema = schema
+        self._codegen = codegen
+        self._code_cache = code_cache
+        self._structs = {}
+        self._loading = set()
+
+    def struct(self, name):
+        """Returns the structure ``name``, building it if need be."""
+        the_struct = self._structs.get(name)
+        if the_struct is not None:
+            return the_struct
+        if name in self._loading:
+            raise errors.SchemaError(name, "structure contains itself")
+        self._loading.add(name)
+
+        desc = self._schema[name]
+        _check_keys(name, desc, ("byte_order", "fields"), ("byte_order", ))
+        try:
+            byte_order.get(desc["byte_order"])
+        except KeyError:
+            raise errors.SchemaError(name, "unknown byte order %r" %
+                                     desc["byte_order"])
+        fields = [self._field("%s.fields[%d]" % (name, index), field_desc)
+                  for index, field_desc in enumerate(desc.get("fields", ()))]
+        the_struct = struct.Struct(desc["byte_order"], *fields,
+                                   codegen=self._codegen,
+                                   code_cache=self._code_cache)
+
+        self._loading.remove(name)
+        self._structs[name] = the_struct
+        return the_struct
+
+    def _field(self, where, desc):
+        _check_keys(where, desc,
+                    _FIELD_ARGUMENTS.union(("type", "repeat", "length",
+                                            "bits", "enum")),
+                    ("type", ))
+        kwargs = dict((key, val) for key, val in desc.items()
+                      if key in _FIELD_ARGUMENTS)
+
+        the_type = desc["type"]
+        if the_type in self._schema:
+            the_type = self.struct(the_type)
+        else:
+            try:
+                field_type.get(the_type)
+            except (KeyError, TypeError):
+                raise errors.SchemaError(where, "unknown type %r" % the_type)
+
+        repeat = desc.get("repeat")
+        if isinstance(repeat, dict):
+            kwargs["repeat"] = self._field(where + ".repeat", repeat)
+        elif repeat is not None:
+            kwargs["repeat"] = repeat
+
+        length = desc.get("length")
+        if isinstance(length, dict) and "delimiter" in length:
+            _check_keys(where + ".length", length, ("delimiter", ),
+                        ("delimiter", ))
+            try:
+                delim = binascii.unhexlify(length["delimiter"])
+            except (TypeError, ValueError):
+                raise errors.SchemaError(where + ".length",
+                                         "delimiter isn't hexadecimal")
+            kwargs["length"] = delimiter.Delimiter(delim)
+        elif isinstance(length, dict):
+            kwargs["length"] = self._field(where + ".length", length)
+        elif length is not None:
+            kwargs["length"] = length
+
+        if desc.get("bits") is not None:
+            kwargs["bits"] = [tuple(member) for member in desc["bits"]]
+
+        members = desc.get("enum")
+        if isinstance(members, dict):
+            # JSON object keys are always strings.
+            members = dict((int(key), val) for key, val in members.items())
+        if members is not None:
+            kwargs["value_transform"] = field_transform.EnumTransform(members)
+
+        try:
+            return field.Field(the_type, **kwargs)
+        except (AssertionError, LookupError, TypeError, ValueError) as err:
+            raise errors.SchemaError(where, str(err) or "invalid field")
+
+
+def _check_keys(where, desc, allowed, required):
+    """Checks that ``desc`` is a dict with only the expected keys."""
+    if not isinstance(desc, dict):
+        raise errors.SchemaError(where, "expected an object")
+    unknown = set(desc) - set(allowed)
+    if unknown:
+        raise errors.SchemaError(where, "unknown keys %s" %
+                                 ", ".join(sorted(unknown)))
+    for key in required:
+        if key not in desc:
+            raise errors.SchemaError(where, "missing %r" % key)
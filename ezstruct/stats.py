@@ -0,0 +1,246 @@
+"""Per-field instrumentation of packing and unpacking.
+
+See :py:meth:`ezstruct.Struct.enable_stats`.  Instrumentation works by
+giving the structure a separate plan, with one step per field, each
+wrapped in an :py:class:`_InstrumentedStep`; the ordinary plan and
+generated code are left untouched, so they cost nothing extra while
+instrumentation is off.
+"""
+from __future__ import absolute_import
+
+from . import field_transform
+from . import plan
+
+import io
+import timeit
+
+
+_COUNTERS = ("pack_calls",
+             "unpack_calls",
+             "bytes_packed",
+             "bytes_unpacked",
+             "pack_time",
+             "unpack_time",
+             "delimiter_scans",
+             "transform_calls")
+
+
+class FieldStats(object):
+    """Counters for one field.
+
+    Attributes:
+      ``pack_calls``, ``unpack_calls``:
+        The number of times the field was packed and unpacked.
+
+      ``bytes_packed``, ``bytes_unpacked``:
+        The number of bytes the field took up, including any length or
+        count prefixes and delimiters.
+
+      ``pack_time``, ``unpack_time``:
+        The total time spent packing and unpacking the field, in
+        seconds.
+
+      ``delimiter_scans``:
+        The number of times a delimited value was searched for.
+
+      ``transform_calls``:
+        The number of times the field's value transform was called.
+        Element-wise transforms are counted once per value.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Sets every counter back to zero."""
+        for counter in _COUNTERS:
+            setattr(self, counter, 0)
+
+    def snapshot(self):
+        """The counters, as a dict."""
+        return dict((counter, getattr(self, counter)) for counter in _COUNTERS)
+
+
+def _label(index, the_field):
+    """The name a field's counters are reported under."""
+    return the_field.name or "[%d]" % index
+
+
+class Stats(object):
+    """The counters for each field of a structure.
+
+    Args:
+      ``ezs``: The :py:class:`ezstruct.Struct`.
+    """
+
+    def __init__(self, ezs):
+        # The structure's generated code, set aside while it's
+        # instrumented.
+        self.compiled = None
+        self.fields = [FieldStats() for _ in ezs.fields]
+        self._labels = [_label(index, the_field)
+                        for index, the_field in enumerate(ezs.fields)]
+        steps = plan.compile_field_steps(ezs.byte_order, ezs.fields)
+        self.steps = [_InstrumentedStep(step, field_stats)
+                      for step, field_stats in zip(steps, self.fields)]
+
+    def reset(self):
+        """Sets every counter back to zero."""
+        for field_stats in self.fields:
+            field_stats.reset()
+
+    def snapshot(self):
+        """A dict mapping each field's name to a dict of its counters.
+
+        Unnamed fields are reported as ``"[N]"``, where ``N`` is the
+        field's position in the structure.
+        """
+        return dict((label, field_stats.snapshot())
+                    for label, field_stats in zip(self._labels, self.fields))
+
+
+class _CountingTransform(field_transform.FieldTransform):
+    """Wraps a value transform, counting calls to it."""
+
+    def __init__(self, transform, field_stats):
+        def pack_fn(val):
+            field_stats.transform_calls += 1
+            return transform.pack(val)
+
+        def unpack_fn(val):
+            field_stats.transform_calls += 1
+            return transform.unpack(val)
+        field_transform.FieldTransform.__init__(
+            self, pack_fn, unpack_fn, element_wise=transform.element_wise)
+
+
+class _CountingReader(object):
+    """Wraps an :py:mod:`io` buffer, counting the bytes consumed from it."""
+
+    def __init__(self, buf):
+        self._buf = buf
+        self.count = 0
+        if hasattr(buf, "peek"):
+            self.peek = buf.peek
+
+    def read(self, size=-1):  # pylint: disable=missing-docstring
+        data = self._buf.read(size)
+        self.count += len(data)
+        return data
+
+    def seekable(self):  # pylint: disable=missing-docstring
+        return self._buf.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):  # pylint: disable=missing-docstring
+        # Only used by read_delimited, to step back over unused data.
+        assert whence == io.SEEK_CUR
+        self.count += offset
+        return self._buf.seek(offset, whence)
+
+
+def _count_calls(transform_fn, field_stats):
+    def counted(val):
+        field_stats.transform_calls += 1
+        return transform_fn(val)
+    return counted
+
+
+def _count_scans(value_fn, field_stats):
+    def counted(*args):
+        field_stats.delimiter_scans += 1
+        return value_fn(*args)
+    return counted
+
+
+class _InstrumentedStep(object):
+    """A plan step for a single field, which updates its ``FieldStats``."""
+
+    def __init__(self, step, field_stats):
+        self._step = step
+        self._stats = field_stats
+        self.size = step.size
+
+        # Field steps look up their per-value functions and transform
+        # through instance attributes, so those can be replaced here
+        # without affecting any other plan.  The field's own transform is
+        # wrapped beneath any per-element or bitfield conversion, so that
+        # each value is counted, and bitfields aren't.
+        if (getattr(step, "_transform", None) is not None and
+                step.field.value_transform is not None):
+            step._transform = plan.value_transform(  # pylint: disable=protected-access
+                step.field,
+                _CountingTransform(step.field.value_transform, field_stats))
+        # Element-wise transforms of fixed-size fields are applied by the
+        # run's adapter for the field, which is wrapped the same way.
+        for member in getattr(step, "_pack_members", ()):
+            folded = member[-1]
+            if isinstance(folded, plan._FoldedTransform):  # pylint: disable=protected-access
+                # pylint: disable=protected-access
+                folded._pack = _count_calls(folded._pack, field_stats)
+                folded._unpack = _count_calls(folded._unpack, field_stats)
+        if getattr(step, "_delimiter", None) is not None:
+            # pylint: disable=protected-access
+            step._unpack_value = _count_scans(step._unpack_value, field_stats)
+            step._unpack_value_from = _count_scans(step._unpack_value_from,
+                                                   field_stats)
+
+    def pack(self, data, out):  # pylint: disable=missing-docstring
+        stats = self._stats
+        start = timeit.default_timer()
+        first = len(out)
+        self._step.pack(data, out)
+        stats.pack_time += timeit.default_timer() - start
+        stats.pack_calls += 1
+        stats.bytes_packed += sum(len(chunk) for chunk in out[first:])
+
+    def pack_into(self, data, buffer, offset):  # pylint: disable=missing-docstring
+        stats = self._stats
+        start = timeit.default_timer()
+        end = self._step.pack_into(data, buffer, offset)
+        stats.pack_time += timeit.default_timer() - start
+        stats.pack_calls += 1
+        stats.bytes_packed += end - offset
+        return end
+
+    def packed_size(self, data):  # pylint: disable=missing-docstring
+        return self._step.packed_size(data)
+
+    def unpack(self, buf, ret):  # pylint: disable=missing-docstring
+        stats = self._stats
+        start = timeit.default_timer()
+        reader = _CountingReader(buf)
+        self._step.unpack(reader, ret)
+        stats.unpack_time += timeit.default_timer() - start
+        stats.unpack_calls += 1
+        stats.bytes_unpacked += reader.count
+
+    def unpack_from(self, buffer, offset, ret):  # pylint: disable=missing-docstring
+        stats = self._stats
+        start = timeit.default_timer()
+        end = self._step.unpack_from(buffer, offset, ret)
+        stats.unpack_time += timeit.default_timer() - start
+        stats.unpack_calls += 1
+        stats.bytes_unpacked += end - offset
+        return end
+
+    def skip_from(self, buffer, offset, ret):  # pylint: disable=missing-docstring
+        return self._step.skip_from(buffer, offset, ret)
+
+    def unpack_requests(self, ret):  # pylint: disable=missing-docstring
+        # Time spent here mostly depends on the caller's I/O, so only
+        # calls and bytes are counted.
+        stats = self._stats
+        requests = self._step.unpack_requests(ret)
+        data = None
+        try:
+            while True:
+                if data is None:
+                    request = next(requests)
+                else:
+                    stats.bytes_unpacked += len(data)
+                    request = requests.send(data)
+                if request[1] is not None:
+                    stats.delimiter_scans += 1
+                data = yield request
+        except StopIteration:
+            stats.unpack_calls += 1
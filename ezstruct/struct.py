@@ -1,13 +1,25 @@
 """Top-level structure objects."""
 from __future__ import absolute_import
 
+from . import aio
 from . import byte_order
-from . import delimiter
+from . import codegen
+from . import decode_cache
 from . import errors
 from . import field
+from . import numpy_support
+from . import plan
+from . import record
+from . import stats
+from . import view
 
-import collections
 import io
+import mmap
+import struct
+
+
+# Bytes read at a time by iter_unpack for fixed-size structures.
+_ITER_CHUNK_SIZE = 64 * 1024
 
 
 class Struct(object):
@@ -17,26 +29,253 @@ class Struct(object):
     data to a sequence of bytes, and *unpacked*, converting from bytes
     to dict.
 
+    A ``Struct`` can be pickled if its length functions and value
+    transforms can be, i.e. if they aren't lambdas or nested functions.
+
     Args:
       ``order``:
         Byte order for multi-byte numeric fields.  See
         :py:mod:`ezstruct.byte_order` for possible values.
 
       ``fields``: List of :py:class:`ezstruct.Field`.
+
+      ``codegen``:
+        If true, :py:meth:`compile` the structure immediately.  If
+        ``"lazy"``, compile it when it's first used, or by
+        :py:meth:`warm_up`.
+
+      ``code_cache``:
+        A directory in which to keep the structure's compiled code, so
+        that other processes can load it rather than compiling it again.
+        Only use a directory which nobody else can write to, as with
+        ``.pyc`` files.
     """
 
-    def __init__(self, order, *fields):
+    def __init__(self, order, *fields, **kwargs):
+        codegen = kwargs.pop("codegen", False)
+        self._code_cache = kwargs.pop("code_cache", None)
+        assert not kwargs, "Unexpected arguments: %r" % kwargs
+        assert codegen in (True, False, "lazy")
+
         self.byte_order = byte_order.get(order)
 
         for the_field in fields:
             assert isinstance(the_field, field.Field)
         self.fields = fields
+        self._plan = None
+        self._view_layout = None
+        self._record_class = None
+        self._frozen_record_class = None
+        self._decode_cache = None
+        self._stats = None
+        self._compiled = None
+        self._lazy_codegen = codegen == "lazy"
+        if codegen is True:
+            self.compile()
+
+    def __getstate__(self):
+        # Plans and generated code can't be pickled; they're rebuilt when
+        # the structure is next used.  Nor can the decode cache, which
+        # isn't kept.
+        state = self.__dict__.copy()
+        state.update(_plan=None,
+                     _view_layout=None,
+                     _record_class=None,
+                     _frozen_record_class=None,
+                     _decode_cache=None,
+                     _stats=None,
+                     _compiled=(self._compiled is not None or
+                                (self._stats is not None and
+                                 self._stats.compiled is not None)))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._compiled:
+            self._compiled = None
+            self.compile()
+        else:
+            self._compiled = None
 
     def __str__(self):
         return "<EzStruct %s: [%s]>" % (self.byte_order,
                                         ", ".join([str(f)
                                                    for f in self.fields]))
 
+    def schema_key(self):
+        """A hashable description of the structure's definition.
+
+        See :py:meth:`ezstruct.Field.schema_key`.
+        """
+        return (str(self.byte_order),
+                tuple(the_field.schema_key() for the_field in self.fields))
+
+    def compile(self):
+        """Generates specialized pack and unpack functions for this structure.
+
+        After this is called, :py:meth:`pack`, :py:meth:`pack_bytes`,
+        :py:meth:`unpack` and :py:meth:`unpack_bytes` use straight-line
+        code generated for this structure's fields.  Structures with
+        identical definitions share the generated code.
+
+        Returns:
+          A :py:class:`ezstruct.codegen.CompiledStruct`; its ``source``
+          attribute holds the generated code.
+        """
+        if self._stats is not None:
+            # Generated code isn't instrumented, so it's kept aside until
+            # disable_stats is called.
+            if self._stats.compiled is None:
+                self._stats.compiled = codegen.compile_struct(
+                    self, self._code_cache)
+            return self._stats.compiled
+        if self._compiled is None:
+            self._compiled = codegen.compile_struct(self, self._code_cache)
+        return self._compiled
+
+    def warm_up(self):
+        """Does the work otherwise put off until the structure is first used.
+
+        This builds the structure's plan, and compiles it if it was made
+        with ``codegen="lazy"``.  Calling it for each structure before
+        handling any data avoids a delay on the first one of each.
+        """
+        self._get_plan()
+        if self._lazy_codegen:
+            self.compile()
+
+    def enable_stats(self):
+        """Starts counting calls, bytes and time for each field.
+
+        While this is on, fields are packed and unpacked one at a time,
+        rather than in coalesced runs or with generated code, so that
+        each can be measured.  When it's off, none of this costs
+        anything.  :py:meth:`view` isn't instrumented.
+
+        See :py:meth:`stats_snapshot`.
+        """
+        if self._stats is None:
+            self._stats = stats.Stats(self)
+            self._stats.compiled = self._compiled
+            self._compiled = None
+            self._plan = self._stats.steps
+
+    def disable_stats(self):
+        """Stops counting, and discards the counters."""
+        if self._stats is not None:
+            self._compiled = self._stats.compiled
+            self._plan = None
+            self._stats = None
+
+    def reset_stats(self):
+        """Sets every counter back to zero."""
+        if self._stats is not None:
+            self._stats.reset()
+
+    def stats_snapshot(self):
+        """The counters kept since :py:meth:`enable_stats` was called.
+
+        Returns:
+          ``None`` if stats aren't enabled.  Otherwise, a dict mapping
+          each field's name to a dict of its counters; see
+          :py:class:`ezstruct.stats.FieldStats`.  Unnamed fields are
+          reported as ``"[N]"``, where ``N`` is the field's position in
+          the structure.
+        """
+        if self._stats is None:
+            return None
+        return self._stats.snapshot()
+
+    def enable_decode_cache(self, max_entries=1024, max_bytes=1 << 20):
+        """Keeps the results of :py:meth:`unpack_bytes`, keyed by its input.
+
+        This suits structures which are often unpacked from identical
+        bytes, such as heartbeat or status messages.  While it's on,
+        :py:meth:`unpack_bytes` returns instances of
+        :py:meth:`frozen_record_class`, which can safely be shared
+        between callers, and repeated inputs aren't unpacked again,
+        whether or not ``as_record`` is given.  Other methods aren't
+        affected.  Calling this again replaces the
+        cache with an empty one.
+
+        Args:
+          ``max_entries``: The most results to keep.
+
+          ``max_bytes``:
+            Roughly the most memory the results and their keys may take
+            up.  Least recently used results are evicted to stay within
+            both limits.
+
+        See :py:meth:`decode_cache_info`.
+        """
+        self._decode_cache = decode_cache.DecodeCache(self, max_entries,
+                                                      max_bytes)
+
+    def disable_decode_cache(self):
+        """Stops caching, and discards the cache."""
+        self._decode_cache = None
+
+    def decode_cache_info(self):
+        """The counters of the cache made by :py:meth:`enable_decode_cache`.
+
+        Returns:
+          ``None`` if the cache isn't enabled.  Otherwise, a dict of the
+          numbers of ``hits``, ``misses``, ``evictions``, ``uncached``
+          results (too large to keep), the ``entries`` and ``bytes``
+          currently kept, and the ``hit_rate``; see
+          :py:class:`ezstruct.decode_cache.DecodeCache`.
+        """
+        if self._decode_cache is None:
+            return None
+        return self._decode_cache.info()
+
+    def calcsize(self):
+        """The packed size of the structure, like :py:func:`struct.calcsize`.
+
+        Raises:
+          :py:class:`ezstruct.errors.VariableLength` if the size depends
+          on the data being packed.
+        """
+        size = 0
+        for step in self._get_plan():
+            if step.size is None:
+                raise errors.VariableLength(self)
+            size += step.size
+        return size
+
+    def packed_size(self, data):
+        """The number of bytes ``data`` takes up when packed.
+
+        This accounts for length prefixes, count prefixes and
+        delimiters, without serializing ``data``.
+        """
+        return sum(step.packed_size(data) for step in self._get_plan())
+
+    def pack_into(self, buffer, offset, data):
+        """Serialize ``data`` directly into a writable buffer.
+
+        Args:
+          ``buffer``:
+            A writable buffer, such as a ``bytearray``, ``memoryview``
+            or ``mmap``.  It is not resized.
+
+          ``offset``: Where in ``buffer`` to start writing.
+
+          ``data``: The data to pack.
+
+        Returns:
+          The number of bytes written.
+
+        Raises:
+          :py:class:`struct.error` if ``buffer`` is too small.
+        """
+        if isinstance(buffer, memoryview) and buffer.format != "B":
+            buffer = buffer.cast("B")
+        end = offset
+        for step in self._get_plan():
+            end = step.pack_into(data, buffer, end)
+        return end - offset
+
     def pack_bytes(self, data):
         """Serialize ``data`` into a new ``bytes``.
 
@@ -46,146 +285,349 @@ class Struct(object):
         Returns:
           A ``bytes`` containing the packed representation of ``data``.
         """
-        raw = io.BytesIO()
-        buf = io.BufferedWriter(raw)
-        self.pack(data, buf)
-        buf.flush()
-        return raw.getvalue()
+        if self._compiled is not None:
+            return self._compiled.pack(data)
+        return b"".join(self._pack_chunks(data))
 
     def pack(self, data, buf):
         """Serialize ``data`` into an IO buffer.
 
         Args:
-          ``data``: The data to pack.
+          ``data``:
+            The data to pack: a dict, or an instance of
+            :py:meth:`record_class`.
+
           ``buf``: An :py:mod:`io` buffer to write the packed data to.
         """
-        for the_field in self.fields:
-            vals = the_field.get_values_for_pack(data)
-
-            if the_field.value_transform:
-                vals = the_field.value_transform.pack(vals)
-
-            if the_field.repeat == 1:
-                vals = (vals, )
-            elif isinstance(the_field.repeat, int):
-                assert len(vals) == the_field.repeat
-            else:
-                the_field.repeat.pack(self.byte_order, len(vals), buf)
-
-            for val in vals:
-                if isinstance(the_field.length, field.Field):
-                    the_field.length.pack(self.byte_order, len(val), buf)
-                elif isinstance(the_field.length, int):
-                    assert len(val) == the_field.length
-                elif isinstance(the_field.length, collections.Callable):
-                    fn_len = the_field.length(data)
-                    val_len = len(val)
-                    if fn_len != val_len:
-                        raise errors.InconsistentLength(the_field,
-                                                        fn_len,
-                                                        val_len)
-
-                the_field.pack(self.byte_order, val, buf)
-
-                if isinstance(the_field.length, delimiter.Delimiter):
-                    buf.write(the_field.length.delimiter)
-
-    def unpack_bytes(self, the_bytes):
+        buf.write(self.pack_bytes(data))
+
+    def _pack_chunks(self, data):
+        if self._compiled is not None:
+            return [self._compiled.pack(data)]
+        out = []
+        for step in self._get_plan():
+            step.pack(data, out)
+        return out
+
+    def pack_columns(self, columns):
+        """Serialize many records, given column by column, into a ``bytes``.
+
+        For structures with a fixed layout (see
+        :py:meth:`to_numpy_dtype`), the columns are packed in bulk with
+        NumPy, if it's installed.  Otherwise, or if a column has values
+        NumPy would store differently, e.g. because they're out of
+        range or have the wrong length, each record is packed in turn,
+        as with :py:meth:`pack_bytes`, which raises the usual errors.
+
+        Args:
+          ``columns``:
+            A dict mapping field names to equal-length sequences or
+            NumPy arrays of values.  Fields missing from it get their
+            ``default_pack_value``.
+
+        Returns:
+          A ``bytes`` containing the packed records, one after another.
+        """
+        return numpy_support.pack_columns(self, columns)
+
+    def pack_array(self, array):
+        """Serialize each record of a NumPy structured array.
+
+        ``array``'s fields are matched to the structure's by name, so
+        ``array`` can be the result of :py:meth:`unpack_array`, or have
+        any other dtype with the right field names.  See
+        :py:meth:`pack_columns`.
+        """
+        return numpy_support.pack_array(self, array)
+
+    def pack_to_transport(self, writer, records):
+        """Serialize many structures to an ``asyncio.StreamWriter``.
+
+        All of the packed data is handed to the writer in a single
+        ``writelines`` call, and then the writer is drained, so that
+        this waits whenever the transport's buffer is full.
+
+        Args:
+          ``writer``: The ``asyncio.StreamWriter``.
+          ``records``: An iterable of data to pack.
+
+        Returns:
+          A coroutine, whose result is the number of bytes written.
+        """
+        return aio.pack(self, writer, records)
+
+    def record_class(self):
+        """Returns a compact class for this structure's unpacked data.
+
+        The class is a :py:class:`ezstruct.record.Record`, with a slot,
+        instead of a dict entry, for each named field.  It's made the
+        first time this is called.  Unpacking methods build instances of
+        it when called with ``as_record=True``, and :py:meth:`pack`
+        accepts them in place of dicts.
+        """
+        if self._record_class is None:
+            self._record_class = record.make_record_class(self)
+        return self._record_class
+
+    def frozen_record_class(self):
+        """Like :py:meth:`record_class`, but for a :py:class:`ezstruct.record.FrozenRecord`.
+
+        Instances can be built from an unpacked dict ``data`` with
+        ``cls(**data)``.
+        """
+        if self._frozen_record_class is None:
+            self._frozen_record_class = record.make_record_class(
+                self, "FrozenRecord", frozen=True)
+        return self._frozen_record_class
+
+    def _new_result(self, as_record):
+        if as_record:
+            return self.record_class()()
+        return {}
+
+    def unpack_bytes(self, the_bytes, as_record=False):
         """Unserialize data from a ``bytes``.
 
         Args:
           ``the_bytes``: The byte sequence to unpack.
 
+          ``as_record``:
+            If true, return an instance of :py:meth:`record_class`.
+            It's ignored while the decode cache is on, since the cache
+            always returns frozen records.
+
         Returns:
-          A dict containing the unpacked data.
+          A dict containing the unpacked data, or a frozen record if
+          :py:meth:`enable_decode_cache` was called.
         """
-        raw = io.BytesIO(the_bytes)
-        buf = io.BufferedReader(raw)
-        return self.unpack(buf)
+        if self._decode_cache is not None:
+            return self._decode_cache.unpack_bytes(the_bytes)
+        return self.unpack_from(the_bytes, as_record=as_record)[0]
 
-    def unpack(self, buf):
-        """Unserialize data from an IO buffer.
+    def unpack_from(self, buffer, offset=0, as_record=False):
+        """Unserialize data from a buffer, starting at ``offset``.
+
+        Values are read in place, without wrapping ``buffer`` in a
+        stream, so this can be used to walk through a large buffer of
+        consecutive structures.
 
         Args:
-          ``buf``: An :py:mod:`io` buffer containing data to unpack.
+          ``buffer``:
+            A ``bytes``, ``bytearray``, ``memoryview``, ``mmap``, or
+            anything else supporting the buffer protocol and slicing.
+
+          ``offset``: Where in ``buffer`` the packed structure starts.
+
+          ``as_record``:
+            If true, return an instance of :py:meth:`record_class`.
 
         Returns:
-          A dict containing the unpacked data.
+          A ``(data, size)`` tuple of the dict containing the unpacked
+          data and the number of bytes of ``buffer`` it took up.
         """
-        assert isinstance(buf, io.BufferedIOBase)
-        assert buf.readable()
+        if isinstance(buffer, memoryview) and buffer.format != "B":
+            buffer = buffer.cast("B")
+
+        if self._compiled is not None and not as_record:
+            ret, end = self._compiled.unpack_from(buffer, offset)
+            return ret, end - offset
+        ret = self._new_result(as_record)
+        end = offset
+        for step in self._get_plan():
+            end = step.unpack_from(buffer, end, ret)
+        return ret, end - offset
+
+    def view(self, buffer, offset=0):
+        """Returns a view of the structure in ``buffer`` which unpacks lazily.
+
+        Nothing is unpacked until a field is looked up; then only that
+        field is, along with any length or count prefixes needed to find
+        it.  This is cheaper than :py:meth:`unpack_from` when only a few
+        fields of a structure are used.
 
-        ret = {}
-        for the_field in self.fields:
-            vals = self._unpack_field(buf, the_field, ret)
-            if the_field.name:
-                ret[the_field.name] = vals
-        return ret
+        Args:
+          ``buffer``: A buffer, as accepted by :py:meth:`unpack_from`.
+          ``offset``: Where in ``buffer`` the packed structure starts.
 
-    def _unpack_field(self, buf, the_field, unpacked_fields):
-        """Unserialize data for a single field.
+        Returns:
+          A :py:class:`ezstruct.view.StructView`.
+        """
+        if isinstance(buffer, memoryview) and buffer.format != "B":
+            buffer = buffer.cast("B")
+        if self._view_layout is None:
+            self._view_layout = view.Layout(
+                self, plan.compile_field_steps(self.byte_order, self.fields))
+        return view.StructView(self._view_layout, buffer, offset)
+
+    def iter_unpack(self, source, as_record=False):
+        """Unserialize consecutive structures until the input runs out.
+
+        Only one structure is held in memory at a time, however large
+        the input is.
 
         Args:
-          ``buf``: An :py:mod:`io` buffer.
-          ``the_field``: The field to unpack.
-          ``unpacked_fields``: Dictionary containing data unpacked so far.
+          ``source``:
+            Either a buffer, as accepted by :py:meth:`unpack_from`, or
+            an :py:mod:`io` buffer, which is read to its end.
+
+          ``as_record``:
+            If true, yield instances of :py:meth:`record_class`.
 
         Returns:
-          The value (or values, for repeated fields), with
-          transformations applied.
+          A generator of dicts containing the unpacked data.  It stops
+          cleanly if the input ends between two structures, and raises
+          :py:class:`ezstruct.errors.TruncatedRecord` if the input ends
+          partway through one.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            return self._iter_unpack_buffer(source, as_record)
+        return self._iter_unpack_stream(source, as_record)
+
+    def _iter_unpack_buffer(self, buffer, as_record):
+        if isinstance(buffer, memoryview) and buffer.format != "B":
+            buffer = buffer.cast("B")
+        end = len(buffer)
+
+        run = plan.single_run(self._get_plan())
+        if run is not None:
+            whole = end - end % run.size
+            for vals in run.struct.iter_unpack(memoryview(buffer)[:whole]):
+                ret = self._new_result(as_record)
+                run.store(vals, ret)
+                yield ret
+            if whole != end:
+                raise errors.TruncatedRecord(whole // run.size)
+            return
+
+        offset = 0
+        count = 0
+        while offset < end:
+            try:
+                ret, size = self.unpack_from(buffer, offset, as_record)
+            except (struct.error, errors.DelimiterNotFound):
+                raise errors.TruncatedRecord(count)
+            yield ret
+            offset += size
+            count += 1
+
+    def _iter_unpack_stream(self, buf, as_record):
+        run = plan.single_run(self._get_plan())
+        if run is not None:
+            # Read many structures at a time, carrying any partial
+            # structure over into the next read.
+            chunk_size = max(1, _ITER_CHUNK_SIZE // run.size) * run.size
+            count = 0
+            pending = b""
+            while True:
+                data = buf.read(chunk_size)
+                if not data:
+                    if pending:
+                        raise errors.TruncatedRecord(count)
+                    return
+                if pending:
+                    data = pending + data
+                whole = len(data) - len(data) % run.size
+                for vals in run.struct.iter_unpack(memoryview(data)[:whole]):
+                    ret = self._new_result(as_record)
+                    run.store(vals, ret)
+                    yield ret
+                count += whole // run.size
+                pending = data[whole:]
+
+        if not hasattr(buf, "peek"):
+            buf = io.BufferedReader(buf)
+        count = 0
+        while buf.peek(1):
+            try:
+                ret = self.unpack(buf, as_record)
+            except (struct.error, errors.DelimiterNotFound):
+                raise errors.TruncatedRecord(count)
+            yield ret
+            count += 1
+
+    def to_numpy_dtype(self):
+        """Returns the NumPy structured dtype with this structure's layout.
+
+        Only structures whose fields all have a fixed layout, i.e. numeric
+        and ``BOOL`` fields and ``BYTES`` with an ``int`` length, repeated
+        a fixed number of times and without value transforms, have one.
+        Unnamed fields become padding.
+
+        Raises:
+          ``ImportError`` if NumPy isn't installed.
+
+          :py:class:`ezstruct.errors.IncompatibleField` if the structure
+          doesn't have a fixed layout.
         """
+        return numpy_support.to_dtype(self)
 
-        repeat = the_field.repeat
-        if isinstance(repeat, field.Field):
-            repeat = the_field.repeat.unpack(self.byte_order, buf)
+    def unpack_array(self, buffer, offset=0, count=-1):
+        """Unserialize many consecutive structures at once with NumPy.
 
-        vals = []
-        for _ in range(repeat):
-            val = self._unpack_field_instance(buf, the_field, unpacked_fields)
-            vals.append(val)
-            if isinstance(the_field.length, delimiter.Delimiter):
-                buf.seek(1, io.SEEK_CUR)
-        if the_field.repeat == 1:
-            vals = vals[0]
+        The result is a view of ``buffer``; nothing is copied.
 
-        if the_field.value_transform:
-            vals = the_field.value_transform.unpack(vals)
+        Args:
+          ``buffer``: Any object supporting the buffer protocol.
+          ``offset``: Where in ``buffer`` the first structure starts.
+
+          ``count``:
+            The number of structures to unpack.  By default, all of
+            ``buffer`` after ``offset`` is unpacked.
 
-        return vals
+        Returns:
+          A NumPy structured array with :py:meth:`to_numpy_dtype`.
 
-    def _unpack_field_instance(self, buf, the_field, unpacked_fields):
-        """Unserialize data for a single repetition of a field.
+        Raises:
+          :py:class:`ezstruct.errors.TruncatedRecord` if ``buffer``
+          doesn't hold a whole number of structures, or fewer than
+          ``count`` of them.
+        """
+        return numpy_support.unpack_array(self, buffer, offset, count)
+
+    def unpack_async(self, reader):
+        """Unserialize data from an ``asyncio.StreamReader``.
+
+        Fixed-size values and length-prefixed values are read with
+        ``readexactly``, and delimited values with ``readuntil``, so
+        nothing past the structure is consumed.
 
         Args:
-          ``buf``: An :py:mod:`io` buffer.
-          ``the_field``: The field to unpack.
-          ``unpacked_fields``: Dictionary containing data unpacked so far.
+          ``reader``: The ``asyncio.StreamReader``.
 
         Returns:
-          The value, *without* transformations applied.
+          A coroutine, whose result is a dict containing the unpacked
+          data.  It raises ``asyncio.IncompleteReadError`` if the
+          stream ends partway through the structure.
         """
+        return aio.unpack(self, reader)
 
-        if isinstance(the_field.length, delimiter.Delimiter):
-            assert buf.seekable()
-            pos = buf.tell()
-            while True:
-                char = buf.read(1)
-                if char == b"":
-                    raise errors.DelimiterNotFound(
-                        the_field.length.delimiter)
-                elif char == the_field.length.delimiter:
-                    break
-            val_len = buf.tell() - pos - 1
-            buf.seek(pos, io.SEEK_SET)
-        elif isinstance(the_field.length, field.Field):
-            val_len = the_field.length.unpack(self.byte_order, buf)
-        elif isinstance(the_field.length, int):
-            val_len = the_field.length
-        elif isinstance(the_field.length, collections.Callable):
-            val_len = the_field.length(unpacked_fields)
-        else:
-            assert the_field.length is None
-            val_len = None
+    def unpack(self, buf, as_record=False):
+        """Unserialize data from an IO buffer.
+
+        Args:
+          ``buf``: An :py:mod:`io` buffer containing data to unpack.
+
+          ``as_record``:
+            If true, return an instance of :py:meth:`record_class`.
+
+        Returns:
+          A dict containing the unpacked data.
+        """
+        assert isinstance(buf, io.BufferedIOBase)
+        assert buf.readable()
+
+        if self._compiled is not None and not as_record:
+            return self._compiled.unpack(buf)
+        ret = self._new_result(as_record)
+        for step in self._get_plan():
+            step.unpack(buf, ret)
+        return ret
 
-        val = the_field.unpack(self.byte_order, buf, length=val_len)
-        return val
+    def _get_plan(self):
+        """Returns the compiled plan, building it on first use."""
+        if self._plan is None:
+            self._plan = plan.compile_plan(self.byte_order, self.fields)
+            if self._lazy_codegen:
+                # Later calls will use the generated code instead.
+                self.compile()
+        return self._plan
@@ -0,0 +1,147 @@
+"""Lazily-decoded views of packed structures."""
+from __future__ import absolute_import
+
+from . import field
+
+
+class Layout(object):
+    """What a :py:class:`StructView` needs to know about a structure.
+
+    Args:
+      ``ezs``: The :py:class:`ezstruct.Struct`.
+      ``steps``: One plan step per field.
+    """
+
+    def __init__(self, ezs, steps):
+        self.steps = steps
+        self.names = [the_field.name for the_field in ezs.fields]
+        self.index = dict((the_field.name, i)
+                          for i, the_field in enumerate(ezs.fields)
+                          if the_field.name)
+        # The offsets of the fields which follow only fixed-size fields,
+        # relative to the start of the structure, then of its end if the
+        # structure has a fixed size.
+        self.static_offsets = [0]
+        for step in steps:
+            if step.size is None:
+                break
+            self.static_offsets.append(self.static_offsets[-1] + step.size)
+
+
+class _Scratch(dict):
+    """Receives one unpacked field, and looks up any others in the view.
+
+    This is what a field's length function sees as the data unpacked
+    so far.
+    """
+    __slots__ = ("_view", )
+
+    def __init__(self, view):
+        dict.__init__(self)
+        self._view = view
+
+    def __missing__(self, key):
+        return self._view[key]
+
+
+class StructView(object):
+    """A packed structure whose fields are unpacked when they're used.
+
+    Fields are looked up by name, either as items or as attributes.  The
+    first lookup of a field unpacks it, and applies its
+    :py:class:`ezstruct.FieldTransform`; the value is cached for later
+    lookups.  Fields which aren't looked up are only skipped over, if
+    they precede one which is, and a field's position is only worked out
+    the first time a later field is needed::
+
+      message = header.view(packet)
+      if message.type == ROUTE:
+          forward(message["destination"], message.payload)
+
+    Views are made by :py:meth:`ezstruct.Struct.view`.  The buffer must
+    not change while a view of it is in use.  Fields named like one of
+    the view's methods can only be looked up as items.
+
+    Raises:
+      The same exceptions as :py:meth:`ezstruct.Struct.unpack_from`,
+      but only once the field they're about is used.
+    """
+    __slots__ = ("_layout", "_buffer", "_offsets", "_values")
+
+    def __init__(self, layout, buffer, offset):
+        self._layout = layout
+        self._buffer = buffer
+        # The offset of each field found so far, then of the end of the
+        # structure, once it is known.
+        self._offsets = [offset + static for static in layout.static_offsets]
+        self._values = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        index = self._layout.index[name]
+        scratch = _Scratch(self)
+        offset = self._offset(index)
+        end = self._layout.steps[index].unpack_from(self._buffer,
+                                                    offset,
+                                                    scratch)
+        if len(self._offsets) == index + 1:
+            self._offsets.append(end)
+        val = self._values[name] = dict.__getitem__(scratch, name)
+        return val
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            # Keeps lookups of unset slots from recursing.
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self._layout.index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return "<StructView %s>" % ", ".join(
+            "%s=%r" % (name, self._values[name]) if name in self._values
+            else name
+            for name in self.keys())
+
+    def get(self, name, default=None):
+        """Like ``dict.get``."""
+        if name in self._layout.index:
+            return self[name]
+        return default
+
+    def keys(self):
+        """The names of the structure's fields."""
+        return [name for name in self._layout.names if name]
+
+    def to_dict(self):
+        """Unpacks every field, and returns them like :py:meth:`ezstruct.Struct.unpack`."""
+        return dict((name, self[name]) for name in self.keys())
+
+    @property
+    def size(self):
+        """The number of bytes the structure takes up in the buffer."""
+        size = self._offset(len(self._layout.steps)) - self._offsets[0]
+        if self._offsets[-1] > len(self._buffer):
+            field.short_read(size)
+        return size
+
+    def _offset(self, index):
+        """The offset of field ``index``, finding it if necessary."""
+        offsets = self._offsets
+        steps = self._layout.steps
+        while len(offsets) <= index:
+            last = len(offsets) - 1
+            offsets.append(steps[last].skip_from(self._buffer,
+                                                 offsets[last],
+                                                 _Scratch(self)))
+        return offsets[index]
@@ -20,7 +20,8 @@ setup(
     author_email='matthewg@zevils.com',
     packages=find_packages(exclude=['tests*']),
     include_package_data=False,
-    install_requires=['six'],
+    python_requires='>=3.7',
+    extras_require={'numpy': ['numpy']},
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
@@ -28,10 +29,9 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
 )
@@ -1,18 +1,51 @@
+import array
 import ezstruct
 import ezstruct.errors
-import six
+import ezstruct.parallel
+import gc
+import io
+import mmap
+import os
+import shutil
+import socket
+import struct
 import sys
+import tempfile
 import unicodedata
 import unittest
 
-class EzStructTest(unittest.TestCase):
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Looked up by name by test_parallel's worker processes, since its
+# length function can't be pickled.
+PARALLEL_STRUCT = ezstruct.Struct(
+    "NET_ENDIAN",
+    ezstruct.Field("UINT8", name="n"),
+    ezstruct.Field("BYTES", name="b", length=lambda data: data["n"]))
 
-    if six.PY2:
-        assertRaisesRegex = unittest.TestCase.assertRaisesRegexp
+# Values unpacked by the current process, to check that test_parallel's
+# parent process only finds where records start.
+PARALLEL_UNPACKED = []
+COUNTED_STRUCT = ezstruct.Struct(
+    "NET_ENDIAN",
+    ezstruct.Field("BYTES", name="b", length=ezstruct.Field("UINT8"),
+                   value_transform=ezstruct.FieldTransform(
+                       lambda val: val,
+                       lambda val: PARALLEL_UNPACKED.append(val) or val)))
+
+class EzStructTest(unittest.TestCase):
 
     def roundTrip(self, ezs, packed, unpacked):
-        self.assertEqual(packed, ezs.pack_bytes(unpacked))
-        self.assertEqual(unpacked, ezs.unpack_bytes(packed))
+        compiled = ezstruct.Struct(str(ezs.byte_order), *ezs.fields,
+                                   codegen=True)
+        for the_struct in (ezs, compiled):
+            self.assertEqual(packed, the_struct.pack_bytes(unpacked))
+            self.assertEqual(unpacked, the_struct.unpack_bytes(packed))
+            self.assertEqual(unpacked,
+                             the_struct.unpack(io.BufferedReader(io.BytesIO(packed))))
 
     def test_str(self):
         ezs = ezstruct.Struct("NET_ENDIAN",
@@ -223,6 +256,1107 @@ class EzStructTest(unittest.TestCase):
                                {"foo_len": 5,
                                 "foo": b"abc"})
 
+    def test_coalesced_fields(self):
+        ezs = ezstruct.Struct(
+            "LITTLE_ENDIAN",
+            ezstruct.Field("UINT16", name="a"),
+            ezstruct.Field("UINT8", default_pack_value=7),
+            ezstruct.Field("SINT8", name="b", repeat=2),
+            ezstruct.Field("BYTES", name="c", length=2, repeat=2),
+            ezstruct.Field("STRING", name="d", string_encoding="utf-8",
+                           length=ezstruct.Field("UINT8")),
+            ezstruct.Field("BOOL", name="e"),
+            ezstruct.Field("DOUBLE", name="f"))
+        # Everything before the string is one run, as is everything after it.
+        self.assertEqual(3, len(ezs._get_plan()))
+        self.roundTrip(ezs,
+                       (b"\x34\x12\x07\xFF\x01abcd"
+                        b"\x03\xC3\xB6x"
+                        b"\x01\x00\x00\x00\x00\x00\x00\xF0\x3F"),
+                       {"a": 0x1234,
+                        "b": [-1, 1],
+                        "c": [b"ab", b"cd"],
+                        "d": u"\u00F6x",
+                        "e": True,
+                        "f": 1.0})
+
+    def test_codegen(self):
+        fields = [ezstruct.Field("UINT8", name="a"),
+                  ezstruct.Field("BYTES", name="b",
+                                 length=ezstruct.Field("UINT8"),
+                                 repeat=ezstruct.Field("UINT8"))]
+        ezs = ezstruct.Struct("NET_ENDIAN", *fields)
+        compiled = ezs.compile()
+        self.assertIn("def pack(data):", compiled.source)
+        self.assertIn("def unpack(buf):", compiled.source)
+        self.assertNotIn("self.fields", compiled.source)
+        self.assertIs(compiled,
+                      ezstruct.Struct("NET_ENDIAN", *fields).compile())
+        self.assertIsNot(compiled,
+                         ezstruct.Struct("LITTLE_ENDIAN", *fields).compile())
+        # Code is only kept while a structure uses it.
+        key = ezs.schema_key()
+        self.assertIn(key, ezstruct.codegen._COMPILED)  # pylint: disable=protected-access
+        del ezs, compiled
+        gc.collect()
+        self.assertNotIn(key, ezstruct.codegen._COMPILED)  # pylint: disable=protected-access
+        ezs = ezstruct.Struct("NET_ENDIAN", *fields)
+        compiled = ezs.compile()
+
+        # Structures whose keys can't be hashed are compiled unshared.
+        class Length(object):
+            __hash__ = None
+
+            def __eq__(self, other):
+                return isinstance(other, Length)
+
+            def __call__(self, data):
+                return data["n"]
+        unhashable = ezstruct.Struct(
+            "NET_ENDIAN",
+            ezstruct.Field("UINT8", name="n"),
+            ezstruct.Field("BYTES", name="b", length=Length()),
+            codegen=True)
+        self.assertEqual({"n": 2, "b": b"xy"},
+                         unhashable.unpack_bytes(b"\x02xy"))
+        self.roundTrip(ezs, b"\x01\x02\x01x\x02yz", {"a": 1, "b": [b"x", b"yz"]})
+        self.assertRaises(ezstruct.errors.InconsistentLength,
+                          ezstruct.Struct(
+                              "NET_ENDIAN",
+                              ezstruct.Field("BYTES", name="a", length=lambda data: 2),
+                              codegen=True).pack_bytes,
+                          {"a": b"x"})
+
+    def test_unpack_from(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT16", name="a"),
+                              ezstruct.Field("BYTES", name="b",
+                                             length=ezstruct.Delimiter(b"\x00")))
+        packed = b"\xFF\x00\x01xy\x00\x00\x02\x00\x00\x03z\x00"
+        expected = [{"a": 1, "b": b"xy"}, {"a": 2, "b": b""}, {"a": 3, "b": b"z"}]
+        mapped = mmap.mmap(-1, len(packed))
+        mapped.write(packed)
+        buffers = [packed, bytearray(packed), memoryview(packed), mapped]
+        for the_struct in (ezs, ezstruct.Struct("NET_ENDIAN", *ezs.fields,
+                                                codegen=True)):
+            for buffer in buffers:
+                records = []
+                offset = 1
+                while offset < len(packed):
+                    record, size = the_struct.unpack_from(buffer, offset)
+                    records.append(record)
+                    offset += size
+                self.assertEqual(expected, records)
+                self.assertEqual(len(packed), offset)
+                self.assertRaises(ezstruct.errors.DelimiterNotFound,
+                                  the_struct.unpack_from, buffer[:-1], 10)
+                self.assertRaises(struct.error,
+                                  the_struct.unpack_from, buffer, len(packed) - 1)
+
+    def test_pack_into(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT16", name="a"),
+                              ezstruct.Field("STRING", name="b",
+                                             string_encoding="utf-8",
+                                             length=ezstruct.Delimiter(b"\x00")),
+                              ezstruct.Field("UINT8", name="c",
+                                             repeat=ezstruct.Field("UINT8")),
+                              ezstruct.Field("BYTES", name="d",
+                                             length=ezstruct.Field("UINT16")))
+        data = {"a": 1, "b": u"\u00F6", "c": [1, 2], "d": b"xyz"}
+        packed = ezs.pack_bytes(data)
+        self.assertEqual(len(packed), ezs.packed_size(data))
+        self.assertRaises(ezstruct.errors.VariableLength, ezs.calcsize)
+
+        buffer = bytearray(len(packed) + 2)
+        self.assertEqual(len(packed), ezs.pack_into(buffer, 1, data))
+        self.assertEqual(b"\x00" + packed + b"\x00", buffer)
+        self.assertEqual(len(packed) + 2, len(buffer))
+        self.assertRaises(struct.error, ezs.pack_into, buffer, 3, data)
+
+        fixed = ezstruct.Struct("LITTLE_ENDIAN",
+                                ezstruct.Field("UINT32", name="a"),
+                                ezstruct.Field("BYTES", name="b", length=3),
+                                ezstruct.Field("UINT8", name="c", repeat=2))
+        self.assertEqual(9, fixed.calcsize())
+        mapped = mmap.mmap(-1, 9)
+        data = {"a": 1, "b": b"xyz", "c": [2, 3]}
+        self.assertEqual(9, fixed.pack_into(memoryview(mapped), 0, data))
+        self.assertEqual(fixed.pack_bytes(data), mapped[:])
+
+    def test_iter_unpack(self):
+        fixed = ezstruct.Struct("NET_ENDIAN",
+                                ezstruct.Field("UINT16", name="a"),
+                                ezstruct.Field("UINT8", name="b", repeat=2))
+        variable = ezstruct.Struct("NET_ENDIAN",
+                                   ezstruct.Field("UINT16", name="a"),
+                                   ezstruct.Field("UINT8", name="b",
+                                                  repeat=ezstruct.Field("UINT8")))
+        records = [{"a": i, "b": [i % 256, 7]} for i in range(50000)]
+        for ezs in (fixed, variable):
+            packed = b"".join(ezs.pack_bytes(record) for record in records)
+            sources = [lambda: packed,
+                       lambda: memoryview(packed),
+                       lambda: io.BytesIO(packed),
+                       lambda: io.BufferedReader(io.BytesIO(packed))]
+            for source in sources:
+                self.assertEqual(records, list(ezs.iter_unpack(source())))
+            self.assertEqual([], list(ezs.iter_unpack(b"")))
+
+            truncated = ezs.iter_unpack(io.BytesIO(packed[:-1]))
+            for _ in range(len(records) - 1):
+                next(truncated)
+            self.assertRaisesRegex(ezstruct.errors.TruncatedRecord,
+                                   "partway through record 49999",
+                                   next, truncated)
+            self.assertRaises(ezstruct.errors.TruncatedRecord,
+                              list, ezs.iter_unpack(packed[:-1]))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_unpack_array(self):
+        ezs = ezstruct.Struct("BIG_ENDIAN",
+                              ezstruct.Field("UINT64", name="ts"),
+                              ezstruct.Field("UINT8", default_pack_value=0),
+                              ezstruct.Field("BOOL", name="ok"),
+                              ezstruct.Field("SINT16", name="xyz", repeat=3),
+                              ezstruct.Field("BYTES", name="tag", length=2),
+                              ezstruct.Field("FLOAT", name="f"))
+        dtype = ezs.to_numpy_dtype()
+        self.assertEqual(ezs.calcsize(), dtype.itemsize)
+        self.assertEqual(("ts", "ok", "xyz", "tag", "f"), dtype.names)
+        self.assertEqual(">u8", dtype.fields["ts"][0].str)
+
+        records = [{"ts": 1 << 40 | i, "ok": bool(i % 2), "xyz": [i, -i, 3],
+                    "tag": b"ab", "f": 0.5} for i in range(100)]
+        packed = b"".join(ezs.pack_bytes(record) for record in records)
+        array = ezs.unpack_array(packed)
+        self.assertEqual(100, len(array))
+        for record, row in zip(records, array):
+            self.assertEqual(record["ts"], row["ts"])
+            self.assertEqual(record["ok"], row["ok"])
+            self.assertEqual(record["xyz"], list(row["xyz"]))
+            self.assertEqual(record["tag"], row["tag"])
+            self.assertEqual(record["f"], row["f"])
+        self.assertEqual(10, len(ezs.unpack_array(packed, ezs.calcsize(), 10)))
+        self.assertRaises(ezstruct.errors.TruncatedRecord,
+                          ezs.unpack_array, packed[:-1])
+
+        self.assertRaises(ezstruct.errors.IncompatibleField,
+                          ezstruct.Struct("NET_ENDIAN",
+                                          ezstruct.Field("BYTES", length=ezstruct.Field("UINT8"))
+                                         ).to_numpy_dtype)
+
+        self.assertEqual(packed, ezs.pack_array(array))
+        self.assertEqual(packed, ezs.pack_columns({
+            "ts": numpy.array([record["ts"] for record in records]),
+            "ok": [record["ok"] for record in records],
+            "xyz": [record["xyz"] for record in records],
+            "tag": [b"ab"] * len(records),
+            "f": numpy.full(len(records), 0.5)}))
+
+    def test_pack_columns(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT16", name="a"),
+                              ezstruct.Field("BYTES", name="b",
+                                             length=ezstruct.Field("UINT8")))
+        self.assertEqual(b"\x00\x01\x01x\x00\x02\x00",
+                         ezs.pack_columns({"a": [1, 2], "b": [b"x", b""]}))
+
+        # Values which NumPy would store differently from pack_bytes are
+        # packed record by record, which rejects them.
+        fixed = ezstruct.Struct("NET_ENDIAN",
+                                ezstruct.Field("UINT8", name="a"),
+                                ezstruct.Field("BYTES", name="b", length=2),
+                                ezstruct.Field("FLOAT", name="f",
+                                               default_pack_value=0.5))
+        self.assertEqual(b"\x01ab?\x00\x00\x00\xffcd?\x00\x00\x00",
+                         fixed.pack_columns({"a": [1, 255],
+                                             "b": [b"ab", b"cd"]}))
+        for columns in ({"a": [1, 300], "b": [b"ab", b"cd"]},
+                        {"a": [1, -1], "b": [b"ab", b"cd"]},
+                        {"a": [1, 1.7], "b": [b"ab", b"cd"]},
+                        {"a": [1, 2], "b": [b"ab", b"c"]},
+                        {"a": [1, 2], "b": [b"ab", b"cde"]},
+                        {"a": [1, 2], "b": [b"ab", b"cd"], "f": [0, 1e300]}):
+            self.assertRaises((AssertionError, OverflowError, struct.error),
+                              fixed.pack_columns, columns)
+        if numpy is not None:
+            self.assertRaises(struct.error, fixed.pack_columns,
+                              {"a": numpy.array([1, 300]),
+                               "b": numpy.array([b"ab", b"cd"])})
+
+    def test_repeat_container(self):
+        ezs = ezstruct.Struct("LITTLE_ENDIAN",
+                              ezstruct.Field("UINT32", name="a",
+                                             repeat=ezstruct.Field("UINT16"),
+                                             repeat_container="array"),
+                              ezstruct.Field("SINT16", name="b", repeat=2,
+                                             repeat_container="array"),
+                              ezstruct.Field("DOUBLE", name="c", repeat=1,
+                                             repeat_container="list"))
+        unpacked = {"a": array.array("I", [1, 0xFFFFFFFF]),
+                    "b": array.array("h", [-1, 2]),
+                    "c": 0.0}
+        packed = (b"\x02\x00\x01\x00\x00\x00\xFF\xFF\xFF\xFF"
+                  b"\xFF\xFF\x02\x00"
+                  b"\x00\x00\x00\x00\x00\x00\x00\x00")
+        self.roundTrip(ezs, packed, unpacked)
+        self.assertEqual(packed, ezs.pack_bytes({"a": [1, 0xFFFFFFFF],
+                                                 "b": (-1, 2),
+                                                 "c": 0.0}))
+        self.assertEqual(len(packed), ezs.packed_size(unpacked))
+
+        big = ezstruct.Struct("BIG_ENDIAN",
+                              ezstruct.Field("UINT16", name="a", repeat=3,
+                                             repeat_container="array"))
+        self.assertEqual(6, big.calcsize())
+        self.roundTrip(big, b"\x00\x01\x00\x02\x01\x00",
+                       {"a": array.array("H", [1, 2, 256])})
+
+    def test_multibyte_delimiter(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("STRING", name="line",
+                                             string_encoding="ascii",
+                                             length=ezstruct.Delimiter(b"\r\n"),
+                                             repeat=3),
+                              ezstruct.Field("UINT8", name="n"))
+        lines = ["a\rb", "x" * 10000, ""]
+        packed = b"a\rb\r\n" + b"x" * 10000 + b"\r\n\r\n\x05"
+        self.roundTrip(ezs, packed, {"line": lines, "n": 5})
+        for buffer_size in (1, 2, 3, 7, 4096):
+            buf = io.BufferedReader(io.BytesIO(packed + b"more"), buffer_size)
+            self.assertEqual({"line": lines, "n": 5}, ezs.unpack(buf))
+            self.assertEqual(b"more", buf.read())
+        buf = io.BytesIO(packed + b"more")
+        self.assertEqual({"line": lines, "n": 5}, ezs.unpack(buf))
+        self.assertEqual(b"more", buf.read())
+        self.assertRaises(ezstruct.errors.DelimiterNotFound,
+                          ezs.unpack, io.BytesIO(packed[:-3]))
+
+    def test_decoder(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT16", name="a"),
+                              ezstruct.Field("BYTES", name="b",
+                                             length=ezstruct.Delimiter(b"\r\n")),
+                              ezstruct.Field("UINT8", name="c",
+                                             repeat=ezstruct.Field("UINT8")))
+        records = [{"a": i, "b": b"x" * (i % 7), "c": [1] * (i % 3)}
+                   for i in range(2000)]
+        packed = b"".join(ezs.pack_bytes(record) for record in records)
+
+        for fragment_size in (1, 3, 1000, len(packed)):
+            decoder = ezstruct.Decoder(ezs)
+            decoded = []
+            for start in range(0, len(packed), fragment_size):
+                decoder.feed(packed[start:start + fragment_size])
+                decoded.extend(decoder)
+                self.assertLess(decoder.pending, max(fragment_size, 4096) * 2 + 20)
+            self.assertEqual(records, decoded)
+            self.assertEqual(0, decoder.pending)
+            decoder.close()
+
+        decoder = ezstruct.Decoder(ezs)
+        decoder.feed(packed[:-1])
+        self.assertEqual(records[:-1], list(decoder))
+        self.assertRaisesRegex(ezstruct.errors.TruncatedRecord,
+                               "record 1999", decoder.close)
+
+        # A field split across many feeds is decoded once, rather than
+        # again after every feed.
+        calls = []
+
+        def unpack_fn(val):
+            calls.append(val)
+            return val
+        item = ezstruct.Struct("NET_ENDIAN",
+                               ezstruct.Field("UINT8", name="x",
+                                              value_transform=ezstruct.FieldTransform(
+                                                  lambda val: val, unpack_fn)),
+                               ezstruct.Field("BYTES", name="y",
+                                              length=ezstruct.Delimiter(b";")))
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field(item, name="items",
+                                             repeat=ezstruct.Field("UINT16")))
+        record = {"items": [{"x": i % 256, "y": b"ab"} for i in range(1000)]}
+        packed = ezs.pack_bytes(record)
+        decoder = ezstruct.Decoder(ezs)
+        for start in range(0, len(packed), 7):
+            decoder.feed(packed[start:start + 7])
+        self.assertEqual([record], list(decoder))
+        # Checking whether the whole field has arrived unpacks the first
+        # few items, but nothing more is unpacked twice.
+        self.assertLess(len(calls), 1010)
+
+    def test_asyncio(self):
+        import asyncio
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT16", name="a"),
+                              ezstruct.Field("BYTES", name="b",
+                                             length=ezstruct.Delimiter(b"\r\n")),
+                              ezstruct.Field("UINT32", name="c",
+                                             repeat=ezstruct.Field("UINT8"),
+                                             repeat_container="array"),
+                              ezstruct.Field("STRING", name="d",
+                                             string_encoding="utf-8",
+                                             length=ezstruct.Field("UINT8"),
+                                             repeat=2),
+                              ezstruct.Field("UINT16", name="e",
+                                             repeat=ezstruct.Field("UINT8")),
+                              ezstruct.Field("BYTES", name="f", length=2,
+                                             repeat=3))
+        records = [{"a": i, "b": b"x" * i, "c": array.array("I", [i] * i),
+                    "d": [u"\u00F6" * i, u""], "e": list(range(i)),
+                    "f": [b"ab", b"cd", b"ef"]} for i in range(20)]
+
+        loop = asyncio.new_event_loop()
+        run = loop.run_until_complete
+        rsock, wsock = socket.socketpair()
+        reader, reader_side = run(asyncio.open_connection(sock=rsock))
+        _, writer = run(asyncio.open_connection(sock=wsock))
+        written = run(ezs.pack_to_transport(writer, records))
+        writer.close()
+        self.assertEqual(sum(len(ezs.pack_bytes(r)) for r in records), written)
+        self.assertEqual(records,
+                         [run(ezs.unpack_async(reader)) for _ in records])
+        with self.assertRaises(asyncio.IncompleteReadError):
+            run(ezs.unpack_async(reader))
+        reader_side.close()
+        run(asyncio.sleep(0))
+        loop.close()
+
+    def test_record_file(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT16", name="a"),
+                              ezstruct.Field("BYTES", name="b",
+                                             length=ezstruct.Field("UINT8")),
+                              ezstruct.Field("BYTES", name="c",
+                                             length=ezstruct.Delimiter(b"\0")))
+        records = [{"a": i, "b": b"x" * (i % 7), "c": b"y" * i}
+                   for i in range(50)]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "records")
+        index_path = path + ".idx"
+        with open(path, "wb") as data_file:
+            for record in records:
+                ezs.pack(record, data_file)
+
+        with ezstruct.RecordFile(path, ezs, index_path=index_path) as recs:
+            self.assertEqual(50, len(recs))
+            self.assertEqual(records[7], recs[7])
+            self.assertEqual(records[-1], recs[-1])
+            self.assertEqual(records[10:20:3], recs[10:20:3])
+            self.assertEqual(records, list(recs))
+            self.assertEqual(len(ezs.pack_bytes(records[0])), recs.offset(1))
+            self.assertRaises(IndexError, lambda: recs[50])
+        self.assertTrue(os.path.exists(index_path))
+
+        # The saved index is used instead of scanning the file.
+        with open(index_path, "r+b") as index_file:
+            index_file.seek(-16, os.SEEK_END)
+            index_file.write(struct.pack("<Q", 0))
+        with ezstruct.RecordFile(path, ezs, index_path=index_path) as recs:
+            self.assertEqual(records[0], recs[49])
+
+        # An index of a data file which has since been rewritten, or of
+        # a different structure, is rebuilt.
+        renamed = ezstruct.Struct("NET_ENDIAN",
+                                  ezstruct.Field("UINT16", name="z"),
+                                  *ezs.fields[1:])
+        with ezstruct.RecordFile(path, renamed,
+                                 index_path=index_path) as recs:
+            self.assertEqual(records[49]["c"], recs[49]["c"])
+        ezstruct.RecordFile(path, ezs, index_path=index_path).close()
+        with open(index_path, "r+b") as index_file:
+            index_file.seek(-16, os.SEEK_END)
+            index_file.write(struct.pack("<Q", 0))
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        with ezstruct.RecordFile(path, ezs, index_path=index_path) as recs:
+            self.assertEqual(records[49], recs[49])
+
+        # A stale index is rebuilt.
+        with open(path, "ab") as data_file:
+            ezs.pack(records[3], data_file)
+        with ezstruct.RecordFile(path, ezs, index_path=index_path) as recs:
+            self.assertEqual(51, len(recs))
+            self.assertEqual(records[49], recs[49])
+            self.assertEqual(records[3], recs[50])
+
+        with open(path, "ab") as data_file:
+            data_file.write(b"\0\1\5ab")
+        with self.assertRaises(ezstruct.errors.TruncatedRecord) as ctx:
+            ezstruct.RecordFile(path, ezs)
+        self.assertEqual(51, ctx.exception.index)
+
+        fixed = ezstruct.Struct("LITTLE_ENDIAN",
+                                ezstruct.Field("UINT32", name="a"))
+        with open(path, "wb") as data_file:
+            data_file.write(fixed.pack_columns({"a": list(range(100))}))
+        with ezstruct.RecordFile(path, fixed) as recs:
+            self.assertEqual(100, len(recs))
+            self.assertEqual({"a": 42}, recs[42])
+            self.assertEqual([{"a": 98}, {"a": 99}], recs[-2:])
+
+        open(path, "wb").close()
+        with ezstruct.RecordFile(path, ezs) as recs:
+            self.assertEqual([], list(recs))
+
+    def test_record_file_bisect(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT8", name="flags"),
+                              ezstruct.Field("BYTES", name="tag", length=3),
+                              ezstruct.Field("UINT64", name="time"),
+                              ezstruct.Field("SINT16", name="vals", repeat=2))
+        times = [10, 20, 20, 20, 35, 50, 51, 90]
+        records = [{"flags": 1, "tag": b"abc", "time": t, "vals": [t, -t]}
+                   for t in times]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "records")
+        with open(path, "wb") as data_file:
+            data_file.write(ezs.pack_columns({
+                "flags": [1] * len(times), "tag": [b"abc"] * len(times),
+                "time": times, "vals": [[t, -t] for t in times]}))
+
+        with ezstruct.RecordFile(path, ezs) as recs:
+            self.assertEqual(0, recs.bisect("time", 0))
+            self.assertEqual(1, recs.bisect("time", 20))
+            self.assertEqual(4, recs.bisect("time", 21))
+            self.assertEqual(8, recs.bisect("time", 91))
+            self.assertEqual(records[1:5],
+                             list(recs.find_range("time", 20, 50)))
+            self.assertEqual([], list(recs.find_range("time", 52, 90)))
+            self.assertRaises(KeyError, recs.bisect, "nope", 1)
+            self.assertRaises(ezstruct.errors.IncompatibleField,
+                              recs.bisect, "vals", 1)
+
+        variable = ezstruct.Struct("NET_ENDIAN",
+                                   ezstruct.Field("UINT64", name="time"),
+                                   ezstruct.Field("BYTES", name="b",
+                                                  length=ezstruct.Field("UINT8")))
+        with open(path, "wb") as data_file:
+            variable.pack({"time": 1, "b": b"x"}, data_file)
+        with ezstruct.RecordFile(path, variable) as recs:
+            self.assertRaises(ezstruct.errors.VariableLength,
+                              recs.bisect, "time", 1)
+
+    def test_view(self):
+        decoded = []
+
+        def unpack_upper(val):
+            decoded.append(val)
+            return val.upper()
+
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT8", name="kind"),
+                              ezstruct.Field("UINT8", default_pack_value=0),
+                              ezstruct.Field("BYTES", name="body",
+                                             length=ezstruct.Field("UINT16")),
+                              ezstruct.Field("STRING", name="tag",
+                                             string_encoding="utf-8",
+                                             length=ezstruct.Delimiter(b"\0"),
+                                             value_transform=ezstruct.FieldTransform(
+                                                 lambda val: val, unpack_upper)),
+                              ezstruct.Field("UINT8", name="n"),
+                              ezstruct.Field("BYTES", name="tail",
+                                             length=lambda data: data["n"]),
+                              ezstruct.Field("UINT16", name="nums",
+                                             repeat=ezstruct.Field("UINT8"),
+                                             repeat_container="array"))
+        data = {"kind": 7, "body": b"x" * 300, "tag": u"ab", "n": 3,
+                "tail": b"xyz", "nums": array.array("H", [1, 2])}
+        packed = b"\xff" + ezs.pack_bytes(data) + b"junk"
+
+        view = ezs.view(packed, 1)
+        self.assertEqual(7, view.kind)
+        self.assertEqual([], decoded)
+        self.assertEqual(b"xyz", view["tail"])
+        self.assertEqual([], decoded)
+        self.assertEqual(u"AB", view.tag)
+        self.assertEqual(u"AB", view.get("tag"))
+        self.assertEqual([u"ab"], decoded)
+        self.assertEqual(len(packed) - 5, view.size)
+        self.assertEqual(dict(data, tag=u"AB"), view.to_dict())
+        self.assertEqual(ezs.unpack_from(packed, 1),
+                         (view.to_dict(), view.size))
+        self.assertEqual(["kind", "body", "tag", "n", "tail", "nums"],
+                         list(view))
+        self.assertTrue("body" in view)
+        self.assertIsNone(view.get("nope"))
+        self.assertRaises(KeyError, lambda: view["nope"])
+        self.assertRaises(AttributeError, lambda: view.nope)
+
+        # Only the fields that are used need to be present.
+        view = ezs.view(packed[1:10])
+        self.assertEqual(7, view.kind)
+        self.assertRaises(struct.error, lambda: view.body)
+        self.assertRaises(struct.error, lambda: view.size)
+
+        fixed = ezstruct.Struct("LITTLE_ENDIAN",
+                                ezstruct.Field("UINT16", name="a"),
+                                ezstruct.Field("UINT32", name="b"))
+        view = fixed.view(bytearray(b"\1\0\2\0\0\0"))
+        self.assertEqual(2, view.b)
+        self.assertEqual(6, view.size)
+
+    def test_record_class(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT8", name="a"),
+                              ezstruct.Field("UINT8", default_pack_value=9),
+                              ezstruct.Field("UINT16", name="b",
+                                             default_pack_value=5),
+                              ezstruct.Field("BYTES", name="c",
+                                             length=lambda data: data["a"]))
+        compiled = ezstruct.Struct("NET_ENDIAN", *ezs.fields, codegen=True)
+        cls = ezs.record_class()
+        self.assertIs(cls, ezs.record_class())
+        self.assertTrue(issubclass(cls, ezstruct.record.Record))
+
+        rec = cls(2, c=b"xy")
+        self.assertEqual(2, rec.a)
+        self.assertEqual(b"xy", rec["c"])
+        self.assertNotIn("b", rec)
+        self.assertEqual({"a": 2, "c": b"xy"}, dict(rec))
+        self.assertEqual("Record(a=2, c=b'xy')", repr(rec))
+        self.assertFalse(hasattr(rec, "__dict__"))
+        self.assertLess(sys.getsizeof(rec),
+                        sys.getsizeof({"a": 2, "b": 5, "c": b"xy"}))
+        self.assertRaises(TypeError, cls, 1, 2, 3, 4)
+        self.assertRaises(TypeError, cls, d=1)
+
+        packed = b"\x02\x09\x00\x05xy"
+        for the_struct in (ezs, compiled):
+            self.assertEqual(packed, the_struct.pack_bytes(rec))
+            cls = the_struct.record_class()
+            unpacked = the_struct.unpack_bytes(packed, as_record=True)
+            self.assertIsInstance(unpacked, cls)
+            self.assertEqual(cls(2, 5, b"xy"), unpacked)
+            self.assertNotEqual(cls(2, 6, b"xy"), unpacked)
+            self.assertEqual(
+                (unpacked, 6),
+                the_struct.unpack_from(b"\0" + packed, 1, as_record=True))
+            self.assertEqual(
+                unpacked,
+                the_struct.unpack(io.BufferedReader(io.BytesIO(packed)),
+                                  as_record=True))
+            self.assertEqual([unpacked] * 2,
+                             list(the_struct.iter_unpack(packed * 2,
+                                                         as_record=True)))
+            self.assertEqual({"a": 2, "b": 5, "c": b"xy"},
+                             the_struct.unpack_bytes(packed))
+
+        fixed = ezstruct.Struct("NET_ENDIAN",
+                                ezstruct.Field("UINT8", name="x"),
+                                ezstruct.Field("UINT8", name="y"))
+        self.assertEqual([fixed.record_class()(1, 2)],
+                         list(fixed.iter_unpack(b"\1\2", as_record=True)))
+
+    def test_parallel(self):
+        import pickle
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "records")
+
+        records = [{"n": i % 50, "b": b"x" * (i % 50)} for i in range(1000)]
+        with open(path, "wb") as data_file:
+            for record in records:
+                PARALLEL_STRUCT.pack(record, data_file)
+        self.assertRaises(Exception, pickle.dumps, PARALLEL_STRUCT)
+        self.assertEqual(records, list(ezstruct.parallel.decode_file(
+            path, "%s:PARALLEL_STRUCT" % __name__, workers=2,
+            chunk_size=1000)))
+
+        # The parent process skips over records without unpacking them,
+        # so that its scan is cheaper than decoding the file serially.
+        records = [{"b": b"x" * (i % 50)} for i in range(1000)]
+        with open(path, "wb") as data_file:
+            for record in records:
+                COUNTED_STRUCT.pack(record, data_file)
+        del PARALLEL_UNPACKED[:]
+        self.assertEqual(records, list(ezstruct.parallel.decode_file(
+            path, "%s:COUNTED_STRUCT" % __name__, workers=2,
+            chunk_size=1000)))
+        self.assertEqual([], PARALLEL_UNPACKED)
+
+        # Chunks have at least one record, however small chunk_size is.
+        with ezstruct.RecordFile(path, COUNTED_STRUCT) as recs:
+            self.assertEqual([(recs.offset(i), recs.offset(i + 1))
+                              for i in range(1000)], recs.split(0))
+            self.assertEqual(recs.split(1), recs.split(-5))
+        self.assertEqual(records[:3], list(ezstruct.parallel.decode_file(
+            path, "%s:COUNTED_STRUCT" % __name__, workers=2,
+            chunk_size=0))[:3])
+
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT16", name="a"),
+                              ezstruct.Field("SINT8", name="b", repeat=2),
+                              codegen=True)
+        ezs = pickle.loads(pickle.dumps(ezs))
+        records = [{"a": i, "b": [i % 100, -1]} for i in range(1000)]
+        with open(path, "wb") as data_file:
+            for record in records:
+                ezs.pack(record, data_file)
+        self.assertEqual(records, list(ezstruct.parallel.decode_file(
+            path, ezs, workers=2, chunk_size=1000)))
+
+        with ezstruct.RecordFile(path, ezs) as recs:
+            self.assertEqual([(0, 1000), (1000, 2000), (2000, 3000),
+                              (3000, 4000)], recs.split(1000))
+            self.assertEqual([(0, 4000)], recs.split(10000))
+
+        open(path, "wb").close()
+        self.assertEqual([], list(ezstruct.parallel.decode_file(path, ezs)))
+
+    def test_stats(self):
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT8", name="a"),
+                              ezstruct.Field("UINT8", default_pack_value=0),
+                              ezstruct.Field("BYTES", name="b",
+                                             length=ezstruct.Delimiter(b"\0"),
+                                             repeat=2),
+                              ezstruct.Field("UINT16", name="c",
+                                             value_transform=ezstruct.FieldTransform(
+                                                 lambda val: val + 1,
+                                                 lambda val: val - 1)),
+                              ezstruct.Field("UINT8", name="d", repeat=2,
+                                             value_transform=ezstruct.EnumTransform(
+                                                 ["off", "on"])),
+                              ezstruct.Field("UINT8", name="e",
+                                             repeat=ezstruct.Field("UINT8"),
+                                             value_transform=ezstruct.EnumTransform(
+                                                 ["off", "on"])),
+                              codegen=True)
+        data = {"a": 1, "b": [b"xy", b""], "c": 5, "d": ["on", "off"],
+                "e": ["on", "on", "off"]}
+        packed = b"\x01\x00xy\x00\x00\x00\x06\x01\x00\x03\x01\x01\x00"
+        self.assertIsNone(ezs.stats_snapshot())
+
+        ezs.enable_stats()
+        self.assertEqual(packed, ezs.pack_bytes(data))
+        self.assertEqual(data, ezs.unpack_bytes(packed))
+        self.assertEqual(data,
+                         ezs.unpack(io.BufferedReader(io.BytesIO(packed))))
+        decoder = ezstruct.Decoder(ezs)
+        decoder.feed(packed)
+        self.assertEqual([data], list(decoder))
+
+        stats = ezs.stats_snapshot()
+        self.assertEqual(["[1]", "a", "b", "c", "d", "e"], sorted(stats))
+        self.assertEqual(1, stats["a"]["pack_calls"])
+        self.assertEqual(3, stats["a"]["unpack_calls"])
+        self.assertEqual(1, stats["[1]"]["bytes_packed"])
+        self.assertEqual(4, stats["b"]["bytes_packed"])
+        self.assertEqual(12, stats["b"]["bytes_unpacked"])
+        self.assertEqual(6, stats["b"]["delimiter_scans"])
+        self.assertEqual(0, stats["a"]["delimiter_scans"])
+        self.assertEqual(4, stats["c"]["transform_calls"])
+        self.assertEqual(8, stats["d"]["transform_calls"])
+        # Each value of a variable-length repeated field is counted.
+        self.assertEqual(12, stats["e"]["transform_calls"])
+        self.assertEqual(6, stats["c"]["bytes_unpacked"])
+        self.assertGreater(stats["b"]["unpack_time"], 0)
+
+        ezs.reset_stats()
+        self.assertEqual(0, ezs.stats_snapshot()["b"]["bytes_unpacked"])
+        ezs.disable_stats()
+        self.assertIsNone(ezs.stats_snapshot())
+        self.assertEqual(data, ezs.unpack_bytes(packed))
+        self.assertIsNotNone(ezs._compiled)  # pylint: disable=protected-access
+
+    def test_nested_struct(self):
+        header = ezstruct.Struct("NET_ENDIAN",
+                                 ezstruct.Field("UINT8", name="version"),
+                                 ezstruct.Field("UINT16", name="kind"))
+        point = ezstruct.Struct("NET_ENDIAN",
+                                ezstruct.Field("SINT8", name="x"),
+                                ezstruct.Field("SINT8", name="y"))
+        message = ezstruct.Struct("NET_ENDIAN",
+                                  ezstruct.Field(header, name="header"),
+                                  ezstruct.Field(point, name="points", repeat=2),
+                                  ezstruct.Field("UINT8", name="z"))
+        data = {"header": {"version": 1, "kind": 0x203},
+                "points": [{"x": 4, "y": -1}, {"x": 5, "y": 6}],
+                "z": 7}
+        packed = b"\x01\x02\x03\x04\xff\x05\x06\x07"
+        self.roundTrip(message, packed, data)
+        self.assertEqual(8, message.calcsize())
+        self.assertEqual(3, message.fields[0].fixed_size)
+        # The nested structures are folded into one struct.Struct.
+        steps = message._get_plan()  # pylint: disable=protected-access
+        self.assertEqual(1, len(steps))
+        self.assertEqual(">BHbbbbB", steps[0].struct.format)
+        self.assertEqual([data] * 2, list(message.iter_unpack(packed * 2)))
+        self.assertEqual(data["points"][1]["y"],
+                         message.view(packed).points[1]["y"])
+
+        # Variable-length and differently-ordered nested structures, and
+        # counted repeats, are handled by their own plans.
+        little = ezstruct.Struct("LITTLE_ENDIAN",
+                                 ezstruct.Field("UINT16", name="n"))
+        named = ezstruct.Struct("NET_ENDIAN",
+                                ezstruct.Field("UINT8", name="n"),
+                                ezstruct.Field("BYTES", name="name",
+                                               length=lambda data: data["n"]))
+        outer = ezstruct.Struct("NET_ENDIAN",
+                                ezstruct.Field(header, name="header"),
+                                ezstruct.Field(little, name="little"),
+                                ezstruct.Field(named, name="names",
+                                               repeat=ezstruct.Field("UINT8")),
+                                ezstruct.Field(point, name="point"))
+        data = {"header": {"version": 1, "kind": 2},
+                "little": {"n": 0x102},
+                "names": [{"n": 2, "name": b"ab"}, {"n": 0, "name": b""}],
+                "point": {"x": 1, "y": 2}}
+        packed = (b"\x01\x00\x02" + b"\x02\x01" + b"\x02\x02ab\x00" +
+                  b"\x01\x02")
+        self.roundTrip(outer, packed, data)
+        self.assertRaises(ezstruct.errors.VariableLength, outer.calcsize)
+        self.assertEqual(len(packed), outer.packed_size(data))
+        self.assertEqual(data["point"], outer.view(packed).point)
+        self.assertEqual(len(packed), outer.view(packed).size)
+        decoder = ezstruct.Decoder(outer)
+        for byte in packed * 2:
+            decoder.feed(bytes((byte, )))
+        self.assertEqual([data] * 2, list(decoder))
+        self.assertNotEqual(
+            outer.schema_key(),
+            ezstruct.Struct("NET_ENDIAN",
+                            ezstruct.Field(point, name="header"),
+                            *outer.fields[1:]).schema_key())
+
+    def test_bitfield(self):
+        import pickle
+        nibbles = [("high", 4), ("low", 4)]
+        ezs = ezstruct.Struct(
+            "NET_ENDIAN",
+            ezstruct.Field("UINT16", name="flags",
+                           bits=[("offset", 4), (None, 3), ("ns", 1),
+                                 ("syn", 1)]),
+            ezstruct.Field("UINT8", name="pair", repeat=2, bits=nibbles),
+            ezstruct.Field("UINT8", name="counted",
+                           repeat=ezstruct.Field("UINT8"), bits=nibbles),
+            ezstruct.Field("UINT8", name="moved", bits=nibbles,
+                           value_transform=ezstruct.FieldTransform(
+                               lambda val: {"high": val["low"],
+                                            "low": val["high"]},
+                               lambda val: {"high": val["low"],
+                                            "low": val["high"]})))
+        data = {"flags": {"offset": 5, "ns": 1, "syn": 1},
+                "pair": [{"high": 1, "low": 2}, {"high": 0xf, "low": 0}],
+                "counted": [{"high": 3, "low": 4}],
+                "moved": {"high": 5, "low": 6}}
+        packed = b"\x51\x80\x12\xf0\x01\x34\x65"
+        self.roundTrip(ezs, packed, data)
+        self.assertEqual(data["pair"], ezs.view(packed).pair)
+        # Fixed-size bitfields are folded into the coalesced format.
+        self.assertEqual(">HBB", ezs._get_plan()[0].struct.format)  # pylint: disable=protected-access
+
+        # Unused bits are packed as zero, and values must fit.
+        self.assertEqual(b"\x00\x80\x00\x00\x00\x00",
+                         ezs.pack_bytes({"flags": {"syn": 1},
+                                         "pair": [{}, {}],
+                                         "counted": [],
+                                         "moved": {"high": 0, "low": 0}}))
+        self.assertRaises(AssertionError, ezs.pack_bytes,
+                          dict(data, flags={"offset": 16}))
+        self.assertRaises(AssertionError, ezs.pack_bytes,
+                          dict(data, counted=[{"high": 16}]))
+        self.assertRaises(AssertionError, ezstruct.Field, "SINT8",
+                          bits=nibbles)
+        # Pairs can be lists, as they are in JSON schemas.
+        listed = ezstruct.Struct("NET_ENDIAN",
+                                 ezstruct.Field("UINT8", name="n",
+                                                bits=[["high", 4], ["low", 4]]),
+                                 codegen=True)
+        self.assertEqual({"n": {"high": 1, "low": 2}},
+                         listed.unpack_bytes(b"\x12"))
+        self.assertRaises(AssertionError, ezstruct.Field, "UINT8",
+                          bits=[("a", 9)])
+        fixed = ezstruct.Struct("NET_ENDIAN", *ezs.fields[:2])
+        self.assertEqual({"flags": data["flags"], "pair": data["pair"]},
+                         pickle.loads(pickle.dumps(fixed)).unpack_bytes(packed[:4]))
+
+    def test_intern_strings(self):
+        import pickle
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("STRING", name="host",
+                                             string_encoding="latin-1",
+                                             length=ezstruct.Field("UINT8"),
+                                             intern_strings=2),
+                              ezstruct.Field("STRING", name="label",
+                                             string_encoding="cp1252",
+                                             length=ezstruct.Delimiter(b"\x00"),
+                                             intern_strings=True))
+        data = {"host": u"b\u00e9ta", "label": u"\u20ac"}
+        packed = b"\x04b\xe9ta\x80\x00"
+        self.roundTrip(ezs, packed, data)
+        first, second = ezs.iter_unpack(packed * 2)
+        self.assertEqual(data, first)
+        self.assertIs(first["host"], second["host"])
+        self.assertIs(first["label"], second["label"])
+
+        # Only the first two distinct hosts are kept.
+        hosts = [ezs.unpack_bytes(b"\x02" + host + b"\x00")["host"]
+                 for host in (b"aa", b"aa", b"cc", b"cc")]
+        self.assertEqual([u"aa", u"aa", u"cc", u"cc"], hosts)
+        self.assertIs(hosts[0], hosts[1])
+        self.assertIsNot(hosts[2], hosts[3])
+        self.assertEqual(data,
+                         pickle.loads(pickle.dumps(ezs)).unpack_bytes(packed))
+        self.assertRaises(AssertionError, ezstruct.Field, "BYTES", length=1,
+                          intern_strings=True)
+
+    def test_enum_transform(self):
+        import enum
+
+        class Color(enum.Enum):
+            red = 1
+            blue = 2
+            green = 3
+
+        colors = ezstruct.EnumTransform(Color)
+        names = ezstruct.EnumTransform([b"zero", b"one", b"two"])
+        ezs = ezstruct.Struct(
+            "NET_ENDIAN",
+            ezstruct.Field("UINT8", name="color", value_transform=colors),
+            ezstruct.Field("UINT8", name="colors", repeat=2,
+                           value_transform=colors),
+            ezstruct.Field("UINT8", name="names",
+                           repeat=ezstruct.Field("UINT8"),
+                           value_transform=names),
+            ezstruct.Field("UINT16", name="codes", repeat=2,
+                           repeat_container="array",
+                           value_transform=ezstruct.EnumTransform(
+                               {0x101: "a", 0x202: "b"})))
+        data = {"color": Color.blue,
+                "colors": [Color.green, Color.red],
+                "names": [b"two", b"zero"],
+                "codes": ["b", "a"]}
+        packed = b"\x02\x03\x01\x02\x02\x00\x02\x02\x01\x01"
+        self.roundTrip(ezs, packed, data)
+        # The fixed-size fields are still coalesced.
+        self.assertEqual(">BBB", ezs._get_plan()[0].struct.format)  # pylint: disable=protected-access
+        self.assertEqual(Color.green, ezs.view(packed).colors[0])
+        self.assertRaises(KeyError, ezs.pack_bytes, dict(data, color=4))
+        self.assertRaises(KeyError, ezs.unpack_bytes, b"\x04" + packed[1:])
+        self.assertRaises(AssertionError, ezstruct.EnumTransform, {1: "a", 2: "a"})
+
+    def test_cached_transform(self):
+        import pickle
+        import threading
+        calls = []
+
+        def parse(val):
+            calls.append(val)
+            return val * 2
+
+        transform = ezstruct.FieldTransform(lambda val: val // 2, parse,
+                                            element_wise=True, cache_size=2)
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT8", name="a", repeat=4,
+                                             value_transform=transform))
+        self.assertEqual({"a": [2, 4, 2, 6]},
+                         ezs.unpack_bytes(b"\x01\x02\x01\x03"))
+        # 1 was a hit; 3 evicted 2, the least recently used.
+        self.assertEqual([1, 2, 3], calls)
+        self.assertEqual({"hits": 1, "misses": 3, "evictions": 1,
+                          "uncacheable": 0, "size": 2},
+                         transform.cache_info()["unpack"])
+        # Only 2 needs computing again.
+        ezs.unpack_bytes(b"\x03\x01\x02\x01")
+        self.assertEqual([1, 2, 3, 2], calls)
+        # Equal values of different types are cached separately.
+        self.assertEqual(2, transform.unpack(True))
+        self.assertEqual(5, transform.cache_info()["unpack"]["misses"])
+
+        # Lists are keyed as tuples, and unhashable values aren't cached.
+        summed = ezstruct.FieldTransform(sum, list, cache_size=4)
+        self.assertEqual(3, summed.pack([1, 2]))
+        self.assertEqual(3, summed.pack([1, 2]))
+        self.assertEqual([1], summed.unpack({1: None}))
+        self.assertEqual({"hits": 1, "misses": 1, "evictions": 0,
+                          "uncacheable": 0, "size": 1},
+                         summed.cache_info()["pack"])
+        self.assertEqual(1, summed.cache_info()["unpack"]["uncacheable"])
+
+        # Each caller gets its own copy of a cached list.
+        spread = ezstruct.FieldTransform(sum, lambda val: [val] * 2,
+                                         cache_size=4)
+        spread.unpack(1).append(2)
+        self.assertEqual([1, 1], spread.unpack(1))
+        self.assertEqual(1, spread.cache_info()["unpack"]["hits"])
+
+        def unpack_many():
+            for _ in range(200):
+                ezs.unpack_bytes(b"\x01\x02\x03\x04")
+        threads = [threading.Thread(target=unpack_many) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = transform.cache_info()["unpack"]
+        self.assertEqual(9 + 4 * 200 * 4, info["hits"] + info["misses"])
+        self.assertEqual(2, info["size"])
+
+        # Clearing the cache takes the lock other threads hold, rather
+        # than replacing it.
+        lock = transform.unpack._lock  # pylint: disable=protected-access
+        transform.clear_cache()
+        self.assertEqual(0, transform.cache_info()["unpack"]["hits"])
+        self.assertIs(lock, transform.unpack._lock)  # pylint: disable=protected-access
+        self.assertIsNone(ezstruct.FieldTransform(int, int).cache_info())
+        copied = pickle.loads(pickle.dumps(summed))
+        self.assertEqual(3, copied.pack([1, 2]))
+        self.assertEqual(1, copied.cache_info()["pack"]["misses"])
+
+    def test_decode_cache(self):
+        import pickle
+        import threading
+        point = ezstruct.Struct("NET_ENDIAN",
+                                ezstruct.Field("UINT8", name="x"),
+                                ezstruct.Field("UINT8", name="y"))
+        ezs = ezstruct.Struct("NET_ENDIAN",
+                              ezstruct.Field("UINT8", name="status"),
+                              ezstruct.Field("UINT8", name="loads", repeat=2),
+                              ezstruct.Field(point, name="point"))
+        self.assertIsNone(ezs.decode_cache_info())
+        ezs.enable_decode_cache(max_entries=2)
+        first = ezs.unpack_bytes(b"\x01\x02\x03\x04\x05")
+        self.assertIs(first, ezs.unpack_bytes(bytearray(b"\x01\x02\x03\x04\x05")))
+        self.assertEqual({"status": 1, "loads": (2, 3),
+                          "point": {"x": 4, "y": 5}}, first.to_dict())
+        self.assertEqual(ezs.frozen_record_class()(status=1, loads=[2, 3],
+                                                   point={"x": 4, "y": 5}),
+                         first)
+        self.assertEqual(hash(first), hash(ezs.frozen_record_class()(**first.to_dict())))
+
+        # Results can't be modified.
+        self.assertRaises(AttributeError, setattr, first, "status", 2)
+        self.assertRaises(TypeError, first.__setitem__, "status", 2)
+        self.assertRaises(TypeError, first.point.__setitem__, "x", 2)
+        self.assertRaises(TypeError, first.point.update, {"x": 2})
+        point = first.point
+        with self.assertRaises(TypeError):
+            point |= {"x": 2}
+        self.assertEqual({"x": 4, "y": 5}, first.point)
+        self.assertIs(first, ezs.unpack_bytes(b"\x01\x02\x03\x04\x05",
+                                              as_record=True))
+        self.assertEqual(frozenset([(1, 2)]),
+                         ezstruct.record.freeze(set([(1, 2)])))
+
+        ezs.unpack_bytes(b"\x02\x00\x00\x00\x00")
+        ezs.unpack_bytes(b"\x03\x00\x00\x00\x00")
+        info = ezs.decode_cache_info()
+        self.assertEqual((2, 3, 1, 2), (info["hits"], info["misses"],
+                                        info["evictions"], info["entries"]))
+        self.assertEqual(0.4, info["hit_rate"])
+        self.assertIsNot(first, ezs.unpack_bytes(b"\x01\x02\x03\x04\x05"))
+
+        # Results larger than the memory budget aren't kept.
+        ezs.enable_decode_cache(max_bytes=1)
+        ezs.unpack_bytes(b"\x01\x02\x03\x04\x05")
+        info = ezs.decode_cache_info()
+        self.assertEqual((1, 0, 0), (info["uncached"], info["entries"],
+                                     info["bytes"]))
+
+        # Clearing the cache while other threads fill it keeps the byte
+        # count in step with the entries.
+        ezs.enable_decode_cache(max_entries=64)
+
+        def unpack_many():
+            for i in range(2000):
+                ezs.unpack_bytes(bytes((i % 200, 0, 0, 0, 0)))
+        threads = [threading.Thread(target=unpack_many) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for _ in range(100):
+            ezs._decode_cache.clear()  # pylint: disable=protected-access
+        for thread in threads:
+            thread.join()
+        entries = ezs._decode_cache._entries  # pylint: disable=protected-access
+        self.assertEqual(sum(size for _, size in entries.values()),
+                         ezs.decode_cache_info()["bytes"])
+
+        copied = pickle.loads(pickle.dumps(ezs))
+        self.assertIsNone(copied.decode_cache_info())
+        ezs.disable_decode_cache()
+        self.assertEqual({"status": 1, "loads": [2, 3], "point": {"x": 4, "y": 5}},
+                         ezs.unpack_bytes(b"\x01\x02\x03\x04\x05"))
+
+    def test_load_schema(self):
+        import json
+        schema = {
+            "Header": {"byte_order": "NET_ENDIAN",
+                       "fields": [{"type": "UINT8", "name": "version"},
+                                  {"type": "UINT8", "name": "flags",
+                                   "bits": [["syn", 1], [None, 7]]}]},
+            "Message": {"byte_order": "NET_ENDIAN",
+                        "fields": [{"type": "Header", "name": "header"},
+                                   {"type": "UINT8", "name": "kind",
+                                    "enum": {"1": "ping", "2": "pong"}},
+                                   {"type": "STRING", "name": "topic",
+                                    "string_encoding": "utf-8",
+                                    "length": {"delimiter": "00"}},
+                                   {"type": "UINT16", "name": "ids",
+                                    "repeat": {"type": "UINT8"}}]}}
+        data = {"header": {"version": 1, "flags": {"syn": 1}},
+                "kind": "pong",
+                "topic": u"t",
+                "ids": [1, 2]}
+        packed = b"\x01\x80\x02t\x00\x02\x00\x01\x00\x02"
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            structs = ezstruct.load_schema(io.StringIO(u"%s" % json.dumps(schema)),
+                                           code_cache=cache_dir)
+            self.assertEqual(["Header", "Message"], sorted(structs))
+            message = structs["Message"]
+            self.assertIs(structs["Header"],
+                          message.fields[0].type.nested_struct)
+            # Structures are only compiled once they're used.
+            self.assertIsNone(message._compiled)  # pylint: disable=protected-access
+            self.assertEqual(data, message.unpack_bytes(packed))
+            self.assertIsNotNone(message._compiled)  # pylint: disable=protected-access
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            self.roundTrip(message, packed, data)
+            structs["Header"].warm_up()
+            self.assertIsNotNone(structs["Header"]._compiled)  # pylint: disable=protected-access
+            self.assertEqual(2, len(os.listdir(cache_dir)))
+
+            # Compiled code is loaded from the cache, and unreadable
+            # files are ignored.
+            ezstruct.codegen._COMPILED.clear()  # pylint: disable=protected-access
+            loaded = ezstruct.load_schema(schema, code_cache=cache_dir)
+            loaded["Message"].warm_up()
+            self.assertEqual(data, loaded["Message"].unpack_bytes(packed))
+            for name in os.listdir(cache_dir):
+                with open(os.path.join(cache_dir, name), "wb") as cached:
+                    cached.write(b"junk")
+            ezstruct.codegen._COMPILED.clear()  # pylint: disable=protected-access
+            loaded = ezstruct.load_schema(schema, codegen=True,
+                                          code_cache=cache_dir)
+            self.assertEqual(packed, loaded["Message"].pack_bytes(data))
+        finally:
+            shutil.rmtree(cache_dir)
+
+        for bad in ({"A": {"fields": []}},
+                    {"A": {"byte_order": "MIDDLE_ENDIAN"}},
+                    {"A": {"byte_order": "NET_ENDIAN",
+                           "fields": [{"type": "UINT7"}]}},
+                    {"A": {"byte_order": "NET_ENDIAN",
+                           "fields": [{"type": "UINT8", "size": 1}]}},
+                    {"A": {"byte_order": "NET_ENDIAN",
+                           "fields": [{"type": "A"}]}},
+                    {"A": {"byte_order": "NET_ENDIAN",
+                           "fields": [{"type": "BYTES",
+                                       "length": {"delimiter": "zz"}}]}},
+                    {"A": {"byte_order": "NET_ENDIAN",
+                           "fields": [{"type": "STRING", "length": 1}]}},
+                    []):
+            self.assertRaises(ezstruct.errors.SchemaError,
+                              ezstruct.load_schema, bad)
+
 
 if __name__ == "__main__":
     unittest.main()